@@ -0,0 +1,191 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+BigQuery estimates module
+
+Predicts how long BigQuery jobs take, so that workers poll short jobs within
+a second and hand long ones over to the poller without waiting for them.
+Predictions combine the progress BigQuery reports for a running job (stages
+of the query plan) with the durations observed for the same
+query fingerprint on previous runs.
+"""
+
+import hashlib
+import re
+import threading
+
+
+# Smallest and largest delays between two checks of a job, in seconds.
+MIN_POLL_DELAY = 0.5
+MAX_POLL_DELAY = 30
+
+# Weight of the latest run in the moving average of durations.
+HISTORY_WEIGHT = 0.5
+
+# Time to keep durations of a fingerprint, 30 days by default.
+HISTORY_TTL = 30 * 24 * 60 * 60
+
+_HISTORY_KEY_PREFIX = 'bq_duration:'
+_LOCK = threading.Lock()
+# Durations of the instance, used where memcache isn't available.
+_LOCAL_HISTORY = {}
+
+
+def _table_name(table):
+  if table is None:
+    return ''
+  return '.'.join('%s' % getattr(table, attr, '')
+                  for attr in ('project', 'dataset_name', 'name'))
+
+
+def _names(values):
+  if not isinstance(values, (list, tuple)):
+    return ''
+  return ' '.join('%s' % value for value in values)
+
+
+def fingerprint(worker_class, job):
+  """Returns a key identifying runs of the same job across executions.
+
+  Runs are identified by the type of the job, its query, its source URIs or
+  tables and its destination table or URIs.
+  """
+  statement = getattr(job, 'query', None) or ''
+  statement = re.sub(r'\s+', ' ', '%s' % statement).strip()
+  sources = getattr(job, 'sources', None)
+  if isinstance(sources, (list, tuple)):
+    sources = ' '.join(_table_name(table) for table in sources)
+  else:
+    sources = _table_name(getattr(job, 'source', None))
+  parts = [
+      worker_class,
+      job.__class__.__name__,
+      statement,
+      _names(getattr(job, 'source_uris', None)),
+      sources,
+      _table_name(getattr(job, 'destination', None)),
+      _names(getattr(job, 'destination_uris', None)),
+  ]
+  key = ':'.join(parts)
+  if isinstance(key, unicode):
+    # Queries and URIs of worker params are decoded from JSON.
+    key = key.encode('utf-8')
+  return hashlib.sha1(key).hexdigest()
+
+
+def _get_memcache():
+  try:
+    from google.appengine.api import memcache
+  except ImportError:
+    return None
+  return memcache
+
+
+def get_expected_duration(key):
+  """Returns the average duration of previous runs in seconds, or None."""
+  memcache = _get_memcache()
+  if memcache is not None:
+    return memcache.get(_HISTORY_KEY_PREFIX + key)
+  with _LOCK:
+    return _LOCAL_HISTORY.get(key)
+
+
+def record_duration(key, duration):
+  """Folds the duration of a run into the moving average of its fingerprint."""
+  previous = get_expected_duration(key)
+  if previous is not None:
+    duration = HISTORY_WEIGHT * duration + (1 - HISTORY_WEIGHT) * previous
+  memcache = _get_memcache()
+  if memcache is not None:
+    memcache.set(_HISTORY_KEY_PREFIX + key, duration, time=HISTORY_TTL)
+  else:
+    with _LOCK:
+      _LOCAL_HISTORY[key] = duration
+
+
+def _statistics(job):
+  properties = getattr(job, '_properties', None)
+  if not isinstance(properties, dict):
+    return {}
+  return properties.get('statistics') or {}
+
+
+def duration(job):
+  """Returns the run time of a finished job in seconds, or None if unknown."""
+  statistics = _statistics(job)
+  try:
+    return (int(statistics['endTime']) - int(statistics['startTime'])) / 1000.0
+  except (KeyError, TypeError, ValueError):
+    return None
+
+
+def progress(job):
+  """Returns the completed fraction of a running job, or None if unknown.
+
+  Query jobs report the parallel inputs completed by every stage of their
+  plan; other job types don't report any progress.
+  """
+  plan = _statistics(job).get('query', {}).get('queryPlan') or []
+  total = 0
+  completed = 0
+  for stage in plan:
+    inputs = int(stage.get('parallelInputs') or 0)
+    if stage.get('status') == 'COMPLETE':
+      completed += inputs
+    else:
+      completed += int(stage.get('completedParallelInputs') or 0)
+    total += inputs
+  if not total:
+    return None
+  return float(completed) / total
+
+
+def estimate_remaining(job, elapsed, expected=None):
+  """Returns the number of seconds a job is likely to keep running.
+
+  Args:
+      job: BigQuery job reloaded with its latest statistics.
+      elapsed: number of seconds since the job began.
+      expected: average duration of the previous runs, if any.
+
+  Returns: Number of seconds, None if unknown. History is ignored once the
+      job runs longer than expected, so that an overrunning job falls back to
+      the doubling delays instead of being checked as often as possible.
+  """
+  if expected is not None and elapsed >= expected:
+    expected = None
+  fraction = progress(job)
+  if fraction:
+    remaining = elapsed * (1 - fraction) / fraction
+    if expected is not None:
+      # A plan reports stages with its first inputs, smooth it with history.
+      remaining = (remaining + expected - elapsed) / 2
+    return remaining
+  if expected is not None:
+    return expected - elapsed
+  return None
+
+
+def next_delay(elapsed, remaining):
+  """Returns the number of seconds to sleep before checking a job again.
+
+  Without an estimate delays double from the shortest one, so that tiny jobs
+  are seen done within a second and longer ones aren't checked too often.
+  """
+  if remaining is None:
+    delay = max(MIN_POLL_DELAY, elapsed)
+  else:
+    delay = remaining / 2
+  return min(MAX_POLL_DELAY, max(MIN_POLL_DELAY, delay))
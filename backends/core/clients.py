@@ -0,0 +1,290 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Clients module
+
+Registry of authorized API clients. Credentials and the requests session are
+built once per instance and shared by every task it serves, while clients
+relying on httplib2, which isn't thread-safe, are memoized per thread; access
+tokens are refreshed by the transport when they expire.
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+from google.cloud import bigquery
+from googleads import adwords
+from google.oauth2 import service_account
+from googleapiclient import discovery
+from googleapiclient.discovery_cache import base as discovery_cache_base
+from oauth2client.service_account import ServiceAccountCredentials
+import requests
+import yaml
+import zeep.cache
+
+
+BIGQUERY_SCOPES = (
+    'https://www.googleapis.com/auth/bigquery',
+    'https://www.googleapis.com/auth/cloud-platform',
+    'https://www.googleapis.com/auth/drive',
+)
+
+# Time to keep discovery documents in memory, 1 day by default.
+DISCOVERY_DOCUMENT_TTL = 24 * 60 * 60
+
+# Maximum number of connections kept open to each host by HTTP sessions.
+HTTP_POOL_SIZE = 32
+
+# Time to keep WSDL and XSD documents of SOAP APIs, 1 day by default.
+WSDL_DOCUMENT_TTL = 24 * 60 * 60
+
+_LOCK = threading.Lock()
+_CREDENTIALS = {}
+_DISCOVERY_CACHE = None
+_HTTP_SESSION = None
+_ADWORDS_CLIENTS = {}
+_WSDL_CACHE = None
+# BigQuery clients and service objects rely on httplib2 which isn't
+# thread-safe, hence they are memoized per thread.
+_LOCAL = threading.local()
+
+
+def get_credentials(scopes):
+  """Returns service account credentials shared for the given scopes."""
+  from core.app_data import SA_DATA
+  scopes = tuple(scopes)
+  with _LOCK:
+    try:
+      return _CREDENTIALS[scopes]
+    except KeyError:
+      credentials = service_account.Credentials.from_service_account_info(
+          SA_DATA, scopes=scopes)
+      _CREDENTIALS[scopes] = credentials
+      return credentials
+
+
+def get_bigquery_client(project=None, scopes=BIGQUERY_SCOPES):
+  """Returns a BigQuery client memoized by the current thread.
+
+  Args:
+      project: BigQuery project ID, defaults to the service account project.
+      scopes: OAuth scopes to authorize the client with.
+  """
+  from core.app_data import SA_DATA
+  project = project or SA_DATA['project_id']
+  try:
+    bigquery_clients = _LOCAL.bigquery_clients
+  except AttributeError:
+    bigquery_clients = _LOCAL.bigquery_clients = {}
+  key = (project, tuple(scopes))
+  try:
+    return bigquery_clients[key]
+  except KeyError:
+    client = bigquery.Client(project=project,
+                             credentials=get_credentials(scopes))
+    bigquery_clients[key] = client
+    return client
+
+
+def get_http_session():
+  """Returns a requests session shared by the threads of the instance.
+
+  Connections to a host are kept alive and reused across requests, up to
+  HTTP_POOL_SIZE connections per host.
+  """
+  global _HTTP_SESSION
+  with _LOCK:
+    if _HTTP_SESSION is None:
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                              pool_maxsize=HTTP_POOL_SIZE)
+      session.mount('https://', adapter)
+      session.mount('http://', adapter)
+      _HTTP_SESSION = session
+    return _HTTP_SESSION
+
+
+class DiscoveryCache(discovery_cache_base.Cache):
+  """Keeps discovery documents in memory on top of the default cache.
+
+  The default cache is App Engine memcache when available and a local file
+  otherwise.
+  """
+
+  def __init__(self, ttl=DISCOVERY_DOCUMENT_TTL):
+    self._ttl = ttl
+    self._documents = {}
+    from googleapiclient import discovery_cache
+    self._fallback = discovery_cache.autodetect()
+
+  def get(self, url):
+    try:
+      content, expires_at = self._documents[url]
+      if expires_at > time.time():
+        return content
+    except KeyError:
+      pass
+    content = self._fallback.get(url) if self._fallback else None
+    if content:
+      self._documents[url] = (content, time.time() + self._ttl)
+    return content
+
+  def set(self, url, content):
+    self._documents[url] = (content, time.time() + self._ttl)
+    if self._fallback:
+      self._fallback.set(url, content)
+
+
+def get_oauth2_credentials():
+  """Returns service account credentials for discovery-based API clients."""
+  from core.app_data import SA_DATA
+  with _LOCK:
+    try:
+      return _CREDENTIALS['oauth2client']
+    except KeyError:
+      credentials = ServiceAccountCredentials.from_json_keyfile_dict(SA_DATA)
+      _CREDENTIALS['oauth2client'] = credentials
+      return credentials
+
+
+def _get_discovery_cache():
+  global _DISCOVERY_CACHE
+  with _LOCK:
+    if _DISCOVERY_CACHE is None:
+      _DISCOVERY_CACHE = DiscoveryCache()
+    return _DISCOVERY_CACHE
+
+
+def build_service(api, version, credentials=None):
+  """Returns a service object memoized by (api, version, credentials).
+
+  Args:
+      api: name of the API, e.g. "analytics".
+      version: version of the API, e.g. "v3".
+      credentials: oauth2client credentials, defaults to the service account.
+  """
+  if credentials is None:
+    credentials = get_oauth2_credentials()
+  try:
+    services = _LOCAL.services
+  except AttributeError:
+    services = _LOCAL.services = {}
+  key = (api, version, credentials)
+  try:
+    return services[key]
+  except KeyError:
+    services[key] = discovery.build(api, version, credentials=credentials,
+                                    cache=_get_discovery_cache())
+    return services[key]
+
+
+class WSDLCache(zeep.cache.Base):
+  """Keeps WSDL and XSD documents in memory on top of App Engine memcache.
+
+  Documents are shared by the SOAP clients of the instance, and memcache
+  spares new instances their download.
+
+  NB: App Engine instances have no writable filesystem for a SqliteCache.
+  """
+
+  _KEY_PREFIX = 'wsdl:'
+
+  def __init__(self, ttl=WSDL_DOCUMENT_TTL):
+    self._ttl = ttl
+    self._lock = threading.Lock()
+    self._documents = {}
+
+  def _get_memcache(self):
+    try:
+      from google.appengine.api import memcache
+    except ImportError:
+      return None
+    return memcache
+
+  def _memcache_key(self, url):
+    return self._KEY_PREFIX + hashlib.sha1(url).hexdigest()
+
+  def add(self, url, content):
+    with self._lock:
+      self._documents[url] = (content, time.time() + self._ttl)
+    memcache = self._get_memcache()
+    if memcache is not None:
+      try:
+        memcache.set(self._memcache_key(url), content, time=self._ttl)
+      except ValueError:
+        # Documents over the memcache value size limit are kept in memory.
+        pass
+
+  def get(self, url):
+    with self._lock:
+      content, expires_at = self._documents.get(url, (None, 0))
+    if expires_at > time.time():
+      return content
+    memcache = self._get_memcache()
+    if memcache is None:
+      return None
+    content = memcache.get(self._memcache_key(url))
+    if content is not None:
+      with self._lock:
+        self._documents[url] = (content, time.time() + self._ttl)
+    return content
+
+
+def _get_wsdl_cache():
+  global _WSDL_CACHE
+  with _LOCK:
+    if _WSDL_CACHE is None:
+      _WSDL_CACHE = WSDLCache()
+    return _WSDL_CACHE
+
+
+def get_adwords_client(client_params):
+  """Returns an AdWords client shared for the given customer and credentials.
+
+  Args:
+      client_params: dictionary of the adwords section of a googleads
+          configuration, with client_customer_id and OAuth credentials.
+  """
+  key = hashlib.sha1(json.dumps(client_params, sort_keys=True)).hexdigest()
+  with _LOCK:
+    try:
+      return _ADWORDS_CLIENTS[key]
+    except KeyError:
+      pass
+  client_params_yaml = yaml.safe_dump({'adwords': client_params},
+                                      encoding='utf-8', allow_unicode=True)
+  client = adwords.AdWordsClient.LoadFromString(client_params_yaml)
+  client.cache = _get_wsdl_cache()
+  with _LOCK:
+    return _ADWORDS_CLIENTS.setdefault(key, client)
+
+
+def get_adwords_service(client, service_name, version):
+  """Returns an AdWords service of a client, memoized per thread.
+
+  Services are built once from their parsed WSDL, instead of on every task.
+  """
+  try:
+    services = _LOCAL.adwords_services
+  except AttributeError:
+    services = _LOCAL.adwords_services = {}
+  key = (id(client), service_name, version)
+  try:
+    return services[key]
+  except KeyError:
+    services[key] = client.GetService(service_name, version)
+    return services[key]
@@ -0,0 +1,147 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Concurrency module
+
+Helpers running blocking I/O (listings, API calls) on short-lived threads.
+Threads never outlive the request that started them, as App Engine requires,
+and the amount of buffered work is bounded to keep memory flat.
+"""
+
+import Queue
+import threading
+import time
+
+
+_DONE = object()
+
+# Seconds to block on a full or empty buffer before checking for a stop.
+_POLL_TIMEOUT = 1
+
+
+def _put(queue, item, stopped):
+  """Puts an item into a bounded queue unless the consumer has stopped."""
+  while not stopped.is_set():
+    try:
+      queue.put(item, timeout=_POLL_TIMEOUT)
+      return True
+    except Queue.Full:
+      pass
+  return False
+
+
+def stream(producers, max_workers, buffer_size=1000):
+  """Yields the items of several iterables produced concurrently.
+
+  Items are yielded in the order of the producers, each producer being
+  consumed entirely before the next one, while up to `max_workers` of them
+  fill their buffers ahead.
+
+  Args:
+      producers: list of callables returning iterables.
+      max_workers: maximum number of producers running at the same time.
+      buffer_size: maximum number of items buffered for each producer.
+  """
+  stopped = threading.Event()
+  queues = [Queue.Queue(buffer_size) for _ in producers]
+
+  def _produce(producer, queue):
+    try:
+      for item in producer():
+        if not _put(queue, (item, None), stopped):
+          return
+      _put(queue, (_DONE, None), stopped)
+    except Exception as e:  # pylint: disable=broad-except
+      _put(queue, (_DONE, e), stopped)
+
+  threads = []
+  for producer, queue in zip(producers, queues):
+    thread = threading.Thread(target=_produce, args=(producer, queue))
+    thread.daemon = True
+    threads.append(thread)
+  started = 0
+  try:
+    for i, queue in enumerate(queues):
+      while started < min(len(threads), i + max_workers):
+        threads[started].start()
+        started += 1
+      while True:
+        item, error = queue.get()
+        if error is not None:
+          raise error
+        if item is _DONE:
+          break
+        yield item
+  finally:
+    stopped.set()
+
+
+def run(func, items, max_workers):
+  """Calls a function on every item, on up to `max_workers` threads.
+
+  Items are pulled from the iterable as threads get free, so that producing
+  them overlaps with the calls.
+
+  Returns: List of (item, exception) tuples of the calls that failed.
+  """
+  pending = Queue.Queue(max_workers * 2)
+  errors = []
+
+  def _work():
+    while True:
+      item = pending.get()
+      if item is _DONE:
+        return
+      try:
+        func(item)
+      except Exception as e:  # pylint: disable=broad-except
+        errors.append((item, e))
+
+  threads = []
+  try:
+    for item in items:
+      if len(threads) < max_workers:
+        thread = threading.Thread(target=_work)
+        thread.start()
+        threads.append(thread)
+      pending.put(item)
+  finally:
+    for _ in threads:
+      pending.put(_DONE)
+    for thread in threads:
+      thread.join()
+  return errors
+
+
+class RateLimiter(object):
+  """Spaces calls made from several threads to a given rate."""
+
+  def __init__(self, rate):
+    """
+    Args:
+        rate: maximum number of calls per second.
+    """
+    self._interval = 1.0 / rate
+    self._lock = threading.Lock()
+    self._next_call_at = 0
+
+  def wait(self):
+    """Blocks until the next call is allowed."""
+    with self._lock:
+      now = time.time()
+      call_at = max(now, self._next_call_at)
+      self._next_call_at = call_at + self._interval
+    if call_at > now:
+      time.sleep(call_at - now)
@@ -14,13 +14,42 @@
 
 from datetime import datetime
 from datetime import timedelta
-import os
-from google.cloud import bigquery
+import ast
+import re
+import threading
+import time
 from google.cloud.exceptions import NotFound
+from simpleeval import SimpleEval
+
+from core import clients
+from core import concurrency
 
 
 _SESSION = None
 
+# Time during which rows read by the bigquery function are reused without
+# checking their table, in seconds. Past it, rows are read again only if
+# their table has been modified since.
+BIGQUERY_CACHE_TTL = 60
+
+# Time to keep rows read by the bigquery function in memcache, in seconds.
+BIGQUERY_MEMCACHE_TTL = 24 * 60 * 60
+
+# Number of tables read concurrently by prefetch.
+MAX_CONCURRENT_PREFETCHES = 8
+
+_BIGQUERY_CACHE = {}
+_BIGQUERY_MEMCACHE_PREFIX = 'inline_bigquery:'
+
+# Inline expressions, e.g. {% today("%Y%m%d") %}
+INLINER_REGEX = re.compile(r'{%.+?%}')
+
+# Maximum number of parsed values kept by the instance.
+MAX_COMPILED_VALUES = 10000
+
+_COMPILED_VALUES = {}
+_COMPILED_VALUES_LOCK = threading.Lock()
+
 
 def open_session():
   global _SESSION
@@ -50,40 +79,81 @@ def _days_since(date, format):
   return (datetime.today() - datetime.strptime(str(date), format)).days
 
 
-def _bigquery(table_name, field_name):
-  def _get_bq_client():
-    try:
-      return _SESSION['bq_client']
-    except KeyError:
-      key = os.path.join(os.path.dirname(__file__), '..', 'data',
-                         'service-account.json')
-      _SESSION['bq_client'] = bigquery.Client.from_service_account_json(key)
-      return _SESSION['bq_client']
-
-  def _fetch_bq_table_data(table_name):
-    client = _get_bq_client()
-    table_name_pieces = table_name.split('.')
-    if len(table_name_pieces) == 2:
-      dataset_id, table_id = table_name_pieces
-    elif len(table_name_pieces) == 3:
-      project_id, dataset_id, table_id = table_name_pieces
-      client.project = project_id
-    else:
-      raise ValueError('Malformed BigQuery table name: `%s`' % table_name)
-    dataset = client.dataset(dataset_id)
-    table = dataset.table(table_id)
-    try:
-      table.reload()
-    except NotFound:
-      raise ValueError('BigQuery table `%s` not found' % table_name)
-    field_names = [f.name for f in table.schema]
-    filed_values = list(table.fetch_data(max_results=1))[0]
-    _SESSION['bq_cache'][table_name] = dict(zip(field_names, filed_values))
+def _get_memcache():
+  try:
+    from google.appengine.api import memcache
+  except ImportError:
+    return None
+  return memcache
+
 
+def _get_cached_table(key):
+  try:
+    return _BIGQUERY_CACHE[key]
+  except KeyError:
+    pass
+  memcache = _get_memcache()
+  if memcache is None:
+    return None
+  return memcache.get(_BIGQUERY_MEMCACHE_PREFIX + key)
+
+
+def _set_cached_table(key, cached_table):
+  _BIGQUERY_CACHE[key] = cached_table
+  memcache = _get_memcache()
+  if memcache is not None:
+    memcache.set(_BIGQUERY_MEMCACHE_PREFIX + key, cached_table,
+                 time=BIGQUERY_MEMCACHE_TTL)
+
+
+def _fetch_bq_table_data(table_name):
+  """Returns the first row of a BigQuery table as a dictionary.
+
+  Rows are cached across runs by fully qualified table name, and read again
+  once BIGQUERY_CACHE_TTL has passed only if the table has been modified.
+  """
+  table_name_pieces = table_name.split('.')
+  if len(table_name_pieces) == 2:
+    project_id = None
+    dataset_id, table_id = table_name_pieces
+  elif len(table_name_pieces) == 3:
+    project_id, dataset_id, table_id = table_name_pieces
+  else:
+    raise ValueError('Malformed BigQuery table name: `%s`' % table_name)
+  client = clients.get_bigquery_client(project_id)
+  key = '%s.%s.%s' % (client.project, dataset_id, table_id)
+  cached_table = _get_cached_table(key)
+  if cached_table is not None and cached_table['expires_at'] > time.time():
+    return cached_table['row']
+  table = client.dataset(dataset_id).table(table_id)
+  try:
+    table.reload()
+  except NotFound:
+    raise ValueError('BigQuery table `%s` not found' % table_name)
+  if cached_table is None or cached_table['modified'] != table.modified:
+    field_names = [f.name for f in table.schema]
+    rows = list(table.fetch_data(max_results=1))
+    if not rows:
+      raise ValueError('BigQuery table `%s` is empty' % table_name)
+    cached_table = {'row': dict(zip(field_names, rows[0])),
+                    'modified': table.modified}
+  cached_table['expires_at'] = time.time() + BIGQUERY_CACHE_TTL
+  _set_cached_table(key, cached_table)
+  return cached_table['row']
+
+
+def _get_bq_table_data(table_name):
+  """Returns the first row of a table, the same one throughout a session."""
+  if _SESSION is None:
+    return _fetch_bq_table_data(table_name)
   if table_name not in _SESSION['bq_cache']:
-    _fetch_bq_table_data(table_name)
+    _SESSION['bq_cache'][table_name] = _fetch_bq_table_data(table_name)
+  return _SESSION['bq_cache'][table_name]
+
+
+def _bigquery(table_name, field_name):
   try:
-    value = _SESSION['bq_cache'][table_name][field_name]
+    value = _get_bq_table_data(table_name)[field_name]
   except KeyError:
     raise ValueError(
         "No field '%s' in BigQuery table `%s`" % (field_name, table_name))
@@ -100,3 +170,79 @@ functions = {
     'days_since': _days_since,
     'bigquery': _bigquery,
 }
+
+
+def compile_value(value):
+  """Returns the inliners of a value with their parsed expressions.
+
+  Values are parsed once per instance and memoized by their text.
+
+  Returns: Tuple of (inliner, expression, AST node) tuples.
+  """
+  try:
+    return _COMPILED_VALUES[value]
+  except KeyError:
+    pass
+  compiled = []
+  for inliner in INLINER_REGEX.findall(value):
+    expression = inliner[2:-2]
+    node = ast.parse(expression.strip()).body[0].value
+    compiled.append((inliner, expression, node))
+  compiled = tuple(compiled)
+  with _COMPILED_VALUES_LOCK:
+    if len(_COMPILED_VALUES) >= MAX_COMPILED_VALUES:
+      _COMPILED_VALUES.clear()
+    _COMPILED_VALUES[value] = compiled
+  return compiled
+
+
+class Evaluator(object):
+  """Renders values with inliners, sharing a context between values.
+
+  NB: the context is read when values are rendered, it must not be changed
+      while the evaluator is in use.
+  """
+
+  def __init__(self, context=None):
+    names = dict(context or {})
+    names.update({'True': True, 'False': False})
+    self._simple_eval = SimpleEval(functions=functions, names=names)
+
+  def render(self, value):
+    """Returns the value with its inliners replaced by their results."""
+    for inliner, expression, node in compile_value(value):
+      # The expression is only used to describe errors.
+      self._simple_eval.expr = expression
+      result = self._simple_eval._eval(node)  # pylint: disable=protected-access
+      value = value.replace(inliner, str(result))
+    return value
+
+
+def _referenced_tables(node):
+  """Yields names of the tables read by bigquery calls with literal names."""
+  for child in ast.walk(node):
+    if (isinstance(child, ast.Call) and isinstance(child.func, ast.Name)
+        and child.func.id == 'bigquery' and child.args
+        and isinstance(child.args[0], ast.Str)):
+      yield child.args[0].s
+
+
+def prefetch(values):
+  """Reads the tables referenced by values concurrently, ahead of rendering.
+
+  Each thread reads with its own BigQuery client, as clients aren't
+  thread-safe. Errors are ignored here, they are raised when the values are
+  rendered.
+  """
+  table_names = set()
+  for value in values:
+    try:
+      compiled = compile_value(value)
+    except (SyntaxError, TypeError):
+      continue
+    for _, _, node in compiled:
+      table_names.update(_referenced_tables(node))
+  if _SESSION is not None:
+    table_names.difference_update(_SESSION['bq_cache'])
+  concurrency.run(_get_bq_table_data, sorted(table_names),
+                  MAX_CONCURRENT_PREFETCHES)
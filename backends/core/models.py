@@ -13,12 +13,13 @@
 # limitations under the License.
 
 from datetime import datetime
+from datetime import timedelta
 import json
 import re
 import uuid
 from google.appengine.api import taskqueue
-from simpleeval import simple_eval
 from simpleeval import InvalidExpression
+from sqlalchemy import BigInteger
 from sqlalchemy import Column
 from sqlalchemy import Integer
 from sqlalchemy import String
@@ -26,7 +27,9 @@ from sqlalchemy import DateTime
 from sqlalchemy import Text
 from sqlalchemy import Boolean
 from sqlalchemy import ForeignKey
+from sqlalchemy import case
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm import load_only
 from core import inline
 from core.database import BaseModel
@@ -54,6 +57,9 @@ class Pipeline(BaseModel):
   jobs = relationship('Job', backref='pipeline',
                       lazy='dynamic')
   run_on_schedule = Column(Boolean, nullable=False, default=False)
+  # Number of jobs of the current run that haven't finished yet.
+  active_jobs_count = Column(Integer, nullable=False, default=0,
+                             server_default='0')
   schedules = relationship('Schedule', lazy='dynamic')
   params = relationship('Param', lazy='dynamic', order_by='asc(Param.name)')
 
@@ -123,18 +129,47 @@ class Pipeline(BaseModel):
         ids_for_removing.append(schedule.id)
     Schedule.destroy(*ids_for_removing)
 
-  def populate_params_runtime_values(self):
+  def populate_params_runtime_values(self, snapshot=None):
+    """Renders the values of the params of the pipeline jobs.
+
+    Global variables are rendered first, then pipeline variables with the
+    global ones and job params with both. BigQuery tables referenced by the
+    values are read concurrently beforehand, runtime values of job params are
+    written with a single update and the parameters of the workers are kept
+    in the snapshot.
+
+    Args:
+        snapshot: optional scheduler.RunSnapshot of the pipeline, loaded if
+            missing.
+    """
+    if snapshot is None:
+      from core import scheduler
+      snapshot = scheduler.RunSnapshot.load(self)
     inline.open_session()
+    param = None
     try:
+      job_params = [p for job in snapshot.jobs
+                    for p in snapshot.params_by_job[job.id]]
+      inline.prefetch([p.value for p in snapshot.global_params
+                       + snapshot.pipeline_params + job_params])
       global_context = {}
-      for param in Param.where(pipeline_id=None, job_id=None).all():
-        global_context[param.name] = param.populate_runtime_value()
+      evaluator = inline.Evaluator()
+      for param in snapshot.global_params:
+        global_context[param.name] = evaluator.render(param.value)
       pipeline_context = global_context.copy()
-      for param in self.params.all():
-        pipeline_context[param.name] = param.populate_runtime_value(global_context)
-      for job in self.jobs.all():
-        for param in job.params.all():
-          param.populate_runtime_value(pipeline_context)
+      evaluator = inline.Evaluator(global_context)
+      for param in snapshot.pipeline_params:
+        pipeline_context[param.name] = evaluator.render(param.value)
+      evaluator = inline.Evaluator(pipeline_context)
+      runtime_values = {}
+      worker_params = dict((job.id, {}) for job in snapshot.jobs)
+      for param in job_params:
+        value = evaluator.render(param.value)
+        runtime_values[param] = value
+        worker_params[param.job_id][param.name] = Param.parse_worker_value(
+            param.type, value)
+      Param.bulk_set_runtime_values(runtime_values)
+      snapshot.worker_params = worker_params
       inline.close_session()
       return True
     except (InvalidExpression, TypeError, ValueError, SyntaxError) as e:
@@ -142,7 +177,9 @@ class Pipeline(BaseModel):
       from core import cloud_logging
       job_id = 'N/A'
       worker_class = 'N/A'
-      if param.job_id is not None:
+      if param is None:
+        message = 'Invalid variables: %s' % e
+      elif param.job_id is not None:
         job_id = param.job_id
         worker_class = param.job.worker_class
         message = 'Invalid job parameter "%s": %s' % (param.label, e)
@@ -164,48 +201,58 @@ class Pipeline(BaseModel):
   def set_status(self, status):
     self.update(status=status, status_changed_at=datetime.now())
 
-  def get_ready(self):
-    if not self.populate_params_runtime_values():
+  def get_ready(self, snapshot=None):
+    """
+    Args:
+        snapshot: optional scheduler.RunSnapshot of the pipeline, loaded if
+            missing.
+    """
+    if snapshot is None:
+      from core import scheduler
+      snapshot = scheduler.RunSnapshot.load(self)
+    if not self.populate_params_runtime_values(snapshot):
       return False
-    for job in self.jobs.all():
-      if not job.get_ready():
-        return False
-    self.set_status(Pipeline.STATUS.RUNNING)
+    waiting_ids = Job.bulk_set_pipeline_status(
+        self.id, Job.STATUS.WAITING, Job.STATUS.INACTIVE_STATUSES)
+    if len(waiting_ids) < len(snapshot.job_ids):
+      return False
+    with self.session.begin(subtransactions=True):
+      Job.bulk_set_pending_predecessors(self.id, snapshot.graph.in_degree)
+      self.update(status=Pipeline.STATUS.RUNNING,
+                  status_changed_at=datetime.now(),
+                  active_jobs_count=len(snapshot.job_ids))
     return True
 
   def start(self):
     if self.status not in Pipeline.STATUS.INACTIVE_STATUSES:
       return False
 
-    jobs = self.jobs.all()
-    if len(jobs) < 1:
+    from core import scheduler
+    snapshot = scheduler.RunSnapshot.load(self)
+    if len(snapshot.jobs) < 1:
       return False
 
-    for job in jobs:
+    for job in snapshot.jobs:
       if job.status not in Job.STATUS.INACTIVE_STATUSES:
         return False
 
-    if not self.get_ready():
+    if not self.get_ready(snapshot):
       return False
 
-    for job in jobs:
-      job.start()
+    scheduler.start_pipeline(self, snapshot)
     return True
 
-  def _cancel_all_tasks(self):
-    for job in self.jobs:
-      job.cancel_tasks()
-
   def stop(self):
     if self.status != Pipeline.STATUS.RUNNING:
       return False
-    for job in self.jobs:
-      job.stop()
-    for job in self.jobs:
-      if job.status not in [Job.STATUS.FAILED, Job.STATUS.SUCCEEDED]:
-        job.set_status(Job.STATUS.STOPPING)
-    self._cancel_all_tasks()
-    return self.job_finished()
+    Job.bulk_set_pipeline_status(
+        self.id, Job.STATUS.STOPPING,
+        [Job.STATUS.IDLE, Job.STATUS.WAITING, Job.STATUS.RUNNING])
+    # Read after the transition, so that jobs finished concurrently are seen
+    # with their final status.
+    statuses = Job.statuses_in_pipeline(self.id)
+    Job.bulk_cancel_tasks(self.id, statuses.keys())
+    return self.job_finished(statuses)
 
   def start_single_job(self, job):
     if self.status not in Pipeline.STATUS.INACTIVE_STATUSES:
@@ -214,17 +261,45 @@ class Pipeline(BaseModel):
       return False
     if not job.get_ready():
       return False
-    self.set_status(Pipeline.STATUS.RUNNING)
+    self.update(status=Pipeline.STATUS.RUNNING,
+                status_changed_at=datetime.now(), active_jobs_count=1)
     job.start_as_single()
     return True
 
-  def job_finished(self):
-    for job in self.jobs:
-      if job.status == Job.STATUS.STOPPING:
-        job.set_status(Job.STATUS.FAILED)
-    for job in self.jobs:
-      if job.status not in Job.STATUS.INACTIVE_STATUSES:
-        return False
+  def decrement_active_jobs_count(self):
+    """Counts a finished job of the current run atomically.
+
+    Returns: Number of jobs of the run that are still active.
+    """
+    with self.session.begin(subtransactions=True):
+      query = self.session.query(Pipeline.active_jobs_count)
+      query = query.filter(Pipeline.id == self.id).with_for_update()
+      active_jobs_count = query.scalar() - 1
+      Pipeline.query.filter(Pipeline.id == self.id).update(
+          {'active_jobs_count': active_jobs_count}, synchronize_session=False)
+    return active_jobs_count
+
+  def job_finished(self, statuses=None):
+    """Finishes the pipeline if none of its jobs is active anymore.
+
+    Args:
+        statuses: optional dictionary mapping job ids to their current status,
+            loaded with a single query if missing.
+
+    Returns: True if the pipeline has finished. False otherwise.
+    """
+    if statuses is None:
+      statuses = Job.statuses_in_pipeline(self.id)
+    stopping_ids = [job_id for job_id, status in statuses.iteritems()
+                    if status == Job.STATUS.STOPPING]
+    failed_ids = Job.bulk_set_status(stopping_ids, Job.STATUS.FAILED,
+                                     [Job.STATUS.STOPPING])
+    for job_id in failed_ids:
+      statuses[job_id] = Job.STATUS.FAILED
+    active_jobs_count = len([s for s in statuses.itervalues()
+                             if s not in Job.STATUS.INACTIVE_STATUSES])
+    if active_jobs_count:
+      return False
     self._finish()
     return True
 
@@ -232,7 +307,7 @@ class Pipeline(BaseModel):
     jobs = Job.query.outerjoin((StartCondition,
                                 Job.id == StartCondition.preceding_job_id))
     jobs = jobs.filter(Job.pipeline_id == self.id)
-    jobs = jobs.filter(StartCondition.preceding_job_id == None)
+    jobs = jobs.filter(StartCondition.preceding_job_id.is_(None))
     jobs = jobs.options(load_only('status')).all()
     status = Pipeline.STATUS.SUCCEEDED
     for job in jobs:
@@ -289,6 +364,12 @@ class Job(BaseModel):
   status_changed_at = Column(DateTime)
   worker_class = Column(String(255))
   pipeline_id = Column(Integer, ForeignKey('pipelines.id'))
+  enqueued_tasks_count = Column(Integer, nullable=False, default=0,
+                                server_default='0')
+  # Number of start conditions of the job whose preceding job hasn't finished
+  # yet in the current run.
+  pending_predecessors_count = Column(Integer, nullable=False, default=0,
+                                      server_default='0')
   params = relationship('Param', backref='job', lazy='dynamic')
   start_conditions = relationship(
       'StartCondition',
@@ -327,6 +408,8 @@ class Job(BaseModel):
     param_ids = [p.id for p in self.params.all()]
     if param_ids:
       Param.destroy(*param_ids)
+    ExternalOperation.where(job_id=self.id).delete()
+    UploadCheckpoint.where(job_id=self.id).delete()
     self.delete()
 
   def get_ready(self):
@@ -335,44 +418,90 @@ class Job(BaseModel):
     self.set_status(Job.STATUS.WAITING)
     return True
 
+  @staticmethod
+  def _task_namespace(pipeline_id, job_id):
+    return 'pipeline=%s_job=%s' % (str(pipeline_id), str(job_id))
+
   def _get_task_namespace(self):
-    return 'pipeline=%s_job=%s' % (str(self.pipeline_id), str(self.id))
+    return self._task_namespace(self.pipeline_id, self.id)
 
   def _add_task_with_name(self, task_name):
     task_namespace = self._get_task_namespace()
-    TaskEnqueued.create(task_namespace=task_namespace, task_name=task_name)
+    with self.session.begin(subtransactions=True):
+      TaskEnqueued.create(task_namespace=task_namespace, task_name=task_name)
+      self._increment_enqueued_tasks_count(1)
     return True
 
   def _delete_task_with_name(self, task_name):
-    """
-    Returns: Number of remaining tasks in the DB.
+    """Deletes a task and decrements the counter of enqueued tasks atomically.
+
+    The job row is locked while the counter is updated, so that exactly one of
+    concurrently completing tasks observes that no task remains.
+
+    Returns: Number of remaining tasks in the DB, None if the task had already
+        been deleted.
     """
     task_namespace = self._get_task_namespace()
-    TaskEnqueued.where(task_namespace=task_namespace,
-                       task_name=task_name).delete()
-    return self._enqueued_task_count()
+    with self.session.begin(subtransactions=True):
+      remaining_tasks = self._locked_enqueued_tasks_count()
+      deleted_count = TaskEnqueued.where(task_namespace=task_namespace,
+                                         task_name=task_name).delete()
+      if not deleted_count:
+        return None
+      self._increment_enqueued_tasks_count(-deleted_count)
+    return remaining_tasks - deleted_count
 
   def cancel_tasks(self):
+    """Deletes the enqueued tasks and the tracked operations of the job."""
     task_namespace = self._get_task_namespace()
     enqueued_tasks = TaskEnqueued.where(task_namespace=task_namespace)
     if enqueued_tasks:
       tasks = [taskqueue.Task(name=t.task_name) for t in enqueued_tasks]
       taskqueue.Queue().delete_tasks(tasks)
-      TaskEnqueued.where(task_namespace=task_namespace).delete()
+      with self.session.begin(subtransactions=True):
+        TaskEnqueued.where(task_namespace=task_namespace).delete()
+        Job.query.filter(Job.id == self.id).update(
+            {'enqueued_tasks_count': 0}, synchronize_session=False)
+    # Operations of a cancelled run must not complete a later run.
+    ExternalOperation.where(job_id=self.id).delete()
 
-  def _enqueued_task_count(self):
-    task_namespace = self._get_task_namespace()
-    return TaskEnqueued.count_in_namespace(task_namespace)
+  @classmethod
+  def bulk_cancel_tasks(cls, pipeline_id, job_ids):
+    """Deletes the tasks and tracked operations of many jobs at once."""
+    if not job_ids:
+      return
+    ExternalOperation.query.filter(
+        ExternalOperation.job_id.in_(job_ids)).delete(
+            synchronize_session=False)
+    task_namespaces = [cls._task_namespace(pipeline_id, job_id)
+                       for job_id in job_ids]
+    enqueued_tasks = TaskEnqueued.query.filter(
+        TaskEnqueued.task_namespace.in_(task_namespaces)).all()
+    if enqueued_tasks:
+      tasks = [taskqueue.Task(name=t.task_name) for t in enqueued_tasks]
+      queue = taskqueue.Queue()
+      for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        queue.delete_tasks(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+      with cls.session.begin(subtransactions=True):
+        TaskEnqueued.query.filter(
+            TaskEnqueued.task_namespace.in_(task_namespaces)).delete(
+                synchronize_session=False)
+        cls.query.filter(cls.id.in_(job_ids)).update(
+            {'enqueued_tasks_count': 0}, synchronize_session=False)
+
+  def _increment_enqueued_tasks_count(self, delta):
+    Job.query.filter(Job.id == self.id).update(
+        {'enqueued_tasks_count': Job.enqueued_tasks_count + delta},
+        synchronize_session=False)
+
+  def _locked_enqueued_tasks_count(self):
+    query = self.session.query(Job.enqueued_tasks_count)
+    query = query.filter(Job.id == self.id).with_for_update()
+    return query.scalar()
 
-  def _start_condition_is_fulfilled(self, start_condition):
-    preceding_job_status = start_condition.preceding_job.status
-    if start_condition.condition == StartCondition.CONDITION.SUCCESS:
-      if preceding_job_status == Job.STATUS.FAILED:
-        return False
-    elif start_condition.condition == StartCondition.CONDITION.FAIL:
-      if preceding_job_status == Job.STATUS.SUCCEEDED:
-        return False
-    return True
+  def _enqueued_task_count(self):
+    query = self.session.query(Job.enqueued_tasks_count)
+    return query.filter(Job.id == self.id).scalar()
 
   def start_as_single(self):
     """
@@ -384,32 +513,14 @@ class Job(BaseModel):
       self.set_status(Job.STATUS.RUNNING)
       return self.run()
 
-  def start(self):
+  def run(self, worker_params=None):
     """
-    Returns: Task object that was added to the task queue, otherwise None.
+    Args:
+        worker_params: optional dictionary of the worker parameters, read from
+            the job params if missing.
     """
-    # Validates that preceding jobs fulfill the starting conditions.
-    for start_condition in self.start_conditions:
-      if self._start_condition_is_fulfilled(start_condition):
-        if start_condition.preceding_job.status not in [
-            Job.STATUS.SUCCEEDED,
-            Job.STATUS.FAILED]:
-          return None
-      else:
-        # pipeline failure
-        self.set_status(Job.STATUS.FAILED)
-        self.pipeline.update(status=Pipeline.STATUS.FAILED,
-                             status_changed_at=datetime.now())
-        self.pipeline.stop()
-        return None
-
-    if self.pipeline.status == Pipeline.STATUS.FAILED:
-      return None
-
-    return self.start_as_single()
-
-  def run(self):
-    worker_params = dict([(p.name, p.worker_value) for p in self.params])
+    if worker_params is None:
+      worker_params = dict([(p.name, p.worker_value) for p in self.params])
     return self.enqueue(self.worker_class, worker_params)
 
   def stop(self):
@@ -422,47 +533,158 @@ class Job(BaseModel):
       return True
     return False
 
+  def _get_unique_task_name(self):
+    task_name = '%s_%s' % (self.pipeline_id, self.id)
+    escaped_task_name = re.sub(r'[^-_0-9a-zA-Z]', '-', task_name)
+    return '%s_%s' % (escaped_task_name, str(uuid.uuid4()))
+
   def enqueue(self, worker_class, worker_params, delay=0):
     if self.status != Job.STATUS.RUNNING:
       return None
 
     # Add a new task to the queue.
-    task_name = '%s_%s' % (self.pipeline.id, self.id)
-    escaped_task_name = re.sub(r'[^-_0-9a-zA-Z]', '-', task_name)
-    unique_task_name = '%s_%s' % (escaped_task_name, str(uuid.uuid4()))
+    unique_task_name = self._get_unique_task_name()
     task_params = {
         'job_id': self.id,
         'worker_class': worker_class,
         'worker_params': json.dumps(worker_params),
         'task_name': unique_task_name
     }
-    task = taskqueue.add(
-        target='job-service',
-        name=unique_task_name,
-        url='/task',
-        params=task_params,
-        countdown=delay)
-
-    # Keep track of the running task name.
+    # Keep track of the running task name before the task can run, so that
+    # its completion always finds it.
     self._add_task_with_name(unique_task_name)
+    try:
+      task = taskqueue.add(
+          target='job-service',
+          name=unique_task_name,
+          url='/task',
+          params=task_params,
+          countdown=delay)
+    except Exception:
+      self._delete_task_with_name(unique_task_name)
+      raise
     self.save()
 
     return task
 
-  def _start_dependent_jobs(self):
-    if self.dependent_jobs:
-      for job in self.dependent_jobs:
-        job.start()
+  def track_operation(self, worker_class, kind, name, params=None, delay=0):
+    """Hands a long-running external operation over to the poller.
+
+    The operation holds a task of the job until the poller sees it completed.
+
+    Returns: ExternalOperation that was created, otherwise None.
+    """
+    if self.status != Job.STATUS.RUNNING:
+      return None
+    unique_task_name = self._get_unique_task_name()
+    with self.session.begin(subtransactions=True):
+      self._add_task_with_name(unique_task_name)
+      return ExternalOperation.create(
+          job_id=self.id,
+          task_name=unique_task_name,
+          worker_class=worker_class,
+          kind=kind,
+          name=name,
+          params=json.dumps(params or {}),
+          next_check_at=datetime.now() + timedelta(seconds=delay))
 
   def set_status(self, status):
     self.update(status=status, status_changed_at=datetime.now())
 
+  @classmethod
+  def _bulk_set_status(cls, criterion, status, from_statuses):
+    session = cls.session
+    with session.begin(subtransactions=True):
+      query = session.query(cls.id).filter(criterion,
+                                           cls.status.in_(from_statuses))
+      changed_ids = [row.id for row in query.with_for_update().all()]
+      if changed_ids:
+        session.query(cls).filter(
+            cls.id.in_(changed_ids),
+            cls.status.in_(from_statuses)).update(
+                {'status': status, 'status_changed_at': datetime.now()},
+                synchronize_session=False)
+    return changed_ids
+
+  @classmethod
+  def bulk_set_status(cls, job_ids, status, from_statuses):
+    """Moves the given jobs currently in one of `from_statuses` to `status`.
+
+    Rows are locked while being selected, so that concurrent callers can't
+    both move the same job, and the update is guarded by the same statuses.
+
+    Returns: List of ids of the jobs which status has been changed.
+    """
+    if not job_ids:
+      return []
+    return cls._bulk_set_status(cls.id.in_(job_ids), status, from_statuses)
+
+  @classmethod
+  def bulk_set_pipeline_status(cls, pipeline_id, status, from_statuses):
+    """Moves the pipeline jobs currently in one of `from_statuses` to `status`.
+
+    Returns: List of ids of the jobs which status has been changed.
+    """
+    return cls._bulk_set_status(cls.pipeline_id == pipeline_id, status,
+                                from_statuses)
+
+  @classmethod
+  def bulk_set_pending_predecessors(cls, pipeline_id, counts):
+    """Resets the counters of pending predecessors of the pipeline jobs.
+
+    Args:
+        pipeline_id: id of the pipeline.
+        counts: dictionary mapping job ids to their number of start
+            conditions, jobs missing from it have none.
+    """
+    counts = dict((job_id, count) for job_id, count in counts.iteritems()
+                  if count)
+    value = case(counts, value=cls.id, else_=0) if counts else 0
+    cls.query.filter(cls.pipeline_id == pipeline_id).update(
+        {'pending_predecessors_count': value}, synchronize_session=False)
+
+  @classmethod
+  def bulk_decrement_pending_predecessors(cls, decrements):
+    """Counts a finished preceding job for each of its successors atomically.
+
+    Args:
+        decrements: dictionary mapping ids of the successors to the number of
+            their start conditions on the finished job.
+
+    Returns: Dictionary mapping ids of the successors to their number of
+        pending predecessors left.
+    """
+    if not decrements:
+      return {}
+    session = cls.session
+    with session.begin(subtransactions=True):
+      query = session.query(cls.id, cls.pending_predecessors_count)
+      query = query.filter(cls.id.in_(decrements.keys())).with_for_update()
+      counts = dict((job_id, count - decrements[job_id])
+                    for job_id, count in query.all())
+      if counts:
+        session.query(cls).filter(cls.id.in_(counts.keys())).update(
+            {'pending_predecessors_count': case(counts, value=cls.id)},
+            synchronize_session=False)
+    return counts
+
+  @classmethod
+  def statuses_in_pipeline(cls, pipeline_id):
+    """
+    Returns: Dictionary mapping ids of the pipeline jobs to their status.
+    """
+    query = cls.session.query(cls.id, cls.status)
+    return dict(query.filter(cls.pipeline_id == pipeline_id).all())
+
   def _task_completed(self, task_name):
     """Completes task execution.
 
-    Returns: True if it was the last tasks to be completed. False otherwise.
+    Returns: True if it was the last tasks to be completed, False if other
+        tasks remain and None if the task had already been completed.
     """
     remaining_tasks = self._delete_task_with_name(task_name)
+    if remaining_tasks is None:
+      return None
     return remaining_tasks == 0
 
   def task_succeeded(self, task_name):
@@ -471,47 +693,38 @@ class Job(BaseModel):
     # NB: `was_last_task` acts as a concurrent lock, only one task can
     #     validate this condition.
     if was_last_task:
-      # Cancel all tasks if one condition doesn't match the success status.
-      for job in self.dependent_jobs:
-        for start_condition in job.start_conditions:
-          success_statuses = [
-              StartCondition.CONDITION.SUCCESS,
-              StartCondition.CONDITION.WHATEVER
-          ]
-          if (start_condition.preceding_job.id == self.id
-              and start_condition.condition not in success_statuses):
-            self.set_status(Job.STATUS.SUCCEEDED)
-            return self.pipeline.stop()
+      from core import scheduler
+      graph = scheduler.DependencyGraph.load(self.pipeline_id)
       self.set_status(Job.STATUS.SUCCEEDED)
+      # Cancel all tasks if one condition doesn't match the success status.
+      if not graph.successor_conditions_fulfilled(self.id,
+                                                  Job.STATUS.SUCCEEDED):
+        return self.pipeline.stop()
       # We can safely start children jobs, because of our concurrent lock.
-      self._start_dependent_jobs()
-      self.pipeline.job_finished()
+      scheduler.job_finished(self, graph)
 
   def task_failed(self, task_name):
     was_last_task = self._task_completed(task_name)
+    if was_last_task is None:
+      # Retried or stale completion of a task that has already completed.
+      return None
+    from core import scheduler
+    graph = scheduler.DependencyGraph.load(self.pipeline_id)
 
     # If no dependent jobs then the pipeline failed
-    if not self.dependent_jobs:
+    if not graph.successors[self.id]:
       self.set_status(Job.STATUS.FAILED)
       return self.pipeline.stop()
 
     # Cancel all tasks if one condition doesn't match the failed status.
-    for job in self.dependent_jobs:
-      for start_condition in job.start_conditions:
-        failed_statuses = [
-            StartCondition.CONDITION.FAIL,
-            StartCondition.CONDITION.WHATEVER
-        ]
-        if (start_condition.preceding_job.id == self.id
-            and start_condition.condition not in failed_statuses):
-          self.set_status(Job.STATUS.FAILED)
-          return self.pipeline.stop()
+    if not graph.successor_conditions_fulfilled(self.id, Job.STATUS.FAILED):
+      self.set_status(Job.STATUS.FAILED)
+      return self.pipeline.stop()
 
     if was_last_task:
       self.set_status(Job.STATUS.FAILED)
       # We can safely start children jobs, because of our concurrent lock.
-      self._start_dependent_jobs()
-      self.pipeline.job_finished()
+      scheduler.job_finished(self, graph)
 
   def assign_attributes(self, attributes):
     for key, value in attributes.iteritems():
@@ -589,33 +802,42 @@ class Param(BaseModel):
   value = Column(Text())
   runtime_value = Column(Text())
 
-  _INLINER_REGEX = re.compile(r'{%.+?%}')
-
-  def populate_runtime_value(self, context={}):
-    names = context.copy()
-    names.update({'True': True, 'False': False})
-    value = self.value
-    inliners = self._INLINER_REGEX.findall(value)
-    for inliner in inliners:
-      result = simple_eval(inliner[2:-2], functions=inline.functions,
-                           names=names)
-      value = value.replace(inliner, str(result))
-    if self.job_id is not None:
-      self.update(runtime_value=value)
-    return value
+  @classmethod
+  def bulk_set_runtime_values(cls, runtime_values):
+    """Writes runtime values of params with a single update.
+
+    Args:
+        runtime_values: dictionary mapping params to their runtime value.
+    """
+    if not runtime_values:
+      return
+    values_by_id = dict((param.id, value)
+                        for param, value in runtime_values.iteritems())
+    session = cls.session
+    with session.begin(subtransactions=True):
+      session.query(cls).filter(cls.id.in_(values_by_id.keys())).update(
+          {'runtime_value': case(values_by_id, value=cls.id)},
+          synchronize_session=False)
+    for param, value in runtime_values.iteritems():
+      set_committed_value(param, 'runtime_value', value)
+
+  @staticmethod
+  def parse_worker_value(param_type, runtime_value):
+    """Returns the value passed to workers for a runtime value of a type."""
+    if param_type == 'boolean':
+      return runtime_value == '1'
+    if param_type == 'number':
+      return _parse_num(runtime_value)
+    if param_type == 'string_list':
+      return runtime_value.split('\n')
+    if param_type == 'number_list':
+      return [_parse_num(l) for l in runtime_value.split('\n')
+              if l.strip()]
+    return runtime_value
 
   @property
   def worker_value(self):
-    if self.type == 'boolean':
-      return self.runtime_value == '1'
-    if self.type == 'number':
-      return _parse_num(self.runtime_value)
-    if self.type == 'string_list':
-      return self.runtime_value.split('\n')
-    if self.type == 'number_list':
-      return [_parse_num(l) for l in self.runtime_value.split('\n')
-              if l.strip()]
-    return self.runtime_value
+    return self.parse_worker_value(self.type, self.runtime_value)
 
   @property
   def api_value(self):
@@ -732,7 +954,91 @@ class TaskEnqueued(BaseModel):
   task_namespace = Column(String(60), index=True)
   task_name = Column(String(100), index=True, unique=True)
 
+
+class ExternalOperation(BaseModel):
+  """Long-running operation of an external service checked by the poller."""
+  __tablename__ = 'external_operations'
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  job_id = Column(Integer, ForeignKey('jobs.id'), index=True)
+  task_name = Column(String(100))
+  worker_class = Column(String(255))
+  kind = Column(String(50), nullable=False)
+  name = Column(String(255), nullable=False)
+  params = Column(Text())
+  checks_count = Column(Integer, nullable=False, default=0)
+  next_check_at = Column(DateTime, index=True)
+
+  job = relationship('Job', foreign_keys=[job_id])
+
+  class KIND(object):
+    BIGQUERY_JOB = 'bigquery_job'
+    ML_JOB = 'ml_job'
+    ML_OPERATION = 'ml_operation'
+    AUTOML_OPERATION = 'automl_operation'
+
+  @property
+  def parsed_params(self):
+    return json.loads(self.params or '{}')
+
+
+class AudienceFingerprint(BaseModel):
+  """Fingerprint of the last definition of a GA audience pushed by a worker."""
+  __tablename__ = 'audience_fingerprints'
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  property_id = Column(String(50), nullable=False, index=True)
+  name = Column(String(255), nullable=False)
+  audience_id = Column(String(50))
+  fingerprint = Column(String(40), nullable=False)
+
+  @classmethod
+  def load(cls, property_id):
+    """
+    Returns: Dictionary mapping names of the audiences of a property to
+        tuples of their id and fingerprint.
+    """
+    query = cls.session.query(cls.name, cls.audience_id, cls.fingerprint)
+    query = query.filter(cls.property_id == property_id)
+    return dict((name, (audience_id, fingerprint))
+                for name, audience_id, fingerprint in query.all())
+
   @classmethod
-  def count_in_namespace(cls, task_namespace):
-    count_query = cls.where(task_namespace=task_namespace)
-    return count_query.count()
+  def store(cls, property_id, fingerprints):
+    """Replaces the fingerprints of audiences of a property.
+
+    Args:
+        property_id: GA property tracking ID.
+        fingerprints: dictionary mapping names of audiences to tuples of
+            their id and fingerprint.
+    """
+    if not fingerprints:
+      return
+    session = cls.session
+    with session.begin(subtransactions=True):
+      cls.forget(property_id, fingerprints.keys())
+      session.add_all([
+          cls(property_id=property_id, name=name, audience_id=audience_id,
+              fingerprint=fingerprint)
+          for name, (audience_id, fingerprint) in fingerprints.iteritems()])
+
+  @classmethod
+  def forget(cls, property_id, names):
+    """Deletes fingerprints, so that the audiences are compared again."""
+    if not names:
+      return
+    session = cls.session
+    with session.begin(subtransactions=True):
+      session.query(cls).filter(cls.property_id == property_id,
+                                cls.name.in_(list(names))).delete(
+                                    synchronize_session=False)
+
+
+class UploadCheckpoint(BaseModel):
+  """Progress of a resumable upload, for a retried task to resume it."""
+  __tablename__ = 'upload_checkpoints'
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  job_id = Column(Integer, ForeignKey('jobs.id'), index=True)
+  source_uri = Column(Text(), nullable=False)
+  source_etag = Column(String(255))
+  session_uri = Column(Text(), nullable=False)
+  offset = Column(BigInteger, nullable=False, default=0)
+  chunk_size = Column(Integer, nullable=False)
@@ -0,0 +1,289 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Poller module
+
+Checks the long-running operations of external services (BigQuery jobs, ML
+Engine jobs and operations, AutoML operations) that workers hand over to it.
+Due operations are checked in batches on each tick, each kind with its own
+backoff, and the task of the owning job completes with the operation.
+"""
+
+from datetime import datetime
+from datetime import timedelta
+
+import traceback
+
+from apiclient.errors import HttpError
+import cloudstorage as gcs
+from google.cloud import bigquery
+from google.cloud.exceptions import ClientError
+
+from core import bq_estimates
+from core import clients
+from core.models import ExternalOperation
+from core.models import Job
+
+
+KIND = ExternalOperation.KIND
+
+# Delay before the first check, multiplier and longest delay between checks,
+# in seconds, for each kind of operation.
+BACKOFF = {
+    KIND.BIGQUERY_JOB: (10, 1.5, 300),
+    KIND.ML_JOB: (60, 1.5, 900),
+    KIND.ML_OPERATION: (30, 1.5, 600),
+    KIND.AUTOML_OPERATION: (60, 1.5, 1800),
+}
+
+# Number of checks after which an operation still running fails, for each
+# kind of operation, i.e. about a day for BigQuery jobs and ML Engine
+# operations and about ten days for ML Engine jobs and AutoML operations.
+MAX_CHECKS = {
+    KIND.BIGQUERY_JOB: 300,
+    KIND.ML_JOB: 1000,
+    KIND.ML_OPERATION: 150,
+    KIND.AUTOML_OPERATION: 500,
+}
+
+# Maximum number of operations checked on a single tick.
+MAX_OPERATIONS_PER_TICK = 500
+
+# Time an operation is reserved for a tick, so that overlapping ticks don't
+# check it twice.
+LEASE_SECONDS = 5 * 60
+
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+def next_delay(kind, checks_count):
+  """Returns the number of seconds to wait before checking again."""
+  initial_delay, factor, max_delay = BACKOFF[kind]
+  return min(max_delay, initial_delay * factor ** checks_count)
+
+
+def _check_bigquery_job(operation):
+  project_id = operation.parsed_params.get('bq_project_id', '').strip()
+  client = clients.get_bigquery_client(project_id)
+  # pylint: disable=protected-access
+  job = bigquery.job._AsyncJob(operation.name, client)
+  # pylint: enable=protected-access
+  job.reload()
+  if job.error_result is not None:
+    return (FAILED, job.error_result['message'])
+  if job.state == 'DONE':
+    key = operation.parsed_params.get('fingerprint')
+    duration = bq_estimates.duration(job)
+    if key and duration is not None:
+      bq_estimates.record_duration(key, duration)
+    return (SUCCEEDED, None)
+  return (RUNNING, None)
+
+
+def _check_bigquery_jobs(operations):
+  results = {}
+  for operation in operations:
+    try:
+      results[operation.id] = _check_bigquery_job(operation)
+    except ClientError as e:
+      results[operation.id] = (FAILED, str(e))
+    except Exception as e:  # pylint: disable=broad-except
+      # Transient error, the operation is checked again on a later tick.
+      results[operation.id] = (RUNNING, str(e))
+  return results
+
+
+def _check_in_batch(operations, service, build_request, parse_response):
+  """Checks operations of a discovery-based API with one batch HTTP request."""
+  results = {}
+
+  def _callback(request_id, response, exception):
+    operation_id = int(request_id)
+    if exception is None:
+      results[operation_id] = parse_response(response)
+    elif (isinstance(exception, HttpError)
+          and 399 < exception.resp.status < 500):
+      results[operation_id] = (FAILED, str(exception))
+    else:
+      # Transient error, the operation is checked again on a later tick.
+      results[operation_id] = (RUNNING, str(exception))
+
+  batch = service.new_batch_http_request(callback=_callback)
+  for operation in operations:
+    batch.add(build_request(service, operation),
+              request_id=str(operation.id))
+  batch.execute()
+  return results
+
+
+def _parse_ml_job(job):
+  final_statuses = ('STATE_UNSPECIFIED', 'SUCCEEDED', 'FAILED', 'CANCELLED')
+  if job.get('state') in final_statuses:
+    return (SUCCEEDED, None)
+  return (RUNNING, None)
+
+
+def _parse_ml_operation(operation):
+  if operation.get('done'):
+    return (SUCCEEDED, None)
+  return (RUNNING, None)
+
+
+def _parse_automl_operation(operation):
+  if operation.get('done'):
+    if operation.get('error'):
+      return (FAILED, 'AutoML operation failed: %s' % operation)
+    return (SUCCEEDED, None)
+  return (RUNNING, None)
+
+
+def _check_ml_jobs(operations):
+  return _check_in_batch(
+      operations, clients.build_service('ml', 'v1'),
+      lambda s, o: s.projects().jobs().get(name=o.name),
+      _parse_ml_job)
+
+
+def _check_ml_operations(operations):
+  return _check_in_batch(
+      operations, clients.build_service('ml', 'v1'),
+      lambda s, o: s.projects().operations().get(name=o.name),
+      _parse_ml_operation)
+
+
+def _check_automl_operations(operations):
+  return _check_in_batch(
+      operations, clients.build_service('automl', 'v1beta1'),
+      lambda s, o: s.projects().locations().operations().get(name=o.name),
+      _parse_automl_operation)
+
+
+CHECKERS = {
+    KIND.BIGQUERY_JOB: _check_bigquery_jobs,
+    KIND.ML_JOB: _check_ml_jobs,
+    KIND.ML_OPERATION: _check_ml_operations,
+    KIND.AUTOML_OPERATION: _check_automl_operations,
+}
+
+
+def _claim_due_operations(now):
+  """Reserves due operations for this tick and returns them."""
+  session = ExternalOperation.session
+  with session.begin(subtransactions=True):
+    query = ExternalOperation.query.filter(
+        ExternalOperation.next_check_at <= now)
+    query = query.order_by(ExternalOperation.next_check_at)
+    operations = query.limit(MAX_OPERATIONS_PER_TICK).with_for_update().all()
+    for operation in operations:
+      operation.next_check_at = now + timedelta(seconds=LEASE_SECONDS)
+  return operations
+
+
+def _log(operation, job, level, message):
+  from core import cloud_logging
+  cloud_logging.logger.log_struct({
+      'labels': {
+          'pipeline_id': job.pipeline_id,
+          'job_id': job.id,
+          'worker_class': operation.worker_class,
+      },
+      'log_level': level,
+      'message': message,
+  })
+
+
+def _check(kind, operations, jobs):
+  try:
+    return CHECKERS[kind](operations)
+  except Exception:  # pylint: disable=broad-except
+    # The whole group is checked again on a later tick.
+    message = 'Unexpected error while checking: %s' % traceback.format_exc()
+    for operation in operations:
+      _log(operation, jobs[operation.job_id], 'WARNING', message)
+    return {}
+
+
+def _delete_staging_files(operation, job):
+  """Deletes the Cloud Storage files read by a completed operation."""
+  for path in operation.parsed_params.get('staging_paths', []):
+    try:
+      gcs.delete(path)
+    except gcs.NotFoundError:
+      pass
+    except Exception as e:  # pylint: disable=broad-except
+      _log(operation, job, 'WARNING',
+           'Failed to delete gs:/%s: %s' % (path, e))
+
+
+def _discard(operation, job):
+  """Drops an operation which job has been stopped while it was running."""
+  operation.delete()
+  if job is not None and job.status == Job.STATUS.STOPPING:
+    job.task_failed(operation.task_name)
+
+
+def _update(operation, job, status, message, now):
+  """Schedules the next check of an operation or completes its task."""
+  kind = operation.kind
+  if status == RUNNING and message:
+    _log(operation, job, 'WARNING', 'Check failed: %s' % message)
+  if (status == RUNNING
+      and operation.checks_count + 1 >= MAX_CHECKS[kind]):
+    status = FAILED
+    message = 'Operation %s is still running after %i checks' % (
+        operation.name, operation.checks_count + 1)
+  if job.status != Job.STATUS.RUNNING:
+    _discard(operation, job)
+  elif status == RUNNING:
+    delay = next_delay(kind, operation.checks_count)
+    operation.update(
+        checks_count=operation.checks_count + 1,
+        next_check_at=now + timedelta(seconds=delay))
+  elif status == SUCCEEDED:
+    _delete_staging_files(operation, job)
+    operation.delete()
+    job.task_succeeded(operation.task_name)
+  else:
+    _log(operation, job, 'ERROR', 'Execution failed: %s' % message)
+    operation.delete()
+    job.task_failed(operation.task_name)
+
+
+def poll(now=None):
+  """Checks due operations and completes the tasks of the finished ones.
+
+  Returns: Number of operations checked.
+  """
+  now = now or datetime.now()
+  operations = _claim_due_operations(now)
+  if not operations:
+    return 0
+  job_ids = set([o.job_id for o in operations])
+  jobs = dict([(j.id, j) for j in Job.query.filter(Job.id.in_(job_ids))])
+  operations_by_kind = {}
+  for operation in operations:
+    job = jobs.get(operation.job_id)
+    if job is None or job.status != Job.STATUS.RUNNING:
+      _discard(operation, job)
+      continue
+    operations_by_kind.setdefault(operation.kind, []).append(operation)
+  for kind, kind_operations in operations_by_kind.iteritems():
+    results = _check(kind, kind_operations, jobs)
+    for operation in kind_operations:
+      status, message = results.get(operation.id, (RUNNING, None))
+      _update(operation, jobs[operation.job_id], status, message, now)
+  return len(operations)
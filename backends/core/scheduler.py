@@ -0,0 +1,224 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Scheduler module
+
+Releases pipeline jobs as soon as their start conditions are fulfilled. The
+dependency graph of a pipeline is loaded with a single query, so that a
+finished job only inspects its direct successors instead of walking the start
+conditions of every job one row at a time. Each job counts its pending
+preceding jobs and each pipeline its active jobs, so that neither the release
+of a successor nor the completion of a pipeline requires reading the status of
+every job of the pipeline. A pipeline starts from a snapshot
+of its jobs, params and start conditions, loaded with a fixed number of
+queries whatever the size of the pipeline.
+"""
+
+from collections import defaultdict
+
+from sqlalchemy import and_
+from sqlalchemy import or_
+
+from core.models import Job
+from core.models import Param
+from core.models import Pipeline
+from core.models import StartCondition
+
+
+def condition_is_fulfilled(condition, preceding_job_status):
+  """Returns False if the preceding job status breaks the start condition."""
+  if condition == StartCondition.CONDITION.SUCCESS:
+    return preceding_job_status != Job.STATUS.FAILED
+  if condition == StartCondition.CONDITION.FAIL:
+    return preceding_job_status != Job.STATUS.SUCCEEDED
+  return True
+
+
+class DependencyGraph(object):
+  """Adjacency list and in-degree counters of a pipeline, keyed by job id."""
+
+  def __init__(self, start_conditions):
+    """
+    Args:
+        start_conditions: iterable of (job_id, preceding_job_id, condition).
+    """
+    self.successors = defaultdict(list)
+    self.in_degree = defaultdict(int)
+    for job_id, preceding_job_id, condition in start_conditions:
+      if preceding_job_id is None:
+        continue
+      self.successors[preceding_job_id].append((job_id, condition))
+      self.in_degree[job_id] += 1
+
+  @classmethod
+  def load(cls, pipeline_id):
+    query = StartCondition.session.query(
+        StartCondition.job_id,
+        StartCondition.preceding_job_id,
+        StartCondition.condition)
+    query = query.join(Job, Job.id == StartCondition.job_id)
+    query = query.filter(Job.pipeline_id == pipeline_id)
+    return cls(query.all())
+
+  def roots(self, job_ids):
+    """Returns ids of the jobs without any start condition."""
+    return [job_id for job_id in job_ids if not self.in_degree[job_id]]
+
+  def successor_conditions_fulfilled(self, job_id, status):
+    """Checks whether finishing with `status` satisfies every successor."""
+    return all(condition_is_fulfilled(condition, status)
+               for _, condition in self.successors[job_id])
+
+  def successor_decrements(self, job_id):
+    """Counts the start conditions of each successor on a job.
+
+    Returns: Dictionary mapping ids of the successors to their number of start
+        conditions on the job.
+    """
+    decrements = defaultdict(int)
+    for successor_id, _ in self.successors[job_id]:
+      decrements[successor_id] += 1
+    return dict(decrements)
+
+  def ready_successors(self, job_id, status, pending_counts):
+    """Splits the successors of a finished job by readiness.
+
+    Conditions on preceding jobs that finished earlier have been checked when
+    they finished, so only the conditions on this job are checked.
+
+    Args:
+        job_id: id of the job that just finished.
+        status: final status of the job.
+        pending_counts: dictionary mapping ids of the successors to their
+            number of preceding jobs that haven't finished yet.
+
+    Returns:
+        Tuple of two lists: ids of successors whose preceding jobs have all
+        finished and fulfilled their conditions, and ids of successors with a
+        condition that can no longer be fulfilled.
+    """
+    blocked = []
+    for successor_id, condition in self.successors[job_id]:
+      if (not condition_is_fulfilled(condition, status)
+          and successor_id not in blocked):
+        blocked.append(successor_id)
+    ready = [successor_id for successor_id in sorted(pending_counts)
+             if pending_counts[successor_id] <= 0
+             and successor_id not in blocked]
+    return ready, blocked
+
+
+class RunSnapshot(object):
+  """Jobs, params and dependency graph of a pipeline, loaded at once.
+
+  Attributes:
+      jobs: list of the pipeline jobs.
+      job_ids: list of the ids of the pipeline jobs, still readable once the
+          jobs have been expired by a commit.
+      global_params: list of the global variables.
+      pipeline_params: list of the pipeline variables, sorted by name.
+      params_by_job: dictionary mapping job ids to lists of their params.
+      graph: DependencyGraph of the pipeline.
+      worker_params: dictionary mapping job ids to the parameters of their
+          worker, set once the runtime values of params are populated.
+  """
+
+  def __init__(self, jobs, params, graph):
+    self.jobs = jobs
+    self.job_ids = [job.id for job in jobs]
+    self.global_params = []
+    self.pipeline_params = []
+    self.params_by_job = dict((job.id, []) for job in jobs)
+    for param in params:
+      if param.job_id is not None:
+        self.params_by_job[param.job_id].append(param)
+      elif param.pipeline_id is not None:
+        self.pipeline_params.append(param)
+      else:
+        self.global_params.append(param)
+    self.graph = graph
+    self.worker_params = None
+
+  @classmethod
+  def load(cls, pipeline):
+    """Loads the snapshot of a pipeline with three queries."""
+    jobs = Job.query.filter(Job.pipeline_id == pipeline.id).all()
+    job_ids = [job.id for job in jobs]
+    conditions = [Param.pipeline_id == pipeline.id,
+                  and_(Param.pipeline_id.is_(None), Param.job_id.is_(None))]
+    if job_ids:
+      conditions.append(Param.job_id.in_(job_ids))
+    params = Param.query.filter(or_(*conditions)).order_by(Param.name).all()
+    return cls(jobs, params, DependencyGraph.load(pipeline.id))
+
+
+def _release(job_ids, worker_params=None):
+  """Moves waiting jobs to running in one update and enqueues their tasks.
+
+  Args:
+      job_ids: ids of the jobs to start.
+      worker_params: optional dictionary mapping job ids to the parameters of
+          their worker, read from the job params if missing.
+
+  Returns: List of ids of the jobs that have been started.
+  """
+  started_ids = Job.bulk_set_status(job_ids, Job.STATUS.RUNNING,
+                                    [Job.STATUS.WAITING])
+  if started_ids:
+    for job in Job.query.filter(Job.id.in_(started_ids)).all():
+      if worker_params is None:
+        job.run()
+      else:
+        job.run(worker_params[job.id])
+  return started_ids
+
+
+def start_pipeline(pipeline, snapshot):
+  """Starts every job of a ready pipeline without start conditions.
+
+  Args:
+      pipeline: Pipeline instance which jobs are ready.
+      snapshot: RunSnapshot of the pipeline, with the worker parameters.
+  """
+  return _release(snapshot.graph.roots(snapshot.job_ids),
+                  snapshot.worker_params)
+
+
+def job_finished(job, graph=None):
+  """Starts the successors released by a finished job.
+
+  Args:
+      job: Job instance which status has just been set to a final one.
+      graph: optional DependencyGraph of the job's pipeline, loaded if missing.
+
+  Returns: True if it was the last job to finish in the pipeline.
+  """
+  if graph is None:
+    graph = DependencyGraph.load(job.pipeline_id)
+  pipeline = job.pipeline
+  pending_counts = Job.bulk_decrement_pending_predecessors(
+      graph.successor_decrements(job.id))
+  ready, blocked = graph.ready_successors(job.id, job.status, pending_counts)
+  if blocked:
+    # Pipeline failure, stopped while running so that the jobs still running
+    # are stopped too.
+    Job.bulk_set_status(blocked, Job.STATUS.FAILED, [Job.STATUS.WAITING])
+    return pipeline.stop()
+  if pipeline.status != Pipeline.STATUS.FAILED:
+    _release(ready)
+  if pipeline.decrement_active_jobs_count() > 0:
+    return False
+  # Confirms with the statuses of the jobs once the counter runs out.
+  return pipeline.job_finished()
@@ -16,31 +16,35 @@
 
 from datetime import datetime
 from datetime import timedelta
-from fnmatch import fnmatch
+from fnmatch import translate
+from functools import partial
 from functools import wraps
+import hashlib
+from itertools import chain
 import json
+import logging
+from operator import itemgetter
 import os
 from random import random
+import re
+import threading
 import time
 import urllib
 from urllib2 import HTTPError
 import uuid
-import yaml
 
-from apiclient.discovery import build
 from apiclient.errors import HttpError
 from apiclient.http import MediaIoBaseUpload
 import cloudstorage as gcs
 from google.cloud import bigquery
 from google.cloud.exceptions import ClientError
-from googleads import adwords
-from oauth2client.service_account import ServiceAccountCredentials
 import requests
-import zeep.cache
+
+from core import bq_estimates
+from core import clients
+from core import concurrency
 
 
-_KEY_FILE = os.path.join(os.path.dirname(__file__), '..', 'data',
-                         'service-account.json')
 AVAILABLE = (
     'AutoMLPredictor',
     'BQMLTrainer',
@@ -86,9 +90,19 @@ class Worker(object):
   # Maximum number of worker execution attempts.
   MAX_ATTEMPTS = 1
 
-  def __init__(self, params, pipeline_id, job_id):
+  # Number of log entries written together, and longest time to keep them
+  # buffered in seconds.
+  LOG_BUFFER_SIZE = 100
+  LOG_FLUSH_INTERVAL = 10
+
+  # Maximum number of log entries kept while Cloud Logging is unavailable.
+  MAX_LOG_BUFFER_SIZE = 1000
+
+  def __init__(self, params, pipeline_id, job_id, task_name=None):
     self._pipeline_id = pipeline_id
     self._job_id = job_id
+    # Name of the task executing the worker, kept by its retries.
+    self._task_name = task_name
     self._params = params
     for p in self.PARAMS:
       try:
@@ -96,10 +110,18 @@ class Worker(object):
       except KeyError:
         self._params[p[0]] = p[3]
     self._workers_to_enqueue = []
+    self._operations_to_track = []
+    self._log_lock = threading.Lock()
+    self._log_entries = []
+    self._log_flushed_at = time.time()
 
   def _log(self, level, message, *substs):
-    from core import cloud_logging
-    self.retry(cloud_logging.logger.log_struct)({
+    """Buffers a log entry, written with the next batch of entries.
+
+    The buffer is flushed when it's full, when it was last flushed more than
+    LOG_FLUSH_INTERVAL seconds ago and with every error.
+    """
+    entry = {
         'labels': {
             'pipeline_id': self._pipeline_id,
             'job_id': self._job_id,
@@ -107,7 +129,49 @@ class Worker(object):
         },
         'log_level': level,
         'message': message % substs,
-    })
+    }
+    with self._log_lock:
+      self._log_entries.append(entry)
+      if (level == 'ERROR'
+          or len(self._log_entries) >= self.LOG_BUFFER_SIZE
+          or time.time() - self._log_flushed_at >= self.LOG_FLUSH_INTERVAL):
+        self._flush_log_entries()
+
+  def _flush_log_entries(self, retry=False):
+    """Writes buffered log entries with a single API call.
+
+    Without retry, entries that failed to be written stay in the buffer for
+    the next flush, so that logging never sleeps in the middle of a task.
+    """
+    from core import cloud_logging
+    self._log_flushed_at = time.time()
+    if not self._log_entries:
+      return
+    batch = cloud_logging.logger.batch()
+    for entry in self._log_entries:
+      batch.log_struct(entry)
+    try:
+      if retry:
+        self.retry(batch.commit)()
+      else:
+        batch.commit()
+    except Exception:  # pylint: disable=broad-except
+      if retry:
+        logging.exception('Failed to write %i log entries',
+                          len(self._log_entries))
+        del self._log_entries[:]
+      else:
+        dropped_count = len(self._log_entries) - self.MAX_LOG_BUFFER_SIZE
+        if dropped_count > 0:
+          logging.exception('Failed to write %i log entries', dropped_count)
+        del self._log_entries[:-self.MAX_LOG_BUFFER_SIZE]
+      return
+    del self._log_entries[:]
+
+  def flush_logs(self):
+    """Writes all buffered log entries, retrying on failures."""
+    with self._log_lock:
+      self._flush_log_entries(retry=True)
 
   def log_info(self, message, *substs):
     self._log('INFO', message, *substs)
@@ -123,10 +187,13 @@ class Worker(object):
                   json.dumps(self._params, sort_keys=True, indent=2,
                              separators=(', ', ': ')))
     try:
-      self._execute()
-    except ClientError as e:
-      raise WorkerException(e)
-    self.log_info('Finished successfully')
+      try:
+        self._execute()
+      except ClientError as e:
+        raise WorkerException(e)
+      self.log_info('Finished successfully')
+    finally:
+      self.flush_logs()
     return self._workers_to_enqueue
 
   def _execute(self):
@@ -136,6 +203,24 @@ class Worker(object):
   def _enqueue(self, worker_class, worker_params, delay=0):
     self._workers_to_enqueue.append((worker_class, worker_params, delay))
 
+  def _track_operation(self, kind, name, params=None, delay=0):
+    """Hands a long-running external operation over to the poller.
+
+    The job keeps running until the poller sees the operation completed,
+    instead of the worker respawning a waiter task to check on it.
+
+    Args:
+        kind: one of ExternalOperation.KIND values.
+        name: name of the BigQuery job or of the API operation.
+        params: dictionary of extra values needed to check the operation.
+        delay: number of seconds before the first check.
+    """
+    self._operations_to_track.append((kind, name, params, delay))
+
+  @property
+  def operations_to_track(self):
+    return self._operations_to_track
+
   def retry(self, func, max_retries=DEFAULT_MAX_RETRIES):
     """Decorator implementing retries with exponentially increasing delays."""
     @wraps(func)
@@ -177,18 +262,165 @@ class Commenter(Worker):
       raise WorkerException(msg)
 
 
+def _get_streaming_buffer_rows(table):
+  """Returns the estimated number of rows in the streaming buffer of a table.
+
+  These rows aren't counted by `num_rows` yet, though tabledata.list returns
+  them.
+  """
+  properties = getattr(table, '_properties', None) or {}
+  streaming_buffer = properties.get('streamingBuffer') or {}
+  return int(streaming_buffer.get('estimatedRows') or 0)
+
+
+def _has_streaming_buffer(table):
+  properties = getattr(table, '_properties', None) or {}
+  return 'streamingBuffer' in properties
+
+
+class TableReader(object):
+  """Streams rows of a BigQuery table as batches of row tuples.
+
+  Rows are read with tabledata.list by ranges of `batch_size` rows. Up to
+  `max_streams` ranges are read concurrently, each stream with the client of
+  its own thread, and batches are yielded in the order of the table as they
+  come. Only the selected fields are transferred, and rows are filtered as
+  they are read.
+
+  The number of rows in the streaming buffer of a table is only an estimate,
+  so all rows of tables with a streaming buffer are read page after page,
+  following the page tokens.
+  """
+
+  def __init__(self, table, selected_fields=None, row_filter=None,
+               start_index=0, max_results=None, page_token=None,
+               by_page=False, batch_size=10000, max_streams=4, retry=None,
+               get_client=None):
+    """
+    Args:
+        table: BigQuery table, reloaded with its schema and number of rows.
+        selected_fields: optional list of names of the fields to read.
+        row_filter: optional function called with each row tuple, returning
+            False for rows to skip.
+        start_index: index of the first row to read.
+        max_results: maximum number of rows to read, all rows by default.
+        page_token: optional token of the page to read from, instead of a
+            range.
+        by_page: whether to read pages following their tokens, from the
+            first page when `page_token` is missing.
+        batch_size: maximum number of rows read with a single request.
+        max_streams: maximum number of ranges read concurrently.
+        retry: optional decorator retrying failed requests.
+        get_client: optional function returning the BigQuery client of the
+            calling thread, the client of the table is used by all streams
+            when missing, hence they are read one at a time.
+    """
+    self._table = table
+    self.schema = list(table.schema)
+    if selected_fields:
+      missing_fields = set(selected_fields) - set(f.name for f in self.schema)
+      if missing_fields:
+        raise WorkerException('Fields not found in table "%s": %s' % (
+            table.name, ', '.join(sorted(missing_fields))))
+      # Rows have their values in the order of the table schema.
+      self.schema = [f for f in self.schema if f.name in selected_fields]
+    self.fields = [f.name for f in self.schema]
+    self._selected_fields = ','.join(self.fields) if selected_fields else None
+    self._row_filter = row_filter
+    self._start_index = start_index
+    self._max_results = max_results
+    if max_results is None:
+      self._end_index = table.num_rows or 0
+    else:
+      self._end_index = start_index + max_results
+    self._page_token = page_token
+    self.by_page = (by_page or page_token is not None
+                    or (max_results is None and _has_streaming_buffer(table)))
+    self.next_page_token = None
+    self._batch_size = batch_size
+    # Clients rely on httplib2, which isn't thread-safe.
+    self._max_streams = max_streams if get_client else 1
+    self._retry = retry or (lambda func: func)
+    self._get_client = get_client
+
+  def _fetch_page(self, max_results, start_index=None, page_token=None):
+    client = self._get_client() if self._get_client else None
+    query_iterator = self._table.fetch_data(max_results=max_results,
+                                            page_token=page_token,
+                                            client=client)
+    query_iterator.schema = self.schema
+    if start_index is not None:
+      query_iterator.extra_params['startIndex'] = start_index
+    if self._selected_fields:
+      query_iterator.extra_params['selectedFields'] = self._selected_fields
+    rows = list(next(query_iterator.pages))
+    return rows, query_iterator.next_page_token
+
+  def _filter(self, rows):
+    if self._row_filter is None:
+      return rows
+    return [row for row in rows if self._row_filter(row)]
+
+  def _read_range(self, start_index, max_results):
+    """Yields the rows of a range, a batch per page."""
+    while max_results > 0:
+      rows, _ = self._retry(self._fetch_page)(max_results, start_index)
+      if not rows:
+        return
+      start_index += len(rows)
+      max_results -= len(rows)
+      yield self._filter(rows)
+
+  def _read_pages(self):
+    """Yields the rows of pages following their tokens, a batch per page.
+
+    Pages are read until `max_results` rows have been read, and
+    `next_page_token` is set to the token of the page following them.
+    """
+    page_token = self._page_token
+    max_results = self._max_results
+    while max_results is None or max_results > 0:
+      batch_size = self._batch_size
+      if max_results is not None:
+        batch_size = min(batch_size, max_results)
+      rows, page_token = self._retry(self._fetch_page)(
+          batch_size, page_token=page_token)
+      self.next_page_token = page_token
+      if max_results is not None:
+        max_results -= len(rows)
+      yield self._filter(rows)
+      if not page_token:
+        return
+
+  def batches(self):
+    """Yields lists of rows, in the order of the table."""
+    if self.by_page:
+      return self._read_pages()
+    producers = []
+    for start_index in range(self._start_index, self._end_index,
+                             self._batch_size):
+      max_results = min(self._batch_size, self._end_index - start_index)
+      producers.append(partial(self._read_range, start_index, max_results))
+    if len(producers) == 1 or self._max_streams == 1:
+      return chain.from_iterable(producer() for producer in producers)
+    return concurrency.stream(producers, self._max_streams, buffer_size=2)
+
+  def rows(self):
+    """Yields rows one by one, in the order of the table."""
+    return chain.from_iterable(self.batches())
+
+
 class BQWorker(Worker):
   """Abstract BigQuery worker."""
 
+  # Longest time to wait for BigQuery jobs within a task, in seconds.
+  MAX_WAIT_TIME = 300
+
+  # Number of streams reading the rows of a table concurrently.
+  BQ_READ_STREAMS = 4
+
   def _get_client(self):
-    bigquery.Client.SCOPE = (
-        'https://www.googleapis.com/auth/bigquery',
-        'https://www.googleapis.com/auth/cloud-platform',
-        'https://www.googleapis.com/auth/drive')
-    client = bigquery.Client.from_service_account_json(_KEY_FILE)
-    if self._params['bq_project_id'].strip():
-      client.project = self._params['bq_project_id']
-    return client
+    return clients.get_bigquery_client(self._params['bq_project_id'].strip())
 
   def _bq_setup(self):
     self._client = self._get_client()
@@ -197,38 +429,163 @@ class BQWorker(Worker):
     self._job_name = '%i_%i_%s_%s' % (self._pipeline_id, self._job_id,
                                       self.__class__.__name__, uuid.uuid4())
 
-  def _begin_and_wait(self, *jobs):
+  def _begin_and_wait(self, *jobs, **kwargs):
+    """Begins BigQuery jobs and waits for them while they are short enough.
+
+    Checks are spaced by the estimated remaining time of the jobs, and jobs
+    expected to run longer than MAX_WAIT_TIME are handed over to the poller
+    as soon as it's known.
+
+    Args:
+        jobs: BigQuery jobs to begin.
+        staging_paths: optional list of Cloud Storage paths of the files read
+            by a single job, deleted once it has succeeded, by the poller if
+            the job is handed over to it.
+    """
+    staging_paths = kwargs.get('staging_paths') or []
+    worker_class = self.__class__.__name__
+    keys = [bq_estimates.fingerprint(worker_class, job) for job in jobs]
+    expected = [bq_estimates.get_expected_duration(key) for key in keys]
     for job in jobs:
       job.begin()
-    delay = 5
-    wait_time = 0
-    all_jobs_done = False
-    while not all_jobs_done:
-      wait_time += delay
-      if wait_time > 300:  # If 5 minutes passed, then spawn BQWaiter.
-        worker_params = {
-            'job_names': [job.name for job in jobs],
-            'bq_project_id': self._params['bq_project_id']
-        }
-        self._enqueue('BQWaiter', worker_params, 60)
+    remaining = None
+    if None not in expected:
+      remaining = max(expected)
+    elapsed = 0
+    while True:
+      delay = bq_estimates.next_delay(elapsed, remaining)
+      if ((remaining is not None and elapsed + remaining > self.MAX_WAIT_TIME)
+          or elapsed + delay > self.MAX_WAIT_TIME):
+        self._hand_over(jobs, keys, elapsed, remaining, staging_paths)
         return
       time.sleep(delay)
-      if delay < 30:
-        delay = [5, 10, 15, 20, 30][wait_time / 60]
-      all_jobs_done = True
-      for job in jobs:
-        job.reload()
-        if job.error_result is not None:
-          raise WorkerException(job.error_result['message'])
-        if job.state != 'DONE':
-          all_jobs_done = False
-          break
+      elapsed += delay
+      estimates = self._check_jobs(jobs, keys, expected, elapsed)
+      if not estimates:
+        for path in staging_paths:
+          gcs.delete(path)
+        return
+      remaining = None
+      if None not in estimates:
+        remaining = max(estimates)
+
+  def _check_jobs(self, jobs, keys, expected, elapsed):
+    """Reloads the unfinished jobs and records the durations of done ones.
+
+    Keys of the jobs done are reset to None.
+
+    Returns: List of the estimated remaining times of the unfinished jobs.
+    """
+    estimates = []
+    for i, job in enumerate(jobs):
+      if keys[i] is None:
+        continue
+      job.reload()
+      if job.error_result is not None:
+        raise WorkerException(job.error_result['message'])
+      if job.state == 'DONE':
+        bq_estimates.record_duration(
+            keys[i], bq_estimates.duration(job) or elapsed)
+        keys[i] = None
+      else:
+        estimates.append(
+            bq_estimates.estimate_remaining(job, elapsed, expected[i]))
+    return estimates
+
+  def _hand_over(self, jobs, keys, elapsed, remaining, staging_paths=None):
+    """Hands unfinished jobs over to the poller."""
+    from core.models import ExternalOperation
+    if remaining is None:
+      # Unknown duration, at least twice the time waited so far.
+      remaining = elapsed
+    for job, key in zip(jobs, keys):
+      if key is None:
+        continue
+      params = {'bq_project_id': self._params['bq_project_id'],
+                'fingerprint': key}
+      if staging_paths:
+        params['staging_paths'] = staging_paths
+      self._track_operation(ExternalOperation.KIND.BIGQUERY_JOB, job.name,
+                            params, int(min(remaining, self.MAX_WAIT_TIME)))
+
+  def _get_selected_fields(self):
+    """Returns names of the fields the worker reads, None to read them all.
+
+    Workers using only some columns of their table override it, so that the
+    other columns of wide tables are never transferred.
+    """
+    return None
+
+  def _get_row_filter(self):
+    """Returns a function skipping the rows the worker can't process."""
+    return None
+
+  def _read_table(self, **kwargs):
+    """Returns a TableReader over the table of the worker.
+
+    Keyword arguments are passed to the TableReader, and the fields and rows
+    read default to the ones declared by the worker.
+    """
+    kwargs.setdefault('max_streams', self.BQ_READ_STREAMS)
+    if 'selected_fields' not in kwargs:
+      kwargs['selected_fields'] = self._get_selected_fields()
+    if 'row_filter' not in kwargs:
+      kwargs['row_filter'] = self._get_row_filter()
+    return TableReader(self._table, retry=self.retry,
+                       get_client=self._get_client, **kwargs)
+
+  def _read_task_rows(self, rows_count, **kwargs):
+    """Returns a TableReader over the rows this task has to process.
+
+    Each task processes `rows_count` rows from the `bq_start_index` parameter
+    on, read by BQ_READ_STREAMS concurrent streams.
+
+    Tables with a streaming buffer are read page after page instead, each task
+    resuming with the page token it was given, as the number of rows they have
+    is only an estimate.
+
+    NB: tasks enqueued by a former version of the worker resume with the page
+        token they were given too.
+    """
+    if self._params.get('bq_start_index') is None:
+      page_token = self._params.get('bq_page_token') or None
+      if page_token or _has_streaming_buffer(self._table):
+        return self._read_table(page_token=page_token, by_page=True,
+                                max_results=rows_count, batch_size=rows_count,
+                                **kwargs)
+    batch_size = ((rows_count + self.BQ_READ_STREAMS - 1)
+                  // self.BQ_READ_STREAMS)
+    return self._read_table(start_index=self._params.get('bq_start_index') or 0,
+                            max_results=rows_count, batch_size=batch_size,
+                            **kwargs)
+
+  def _enqueue_next_task(self, reader, rows_count):
+    """Enqueues the worker again for the rows following the ones of the task."""
+    worker_params = self._params.copy()
+    if reader.by_page:
+      if not reader.next_page_token:
+        return
+      worker_params['bq_page_token'] = reader.next_page_token
+    else:
+      start_index = (self._params.get('bq_start_index') or 0) + rows_count
+      num_rows = ((self._table.num_rows or 0)
+                  + _get_streaming_buffer_rows(self._table))
+      if start_index >= num_rows:
+        return
+      worker_params.pop('bq_page_token', None)
+      worker_params['bq_start_index'] = start_index
+    self._enqueue(self.__class__.__name__, worker_params, 0)
 
 
 class BQWaiter(BQWorker):
-  """Worker that checks BQ job status and respawns itself if job is running."""
+  """Worker that checks BQ job status and hands running jobs over to poller.
+
+  NB: BQ jobs are now tracked by the poller, this worker only completes waiter
+      tasks enqueued before.
+  """
 
   def _execute(self):
+    from core.models import ExternalOperation
     client = self._get_client()
     for job_name in self._params['job_names']:
       # pylint: disable=protected-access
@@ -238,12 +595,9 @@ class BQWaiter(BQWorker):
       if job.error_result is not None:
         raise WorkerException(job.error_result['message'])
       if job.state != 'DONE':
-        worker_params = {
-            'job_names': self._params['job_names'],
-            'bq_project_id': self._params['bq_project_id']
-        }
-        self._enqueue('BQWaiter', worker_params, 60)
-        return
+        self._track_operation(
+            ExternalOperation.KIND.BIGQUERY_JOB, job_name,
+            {'bq_project_id': self._params['bq_project_id']})
 
 
 class BQQueryLauncher(BQWorker):
@@ -269,29 +623,95 @@ class BQQueryLauncher(BQWorker):
     self._begin_and_wait(job)
 
 
+def _glob_prefix(pattern):
+  """Returns the literal part of a glob pattern before its first wildcard."""
+  match = re.search(r'[*?[]', pattern)
+  if match is None:
+    return pattern
+  return pattern[:match.start()]
+
+
+def _is_under(object_prefix, parent_prefix):
+  """Tells whether an object prefix is below another on a '/' boundary."""
+  if not parent_prefix or object_prefix == parent_prefix:
+    return True
+  if not parent_prefix.endswith('/'):
+    parent_prefix += '/'
+  return object_prefix.startswith(parent_prefix)
+
+
 class StorageWorker(Worker):
   """Abstract worker class for Cloud Storage workers."""
 
+  # Maximum number of bucket listings run in parallel.
+  MAX_CONCURRENT_LISTINGS = 8
+
   def _get_matching_stats(self, patterned_uris):
-    stats = []
+    """Yields stats of the files matching any of the URI patterns.
+
+    Buckets are listed under the literal prefixes of their patterns only,
+    several listings run concurrently, and stats are streamed as they come in
+    lexicographic order of their filenames within each listing.
+
+    Args:
+        patterned_uris: list of file URIs and URI patterns.
+    """
+    for _, _, stat in self._list_matching_files(patterned_uris):
+      yield stat
+
+  def _list_matching_files(self, patterned_uris, checkpoint=None):
+    """Yields (bucket, prefix, stat) tuples of the files matching the patterns.
+
+    Args:
+        patterned_uris: list of file URIs and URI patterns.
+        checkpoint: optional (bucket, prefix, marker) tuple of a previously
+            yielded file, only the files listed after it are yielded.
+    """
     patterns = {}
     for patterned_uri in patterned_uris:
       patterned_uri_split = patterned_uri.split('/')
       bucket = '/'.join(patterned_uri_split[1:3])
       pattern = '/'.join(patterned_uri_split[1:])
-      try:
-        if pattern not in patterns[bucket]:
-          patterns[bucket].append(pattern)
-      except KeyError:
-        patterns[bucket] = [pattern]
+      patterns.setdefault(bucket, set()).add(pattern)
+    regexes = {}
+    prefixes = set()
     for bucket in patterns:
-      for stat in gcs.listbucket(bucket):
-        if not stat.is_dir:
-          for pattern in patterns[bucket]:
-            if fnmatch(stat.filename, pattern):
-              stats.append(stat)
-              break
-    return stats
+      regexes[bucket] = re.compile(
+          '|'.join(translate(p) for p in patterns[bucket]))
+      prefixes.update((bucket, _glob_prefix(p)[len(bucket) + 1:])
+                      for p in patterns[bucket])
+    kept_prefixes = []
+    for bucket, object_prefix in sorted(prefixes):
+      # Objects under a parent directory are already listed with it.
+      if not any(b == bucket and _is_under(object_prefix, p)
+                 for b, p in kept_prefixes):
+        kept_prefixes.append((bucket, object_prefix))
+    listings = []
+    for bucket, object_prefix in kept_prefixes:
+      marker = None
+      if checkpoint is not None:
+        if (bucket, object_prefix) < tuple(checkpoint[:2]):
+          # Listed entirely before the checkpoint.
+          continue
+        if (bucket, object_prefix) == tuple(checkpoint[:2]):
+          marker = checkpoint[2]
+      # Objects under a longer prefix kept apart are listed with it only.
+      excluded_prefixes = tuple(
+          '%s/%s' % (b, p) for b, p in kept_prefixes
+          if b == bucket and p != object_prefix and p.startswith(object_prefix))
+      listings.append(self._make_listing(
+          bucket, object_prefix, regexes[bucket], marker, excluded_prefixes))
+    return concurrency.stream(listings, self.MAX_CONCURRENT_LISTINGS)
+
+  @staticmethod
+  def _make_listing(bucket, object_prefix, regex, marker, excluded_prefixes):
+    def _list():
+      path_prefix = '%s/%s' % (bucket, object_prefix)
+      for stat in gcs.listbucket(path_prefix, marker=marker):
+        if (not stat.is_dir and regex.match(stat.filename)
+            and not stat.filename.startswith(excluded_prefixes)):
+          yield bucket, object_prefix, stat
+    return _list
 
 
 class StorageCleaner(StorageWorker):
@@ -305,15 +725,71 @@ class StorageCleaner(StorageWorker):
        'Days to keep files since last modification'),
   ]
 
+  # Listing a large bucket can outlive the instance, retries resume it.
+  MAX_ATTEMPTS = 3
+
+  # Number of listed files between two checkpoints.
+  CHECKPOINT_INTERVAL = 1000
+
+  # Time to keep the checkpoint of an interrupted execution, in seconds.
+  CHECKPOINT_TTL = 24 * 60 * 60
+
+  # Maximum number of files deleted in parallel.
+  MAX_CONCURRENT_DELETES = 16
+
+  def _checkpoint_key(self):
+    """Returns the key of the checkpoint, shared by the retries of a task only.
+
+    A later run starts over, so that it sees the files expired in between.
+    """
+    params = json.dumps([self._task_name, self._params['file_uris'],
+                         self._params['expiration_days']])
+    return 'storage_cleaner:%i:%s' % (self._job_id,
+                                      hashlib.sha1(params).hexdigest())
+
+  def _delete(self, filenames):
+    def _delete_file(filename):
+      try:
+        gcs.delete(filename)
+      except gcs.NotFoundError:
+        # Deleted by a previous attempt.
+        pass
+    errors = concurrency.run(_delete_file, filenames,
+                             self.MAX_CONCURRENT_DELETES)
+    if errors:
+      filename, error = errors[0]
+      raise WorkerException('Failed to delete %i files, e.g. gs:/%s: %s' % (
+          len(errors), filename, error))
+
   def _execute(self):
+    from google.appengine.api import memcache
     delta = timedelta(self._params['expiration_days'])
     expiration_datetime = datetime.now() - delta
     expiration_timestamp = time.mktime(expiration_datetime.timetuple())
-    stats = self._get_matching_stats(self._params['file_uris'])
-    for stat in stats:
+    checkpoint_key = self._checkpoint_key()
+    checkpoint = memcache.get(checkpoint_key)
+    if checkpoint is not None:
+      self.log_info('Resuming after gs:/%s', checkpoint[2])
+    listed_count = 0
+    deleted_count = 0
+    expired_filenames = []
+    files = self._list_matching_files(self._params['file_uris'], checkpoint)
+    for bucket, object_prefix, stat in files:
+      listed_count += 1
       if stat.st_ctime < expiration_timestamp:
-        gcs.delete(stat.filename)
-        self.log_info('gs:/%s file deleted.', stat.filename)
+        expired_filenames.append(stat.filename)
+      if listed_count % self.CHECKPOINT_INTERVAL == 0:
+        self._delete(expired_filenames)
+        deleted_count += len(expired_filenames)
+        expired_filenames = []
+        memcache.set(checkpoint_key, (bucket, object_prefix, stat.filename),
+                     time=self.CHECKPOINT_TTL)
+        self.log_info('%i files listed, %i deleted so far', listed_count,
+                      deleted_count)
+    self._delete(expired_filenames)
+    deleted_count += len(expired_filenames)
+    memcache.delete(checkpoint_key)
+    self.log_info('%i files listed, %i deleted', listed_count, deleted_count)
 
 
 class StorageChecker(StorageWorker):
@@ -332,10 +808,15 @@ class StorageChecker(StorageWorker):
       min_size = int(self._params['min_size'])
     except TypeError:
       min_size = 0
-    stats = self._get_matching_stats(self._params['file_uris'])
-    if not stats:
+    found = False
+    size = 0
+    for stat in self._get_matching_stats(self._params['file_uris']):
+      found = True
+      size += stat.st_size
+      if size >= min_size:
+        break
+    if not found:
       raise WorkerException('Files matching the patterns were not found')
-    size = reduce(lambda total, stat: total + stat.st_size, stats, 0)
     if size < min_size:
       raise WorkerException('Files matching the patterns are too small')
 
@@ -428,18 +909,68 @@ class BQToStorageExporter(BQWorker):
     self._begin_and_wait(job)
 
 
+def _is_transient_error(exception):
+  """Checks whether a request failed with an error worth retrying."""
+  if isinstance(exception, HttpError):
+    return exception.resp.status >= 500 or exception.resp.status == 429
+  return False
+
+
 class GAWorker(Worker):
   """Abstract class with GA-specific methods."""
 
   def _ga_setup(self, v='v4'):
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(_KEY_FILE)
     service = 'analyticsreporting' if v == 'v4' else 'analytics'
-    self._ga_client = build(service, v, credentials=credentials)
+    self._ga_client = clients.build_service(service, v)
 
   def _parse_accountid_from_propertyid(self):
     return self._params['property_id'].split('-')[1]
 
 
+class GAReportRowMapper(object):
+  """Maps rows of a Reporting API report to tuples ordered as a BQ schema.
+
+  The mapper is compiled once per report header. A row is mapped by a single
+  lookup of the index of every field among the values of the row, followed by
+  the view ID, start and end dates of the report and None for the fields the
+  report doesn't have. Metrics take precedence over dimensions, which take
+  precedence over the report values, when their names collide.
+  """
+
+  # Names of the fields set for every row of a report.
+  REPORT_FIELDS = ['view_id', 'start_date', 'end_date']
+
+  def __init__(self, field_names, column_header):
+    """
+    Args:
+        field_names: names of the fields of the BQ table, in order.
+        column_header: columnHeader of the report.
+    """
+    dimensions = [d.replace(':', '_')
+                  for d in column_header.get('dimensions', [])]
+    metrics = [m['name'].replace(':', '_') for m in
+               column_header['metricHeader']['metricHeaderEntries']]
+    indexes = {}
+    for i, name in enumerate(self.REPORT_FIELDS):
+      indexes[name] = len(dimensions) + len(metrics) + i
+    for i, name in enumerate(dimensions):
+      indexes[name] = i
+    for i, name in enumerate(metrics):
+      indexes[name] = len(dimensions) + i
+    none_index = len(dimensions) + len(metrics) + len(self.REPORT_FIELDS)
+    field_indexes = [indexes.get(name, none_index) for name in field_names]
+    if len(field_indexes) > 1:
+      self._get = itemgetter(*field_indexes)
+    else:
+      # A single index gets a value instead of a tuple.
+      self._get = lambda values: tuple(values[i] for i in field_indexes)
+
+  def map(self, row, view_id, start_date, end_date):
+    """Returns the tuple of values of a report row."""
+    return self._get(row.get('dimensions', []) + row['metrics'][0]['values'] +
+                     [view_id, start_date, end_date, None])
+
+
 class GAToBQImporter(BQWorker, GAWorker):
   """Worker to load data into BQ from GA using Core Reporting API."""
 
@@ -456,8 +987,49 @@ class GAToBQImporter(BQWorker, GAWorker):
       ('bq_project_id', 'string', False, '', 'BQ Project ID'),
       ('bq_dataset_id', 'string', True, '', 'BQ Dataset ID'),
       ('bq_table_id', 'string', True, '', 'BQ Table ID'),
+      ('staging_uri', 'string', False, '',
+       'GCS folder to load data from instead of streaming it '
+       '(e.g. gs://bucket/ga)'),
   ]
 
+  # Number of tasks fetching shards of a report in parallel.
+  MAX_PARALLEL_TASKS = 4
+
+  # Number of shards fetched by a task, before it hands the following ones
+  # over to a new task.
+  MAX_SHARDS_PER_TASK = 8
+
+  # Number of shards fetched concurrently by a task.
+  MAX_CONCURRENT_REPORTS = 4
+
+  # Maximum number of Reporting API requests per second sent by a task, so
+  # that parallel tasks stay within 2,000 requests per 100 seconds.
+  MAX_REQUESTS_PER_SECOND = 5
+
+  def _plan_shards(self):
+    """Splits the report into [view_id, start_date, end_date] shards.
+
+    Shards span the whole date range, or a single day in day by day mode.
+    """
+    if not self._params['day_by_day']:
+      return [[view_id, self._params['start_date'], self._params['end_date']]
+              for view_id in self._params['view_ids']]
+    date = datetime.strptime(self._params['start_date'], '%Y-%m-%d').date()
+    end_date = datetime.strptime(self._params['end_date'], '%Y-%m-%d').date()
+    shards = []
+    while date <= end_date:
+      date_str = date.strftime('%Y-%m-%d')
+      for view_id in self._params['view_ids']:
+        shards.append([view_id, date_str, date_str])
+      date += timedelta(1)
+    return shards
+
+  def _enqueue_shards(self, shards):
+    """Enqueues a task fetching the given shards."""
+    params = self._params.copy()
+    params['shards'] = shards
+    self._enqueue(self.__class__.__name__, params)
+
   def _compose_report(self):
     dimensions = [{'name': d} for d in self._params['dimensions']]
     metrics = [{'expression': m} for m in self._params['metrics']]
@@ -475,60 +1047,67 @@ class GAToBQImporter(BQWorker, GAWorker):
     }
 
   def _get_report(self, view_id, start_date, end_date):
-    # TODO(dulacp): refactor this method, too complex branching logic
+    """Fetches the report of a shard and writes its rows.
 
+    NB: shards are fetched on several threads, each with its own client.
+    """
+    ga_client = clients.build_service('analyticsreporting', 'v4')
     log_str = 'View ID %s from %s till %s' % (view_id, start_date, end_date)
     self.log_info('Fetch for %s started', log_str)
     rows_fetched = 0
-    self._request['view_id'] = view_id
-    self._request['dateRanges'] = [{
+    report_request = dict(self._request, viewId=view_id, dateRanges=[{
         'startDate': start_date,
         'endDate': end_date,
-    }]
-    body = {'reportRequests': [self._request]}
+    }])
+    body = {'reportRequests': [report_request]}
+
+    def _batch_get():
+      self._rate_limiter.wait()
+      return ga_client.reports().batchGet(body=body).execute()
+
     while True:
-      request = self._ga_client.reports().batchGet(body=body)
-      response = self.retry(request.execute)()
+      response = self.retry(_batch_get)()
       report = response['reports'][0]
-      dimensions = [d.replace(':', '_') for d in
-                    report['columnHeader']['dimensions']]
-      metrics = [m['name'].replace(':', '_') for m in
-                 report['columnHeader']['metricHeader']['metricHeaderEntries']]
-      ga_row = {
-          'view_id': view_id,
-          'start_date': start_date,
-          'end_date': end_date,
-      }
-      try:
-        for row in report['data']['rows']:
-          for dimension, value in zip(dimensions, row['dimensions']):
-            ga_row[dimension] = value
-          for metric, value in zip(metrics, row['metrics'][0]['values']):
-            ga_row[metric] = value
-          bq_row = []
-          for field in self._table.schema:
-            try:
-              bq_row.append(ga_row[field.name])
-            except KeyError:
-              bq_row.append(None)
-          self._bq_rows.append(tuple(bq_row))
+      rows = report.get('data', {}).get('rows')
+      if not rows:
+        break
+      mapper = self._get_row_mapper(report['columnHeader'])
+      bq_rows = [mapper.map(row, view_id, start_date, end_date)
+                 for row in rows]
+      with self._rows_lock:
+        for bq_row in bq_rows:
+          self._write_row(bq_row)
         self._flush()
-        rows_fetched += len(report['data']['rows'])
-        try:
-          self._request['pageToken'] = report['nextPageToken']
-        except KeyError:
-          try:
-            del self._request['pageToken']
-          except KeyError:
-            pass
-          break
-      except KeyError:
+      rows_fetched += len(rows)
+      if 'nextPageToken' not in report:
         break
+      report_request['pageToken'] = report['nextPageToken']
     if rows_fetched:
       self.log_info('%i rows of data fetched for %s', rows_fetched, log_str)
     else:
       self.log_warn('No rows of data fetched for %s', log_str)
 
+  def _get_row_mapper(self, column_header):
+    """Returns the row mapper of a report header, compiled once per task."""
+    key = json.dumps(column_header, sort_keys=True)
+    try:
+      return self._row_mappers[key]
+    except KeyError:
+      mapper = GAReportRowMapper(
+          [field.name for field in self._table.schema], column_header)
+      self._row_mappers[key] = mapper
+      return mapper
+
+  def _write_row(self, bq_row):
+    """Buffers a row for streaming inserts or writes it to the staging file."""
+    if self._staging_file is None:
+      self._bq_rows.append(bq_row)
+      return
+    values = dict((name, value) for name, value in zip(self._fields, bq_row)
+                  if value is not None)
+    self._staging_file.write(json.dumps(values) + '\n')
+    self._staged_rows_count += 1
+
   def _flush(self, forced=False):
     if self._bq_rows:
       if forced or len(self._bq_rows) > 9999:
@@ -536,31 +1115,76 @@ class GAToBQImporter(BQWorker, GAWorker):
           self._table.insert_data(self._bq_rows[i:i + 10000])
         self._bq_rows = []
 
+  def _open_staging_file(self):
+    """Opens a newline-delimited JSON file for the rows of the task.
+
+    Rows are written to Cloud Storage as they are fetched, so that they are
+    loaded with a single load job instead of being buffered and streamed.
+    """
+    self._staging_file = None
+    self._staged_rows_count = 0
+    if not self._params['staging_uri']:
+      return
+    self._fields = [field.name for field in self._table.schema]
+    self._staging_path = '%s/%s.json' % (
+        self._params['staging_uri'].replace('gs:/', '').rstrip('/'),
+        self._job_name)
+    self._staging_file = gcs.open(self._staging_path, 'w',
+                                  content_type='application/json')
+
+  def _load_staging_file(self):
+    """Loads the staged rows into the table and deletes the staging file.
+
+    NB: the poller deletes the staging file if the load job is handed over.
+    """
+    if self._staging_file is None:
+      return
+    self._staging_file.close()
+    if not self._staged_rows_count:
+      gcs.delete(self._staging_path)
+      return
+    job = self._client.load_table_from_storage(
+        self._job_name, self._table, 'gs:/%s' % self._staging_path)
+    job.source_format = 'NEWLINE_DELIMITED_JSON'
+    job.write_disposition = 'WRITE_APPEND'
+    job.create_disposition = 'CREATE_NEVER'
+    self.log_info('Loading %i rows from gs:/%s', self._staged_rows_count,
+                  self._staging_path)
+    self._begin_and_wait(job, staging_paths=[self._staging_path])
+
   def _execute(self):
+    """Fetches the shards of the report, in parallel tasks for large ones.
+
+    The first task plans the shards. Up to MAX_SHARDS_PER_TASK of them are
+    fetched right away, more are spread over MAX_PARALLEL_TASKS tasks which
+    fetch them in turn, and the job finishes when all of them are done.
+    """
+    shards = self._params.get('shards')
+    if shards is None:
+      shards = self._plan_shards()
+      if len(shards) > self.MAX_SHARDS_PER_TASK:
+        chunk_size = -(-len(shards) // self.MAX_PARALLEL_TASKS)
+        for i in xrange(0, len(shards), chunk_size):
+          self._enqueue_shards(shards[i:i + chunk_size])
+        return
     self._bq_setup()
     self._table.reload()
-    self._ga_setup()
     self._compose_report()
     self._bq_rows = []
-    if self._params['day_by_day']:
-      start_date = datetime.strptime(
-          self._params['start_date'], '%Y-%m-%d').date()
-      end_date = datetime.strptime(
-          self._params['end_date'], '%Y-%m-%d').date()
-      date_str = start_date.strftime('%Y-%m-%d')
-      for view_id in self._params['view_ids']:
-        self._get_report(view_id, date_str, date_str)
-      self._flush(forced=True)
-      if start_date != end_date:
-        start_date += timedelta(1)
-        params = self._params.copy()
-        params['start_date'] = start_date.strftime('%Y-%m-%d')
-        self._enqueue(self.__class__.__name__, params)
-    else:
-      for view_id in self._params['view_ids']:
-        self._get_report(
-            view_id, self._params['start_date'], self._params['end_date'])
-      self._flush(forced=True)
+    self._rows_lock = threading.Lock()
+    self._row_mappers = {}
+    self._rate_limiter = concurrency.RateLimiter(self.MAX_REQUESTS_PER_SECOND)
+    self._open_staging_file()
+    errors = concurrency.run(lambda shard: self._get_report(*shard),
+                             shards[:self.MAX_SHARDS_PER_TASK],
+                             self.MAX_CONCURRENT_REPORTS)
+    if errors:
+      _, error = errors[0]
+      raise error
+    self._flush(forced=True)
+    self._load_staging_file()
+    if len(shards) > self.MAX_SHARDS_PER_TASK:
+      self._enqueue_shards(shards[self.MAX_SHARDS_PER_TASK:])
 
 
 class GADataImporter(GAWorker):
@@ -582,23 +1206,112 @@ class GADataImporter(GAWorker):
 
   _BUFFER_SIZE = 256 * 1024
 
+  # Uploads can outlive the instance or fail repeatedly, retries resume them
+  # from a checkpoint.
+  MAX_ATTEMPTS = 3
+
+  # Largest chunk sent with a single request, a multiple of _BUFFER_SIZE as
+  # resumable uploads require.
+  MAX_CHUNK_SIZE = 64 * _BUFFER_SIZE
+
+  # Time it should take to send a chunk, in seconds.
+  TARGET_CHUNK_DURATION = 10
+
+  def _next_chunk_size(self, chunk_size, duration):
+    """Sizes the next chunk to be sent in about TARGET_CHUNK_DURATION seconds.
+
+    Chunks are at most twice as big as the previous one, so that a single
+    fast request doesn't lead to a chunk too big to be sent in time.
+    """
+    if duration > 0:
+      size = int(chunk_size * self.TARGET_CHUNK_DURATION / duration)
+    else:
+      size = self.MAX_CHUNK_SIZE
+    size = size // self._BUFFER_SIZE * self._BUFFER_SIZE
+    return max(self._BUFFER_SIZE, min(size, 2 * chunk_size,
+                                      self.MAX_CHUNK_SIZE))
+
+  def _get_checkpoint(self, source_etag):
+    """Returns the checkpoint of an upload of the same file by this job."""
+    from core.models import UploadCheckpoint
+    checkpoint = UploadCheckpoint.where(
+        job_id=self._job_id, source_uri=self._params['csv_uri']).first()
+    if checkpoint is not None and checkpoint.source_etag != source_etag:
+      # The file has changed since, its upload starts over.
+      checkpoint.delete()
+      return None
+    return checkpoint
+
+  def _save_checkpoint(self, checkpoint, request, source_etag, chunk_size):
+    from core.models import UploadCheckpoint
+    if checkpoint is None:
+      return UploadCheckpoint.create(
+          job_id=self._job_id, source_uri=self._params['csv_uri'],
+          source_etag=source_etag, session_uri=request.resumable_uri,
+          offset=request.resumable_progress, chunk_size=chunk_size)
+    checkpoint.update(session_uri=request.resumable_uri,
+                      offset=request.resumable_progress, chunk_size=chunk_size)
+    return checkpoint
+
+  def _upload_request(self, media, checkpoint):
+    """Returns the upload request, resuming the session of the checkpoint."""
+    request = self._ga_client.management().uploads().uploadData(
+        accountId=self._account_id,
+        webPropertyId=self._params['property_id'],
+        customDataSourceId=self._params['dataset_id'],
+        media_body=media)
+    if checkpoint is not None:
+      request.resumable_uri = checkpoint.session_uri
+      request.resumable_progress = checkpoint.offset
+      # Asks GA for the bytes received before sending the following ones.
+      request._in_error_state = True  # pylint: disable=protected-access
+      self.log_info('Resuming upload from byte %i.', checkpoint.offset)
+    return request
+
+  def _log_progress(self, status, milestone):
+    """Logs the progress of the upload every 20%.
+
+    Returns: Percentage of the next progress to log.
+    """
+    progress = int(status.progress() * 100)
+    if progress >= milestone:
+      self.log_info('Uploaded %d%%.', progress)
+      milestone += 20
+    return milestone
+
   def _upload(self):
+    """Uploads the file with a resumable upload checkpointed after each chunk.
+
+    A retried task resumes the upload from the last byte GA received, and
+    chunks are sized after the throughput observed.
+    """
+    source_etag = gcs.stat(self._file_name).etag
+    checkpoint = self._get_checkpoint(source_etag)
+    if checkpoint is not None:
+      chunk_size = checkpoint.chunk_size
+    else:
+      chunk_size = self._BUFFER_SIZE
     with gcs.open(self._file_name, read_buffer_size=self._BUFFER_SIZE) as f:
       media = MediaIoBaseUpload(f, mimetype='application/octet-stream',
-                                chunksize=self._BUFFER_SIZE, resumable=True)
-      request = self._ga_client.management().uploads().uploadData(
-          accountId=self._account_id,
-          webPropertyId=self._params['property_id'],
-          customDataSourceId=self._params['dataset_id'],
-          media_body=media)
+                                chunksize=chunk_size, resumable=True)
+      request = self._upload_request(media, checkpoint)
+      resumed = checkpoint is not None
       response = None
+      error = None
       tries = 0
       milestone = 0
       while response is None and tries < 5:
+        started_at = time.time()
+        status = None
         try:
           status, response = request.next_chunk()
         except HttpError, e:
+          if resumed and e.resp.status in [404, 410]:
+            self.log_warn('Upload session has expired, restarting upload.')
+            checkpoint.delete()
+            return self._upload()
           if e.resp.status in [404, 500, 502, 503, 504]:
+            error = e
             tries += 1
             delay = 5 * 2 ** (tries + random())
             self.log_warn('%s, Retrying in %.1f seconds...', e, delay)
@@ -607,11 +1320,21 @@ class GADataImporter(GAWorker):
             raise WorkerException(e)
         else:
           tries = 0
+          resumed = False
         if status:
-          progress = int(status.progress() * 100)
-          if progress >= milestone:
-            self.log_info('Uploaded %d%%.', int(status.progress() * 100))
-            milestone += 20
+          chunk_size = self._next_chunk_size(chunk_size,
+                                             time.time() - started_at)
+          media._chunksize = chunk_size  # pylint: disable=protected-access
+          checkpoint = self._save_checkpoint(checkpoint, request, source_etag,
+                                             chunk_size)
+          milestone = self._log_progress(status, milestone)
+      if response is None:
+        # Not a WorkerException, so that the task is retried and its next
+        # attempt resumes the upload from the checkpoint.
+        self.log_warn('Upload failed after %i tries.', tries)
+        raise error
+      if checkpoint is not None:
+        checkpoint.delete()
       self.log_info('Upload Complete.')
 
   def _delete_older(self, uploads_to_keep):
@@ -663,12 +1386,23 @@ class GAAudiencesUpdater(BQWorker, GAWorker):
       ('bq_table_id', 'string', True, '', 'BQ Table ID'),
       ('template', 'text', True, '', 'GA audience JSON template'),
       ('account_id', 'string', False, '', 'GA Account ID'),
+      ('full_sync', 'boolean', False, False,
+       'Compare all audiences with GA, even the ones unchanged since last run'),
   ]
 
+  # Maximum number of inserts and patches sent with a batch HTTP request.
+  MAX_REQUESTS_PER_BATCH = 30
+
+  def _get_selected_fields(self):
+    """Returns the fields of the table used by the audience template."""
+    names = set(re.findall(r'%\(([^)]*)\)', self._params['template']))
+    return [f.name for f in self._table.schema if f.name in names]
+
   def _infer_audiences(self):
     self._inferred_audiences = {}
-    fields = [f.name for f in self._table.schema]
-    for row in self._table.fetch_data():
+    reader = self._read_table()
+    fields = reader.fields
+    for row in reader.rows():
       try:
         template_rendered = self._params['template'] % dict(zip(fields, row))
         audience = json.loads(template_rendered)
@@ -676,7 +1410,37 @@ class GAAudiencesUpdater(BQWorker, GAWorker):
         raise WorkerException(e)
       self._inferred_audiences[audience['name']] = audience
 
+  def _get_fingerprints(self):
+    """Hashes the inferred audience definitions and loads the stored ones.
+
+    Audiences which definition didn't change since it was last pushed are
+    dropped from the inferred audiences.
+    """
+    from core.models import AudienceFingerprint
+    self._fingerprints = {}
+    for name, audience in self._inferred_audiences.iteritems():
+      self._fingerprints[name] = hashlib.sha1(
+          json.dumps(audience, sort_keys=True)).hexdigest()
+    self._stored_fingerprints = {}
+    if not self._params['full_sync']:
+      self._stored_fingerprints = AudienceFingerprint.load(
+          self._params['property_id'])
+    unchanged_names = [
+        name for name, fingerprint in self._fingerprints.iteritems()
+        if self._stored_fingerprints.get(name, (None, None))[1] == fingerprint]
+    for name in unchanged_names:
+      del self._inferred_audiences[name]
+    if unchanged_names:
+      self.log_info('%i audience(s) unchanged since last run.',
+                    len(unchanged_names))
+
   def _get_audiences(self):
+    """Lists the current GA audiences which ids aren't known yet."""
+    self._current_audiences = {}
+    names = set(name for name in self._inferred_audiences
+                if name not in self._stored_fingerprints)
+    if not names:
+      return
     audiences = []
     start_index = 1
     max_results = 100
@@ -691,8 +1455,6 @@ class GAAudiencesUpdater(BQWorker, GAWorker):
       total_results = response['totalResults']
       start_index += max_results
       audiences += response['items']
-    self._current_audiences = {}
-    names = self._inferred_audiences.keys()
     for audience in audiences:
       if audience['name'] in names:
         self._current_audiences[audience['name']] = audience
@@ -731,34 +1493,111 @@ class GAAudiencesUpdater(BQWorker, GAWorker):
     return True
 
   def _get_diff(self):
-    """Composes lists of audiences to be created and updated in GA."""
+    """Composes lists of audiences to be created and updated in GA.
+
+    Audiences with a stored id are patched right away, the other ones are
+    compared with the current GA audience of the same name, if any.
+    """
     self._audiences_to_insert = []
     self._audiences_to_patch = {}
+    self._pushed_audiences = {}
     for name in self._inferred_audiences:
       inferred_audience = self._inferred_audiences[name]
-      if name in self._current_audiences:
+      audience_id = self._stored_fingerprints.get(name, (None, None))[0]
+      if audience_id is not None:
+        self._audiences_to_patch[audience_id] = inferred_audience
+      elif name in self._current_audiences:
         current_audience = self._current_audiences[name]
-        if not self._equal(inferred_audience, current_audience):
+        if self._equal(inferred_audience, current_audience):
+          self._pushed_audiences[name] = current_audience['id']
+        else:
           self._audiences_to_patch[current_audience['id']] = inferred_audience
       else:
         self._audiences_to_insert.append(inferred_audience)
 
+  def _send_batches(self, requests_to_send, indexes, errors):
+    """Sends requests with batch HTTP requests.
+
+    Args:
+        requests_to_send: list of (audience name, request, idempotent) tuples.
+        indexes: indexes of the requests to send.
+        errors: dictionary mapping names of the failed audiences to their
+            error, updated with the responses received.
+
+    Returns: Indexes of the idempotent requests to send again, which failed
+        with a transient error or got no response.
+    """
+    responded = set()
+
+    def _callback(request_id, response, exception):
+      responded.add(int(request_id))
+      name = requests_to_send[int(request_id)][0]
+      if exception is None:
+        self._pushed_audiences[name] = response['id']
+        errors.pop(name, None)
+      else:
+        errors[name] = exception
+
+    for i in xrange(0, len(indexes), self.MAX_REQUESTS_PER_BATCH):
+      batch_indexes = indexes[i:i + self.MAX_REQUESTS_PER_BATCH]
+      batch = self._ga_client.new_batch_http_request(callback=_callback)
+      for j in batch_indexes:
+        batch.add(requests_to_send[j][1], request_id=str(j))
+      try:
+        batch.execute()
+      except Exception as e:  # pylint: disable=broad-except
+        # Some requests may have been processed before the batch failed.
+        for j in batch_indexes:
+          if j not in responded:
+            errors[requests_to_send[j][0]] = e
+    return [j for j in indexes if requests_to_send[j][2] and (
+        j not in responded
+        or _is_transient_error(errors.get(requests_to_send[j][0])))]
+
   def _update_ga_audiences(self):
-    """Updates and/or creates audiences in GA."""
+    """Updates and/or creates audiences in GA with batch HTTP requests.
+
+    Fingerprints of the audiences pushed are stored, failed audiences are
+    compared with GA again on the next run.
+
+    NB: only patches are sent again after a transient error, as inserts
+        which outcome is unknown would create duplicate audiences.
+    """
+    from core.models import AudienceFingerprint
+    audiences = self._ga_client.management().remarketingAudience()
+    requests_to_send = []
     for audience in self._audiences_to_insert:
-      request = self._ga_client.management().remarketingAudience().insert(
+      requests_to_send.append((audience['name'], audiences.insert(
           accountId=self._account_id,
           webPropertyId=self._params['property_id'],
-          body=audience)
-      self.retry(request.execute)()
+          body=audience), False))
     for audience_id in self._audiences_to_patch:
       audience = self._audiences_to_patch[audience_id]
-      request = self._ga_client.management().remarketingAudience().patch(
+      requests_to_send.append((audience['name'], audiences.patch(
           accountId=self._account_id,
           webPropertyId=self._params['property_id'],
           remarketingAudienceId=audience_id,
-          body=audience)
-      self.retry(request.execute)()
+          body=audience), True))
+    errors = {}
+    indexes = range(len(requests_to_send))
+    tries = 0
+    while True:
+      indexes = self._send_batches(requests_to_send, indexes, errors)
+      if not indexes or tries >= DEFAULT_MAX_RETRIES:
+        break
+      tries += 1
+      time.sleep(5 * 2 ** (tries + random()))
+    property_id = self._params['property_id']
+    AudienceFingerprint.store(property_id, dict(
+        (name, (audience_id, self._fingerprints[name]))
+        for name, audience_id in self._pushed_audiences.iteritems()))
+    self.log_info('%i audience(s) created or updated, %i failed.',
+                  len(requests_to_send) - len(errors), len(errors))
+    if errors:
+      AudienceFingerprint.forget(property_id, errors.keys())
+      name, error = sorted(errors.items())[0]
+      raise WorkerException('Failed to update %i audience(s), "%s": %s' % (
+          len(errors), name, error))
 
   def _execute(self):
     if self._params['account_id']:
@@ -769,6 +1608,7 @@ class GAAudiencesUpdater(BQWorker, GAWorker):
     self._table.reload()
     self._ga_setup('v3')
     self._infer_audiences()
+    self._get_fingerprints()
     self._get_audiences()
     self._get_diff()
     self._update_ga_audiences()
@@ -778,8 +1618,7 @@ class MLWorker(Worker):
   """Abstract ML Engine worker."""
 
   def _get_ml_client(self):
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(_KEY_FILE)
-    self._ml_client = build('ml', 'v1', credentials=credentials)
+    self._ml_client = clients.build_service('ml', 'v1')
 
   def _get_ml_job_id(self):
     self._ml_job_id = '%s_%i_%i_%s' % (self.__class__.__name__,
@@ -788,30 +1627,41 @@ class MLWorker(Worker):
 
 
 class MLWaiter(MLWorker):
-  """Worker that checks ML job status and respawns itself if job is running."""
+  """Worker that checks ML job status and hands running job over to poller.
+
+  NB: ML jobs are now tracked by the poller, this worker only completes waiter
+      tasks enqueued before.
+  """
 
   FINAL_STATUSES = ('STATE_UNSPECIFIED', 'SUCCEEDED', 'FAILED', 'CANCELLED')
 
   def _execute(self):
+    from core.models import ExternalOperation
     self._get_ml_client()
     request = self._ml_client.projects().jobs().get(
         name=self._params['job_name'])
     job = self.retry(request.execute)()
     if job.get('state') not in self.FINAL_STATUSES:
-      self._enqueue('MLWaiter', {'job_name': self._params['job_name']}, 60)
+      self._track_operation(ExternalOperation.KIND.ML_JOB,
+                            self._params['job_name'])
 
 class MLOperationWaiter(MLWorker):
-  """ Worker that checks an ML operation's status and respawns'
-  'itslef until the operation is done."""
+  """Worker that checks an ML operation's status and hands it over to poller
+  if the operation is not done.
+
+  NB: ML operations are now tracked by the poller, this worker only completes
+      waiter tasks enqueued before.
+  """
 
   def _execute(self):
+    from core.models import ExternalOperation
     self._get_ml_client()
     request = self._ml_client.projects().operations().get(
         name=self._params['operation_name'])
     operation = self.retry(request.execute)()
     if operation['done'] != True:
-      self._enqueue('MLOperationWaiter',
-                    {'operation_name': self._params['operation_name']}, 60)
+      self._track_operation(ExternalOperation.KIND.ML_OPERATION,
+                            self._params['operation_name'])
 
 class MLPredictor(MLWorker):
   """Worker to create ML batch prediction jobs."""
@@ -827,6 +1677,7 @@ class MLPredictor(MLWorker):
   ]
 
   def _execute(self):
+    from core.models import ExternalOperation
     project_id = 'projects/%s' % self._params['project']
     version_name = '%s/models/%s/versions/%s' % (
         project_id, self._params['model'], self._params['version'])
@@ -846,7 +1697,7 @@ class MLPredictor(MLWorker):
                                                        body=body)
     self.retry(request.execute)()
     job_name = '%s/jobs/%s' % (project_id, self._ml_job_id)
-    self._enqueue('MLWaiter', {'job_name': job_name}, 60)
+    self._track_operation(ExternalOperation.KIND.ML_JOB, job_name, delay=60)
 
 class MLTrainer(MLWorker):
   """Worker to train a ML model"""
@@ -869,6 +1720,7 @@ class MLTrainer(MLWorker):
        'Key in one line, value in the next.')
   ]
   def _execute(self):
+    from core.models import ExternalOperation
 
     self._get_ml_job_id()
     body = {
@@ -889,7 +1741,7 @@ class MLTrainer(MLWorker):
         parent=project_id, body=body)
     self.retry(request.execute)()
     job_name = '%s/jobs/%s' % (project_id, self._ml_job_id)
-    self._enqueue('MLWaiter', {'job_name': job_name}, 60)
+    self._track_operation(ExternalOperation.KIND.ML_JOB, job_name, delay=60)
 
 class MLVersionDeployer(MLWorker, StorageWorker):
   """Worker to deploy ML Model Version"""
@@ -911,6 +1763,7 @@ class MLVersionDeployer(MLWorker, StorageWorker):
   ]
 
   def _execute(self):
+    from core.models import ExternalOperation
     self._get_ml_job_id()
 
     # Find directory where newest saved model is located
@@ -941,7 +1794,8 @@ class MLVersionDeployer(MLWorker, StorageWorker):
     request = self._ml_client.projects().models().versions().create(
         parent=project_id + "/models/" + self._params['modelName'], body=body)
     response = self.retry(request.execute)()
-    self._enqueue('MLOperationWaiter', {'operation_name': response['name']}, 60)
+    self._track_operation(ExternalOperation.KIND.ML_OPERATION,
+                          response['name'], delay=60)
 
 
 class MeasurementProtocolException(WorkerException):
@@ -959,87 +1813,199 @@ class BQToMeasurementProtocol(BQWorker):
       ('mp_batch_size', 'number', True, 20, ('Measurement Protocol batch size '
                                              '(https://goo.gl/7VeWuB)')),
       ('debug', 'boolean', True, False, 'Debug mode'),
+      ('mp_concurrency', 'number', False, 10,
+       'Number of batch requests sent in parallel'),
   ]
 
   # BigQuery batch size for querying results. Default to 1000.
   BQ_BATCH_SIZE = int(1e3)
 
   # Maximum number of jobs to enqueued before spawning a new scheduler.
-  MAX_ENQUEUED_JOBS = 50
+  MAX_ENQUEUED_JOBS = 1000
 
   def _execute(self):
+    """Enqueues a processor for each range of BQ_BATCH_SIZE rows.
+
+    Ranges are computed from the number of rows of the table, so that the
+    scheduler doesn't read any data.
+
+    NB: the number of rows still in the streaming buffer of a table is only
+        an estimate, so processors are enqueued for each page of tables with
+        a streaming buffer, walking through their page tokens.
+    """
     self._bq_setup()
     self._table.reload()
-    page_token = self._params.get('bq_page_token', None)
-    batch_size = self.BQ_BATCH_SIZE
+    if self._params.get('bq_page_token'):
+      # Scheduler enqueued by a former version walking through page tokens.
+      self._enqueue_pages(self._params['bq_page_token'])
+      return
+    if (self._params.get('bq_start_index') is None
+        and _has_streaming_buffer(self._table)):
+      self._enqueue_pages(None)
+      return
+    num_rows = self._table.num_rows or 0
+    start_index = self._params.get('bq_start_index') or 0
+    enqueued_jobs_count = 0
+    while start_index < num_rows:
+      # Spawns a new job to schedule the remaining ranges.
+      if enqueued_jobs_count >= self.MAX_ENQUEUED_JOBS:
+        worker_params = self._params.copy()
+        worker_params['bq_start_index'] = start_index
+        self._enqueue(self.__class__.__name__, worker_params, 0)
+        return
+      worker_params = self._params.copy()
+      worker_params['bq_start_index'] = start_index
+      worker_params['bq_batch_size'] = self.BQ_BATCH_SIZE
+      self._enqueue('BQToMeasurementProtocolProcessor', worker_params, 0)
+      enqueued_jobs_count += 1
+      start_index += self.BQ_BATCH_SIZE
+
+  def _enqueue_pages(self, page_token):
     query_iterator = self.retry(self._table.fetch_data)(
-        max_results=batch_size,
+        max_results=self.BQ_BATCH_SIZE,
         page_token=page_token)
-
-    enqueued_jobs_count = 0
     for query_page in query_iterator.pages:  # pylint: disable=unused-variable
-      # Enqueue job for this page
       worker_params = self._params.copy()
       worker_params['bq_page_token'] = page_token
       worker_params['bq_batch_size'] = self.BQ_BATCH_SIZE
       self._enqueue('BQToMeasurementProtocolProcessor', worker_params, 0)
-      enqueued_jobs_count += 1
-
-      # Updates the page token reference for the next iteration.
       page_token = query_iterator.next_page_token
 
-      # Spawns a new job to schedule the remaining pages.
-      if (enqueued_jobs_count >= self.MAX_ENQUEUED_JOBS
-          and page_token is not None):
-        worker_params = self._params.copy()
-        worker_params['bq_page_token'] = page_token
-        self._enqueue(self.__class__.__name__, worker_params, 0)
-        return
 
+def _encode_value(value):
+  return urllib.quote_plus(unicode(value).encode('utf-8'))
 
-class BQToMeasurementProtocolProcessor(BQWorker):
-  """Worker pushing to Measurement Protocol the first page only of a query."""
 
-  def _flatten(self, data):
-    flat = False
-    while not flat:
-      flat = True
-      for k in data.keys():
-        if data[k] is None:
-          del data[k]
-        elif isinstance(data[k], list):
-          for i, v in enumerate(data[k]):
-            data['%s%i' % (k, i + 1)] = v
-          del data[k]
-          flat = False
-        elif isinstance(data[k], dict):
-          for l in data[k]:
-            data['%s%s' % (k, l)] = data[k][l]
-          del data[k]
-          flat = False
-
-  def _get_payload_from_data(self, data):
-    self._flatten(data)
-    payload = {'v': 1}  # Use version 1
-    payload.update(data)
-    return payload
-
-  def _prepare_payloads_for_batch_request(self, payloads):
-    """Merges payloads to send them in a batch request.
+def _flatten_into(key, value, pairs):
+  """Appends the (key, encoded value) pairs of a nested value, without nulls.
 
-    Args:
-        payloads: list of payload, each payload being a dictionary.
+  Items of lists are keyed by their 1-based index and items of dictionaries
+  by their key, both appended to the key of their parent.
+  """
+  if value is None:
+    return
+  if isinstance(value, list):
+    for i, item in enumerate(value):
+      _flatten_into('%s%i' % (key, i + 1), item, pairs)
+  elif isinstance(value, dict):
+    for name, item in value.iteritems():
+      _flatten_into(key + name, item, pairs)
+  else:
+    pairs.append((key, _encode_value(value)))
+
+
+def _compile_record(fields):
+  """Returns a function flattening values of a record with the given fields.
+
+  Subfields holding scalars are encoded directly, other ones are flattened
+  with _flatten_into.
+  """
+  scalars = []
+  nested = []
+  for field in fields:
+    if field.mode == 'REPEATED' or field.field_type == 'RECORD':
+      nested.append(field.name)
+    else:
+      scalars.append(field.name)
 
-    Returns:
-        Concatenated url-encoded payloads. For example:
+  def _flatten_record(key, record, pairs):
+    if record is None:
+      return
+    if not isinstance(record, dict):
+      _flatten_into(key, record, pairs)
+      return
+    for name in scalars:
+      value = record.get(name)
+      if value is not None:
+        pairs.append((key + name, _encode_value(value)))
+    for name in nested:
+      _flatten_into(key + name, record.get(name), pairs)
+  return _flatten_record
 
-          param1=value10&param2=value20
-          param1=value11&param2=value21
-    """
-    assert isinstance(payloads, (list, tuple))
-    payloads_utf8 = [sorted([(k, unicode(p[k]).encode('utf-8')) for k in p],
-                            key=lambda t: t[0]) for p in payloads]
-    return '\n'.join([urllib.urlencode(p) for p in payloads_utf8])
+
+def _compile_repeated_record(fields):
+  flatten_record = _compile_record(fields)
+
+  def _flatten_records(key, records, pairs):
+    if not isinstance(records, list):
+      _flatten_into(key, records, pairs)
+      return
+    for i, record in enumerate(records):
+      flatten_record('%s%i' % (key, i + 1), record, pairs)
+  return _flatten_records
+
+
+class MeasurementProtocolEncoder(object):
+  """Encodes query rows into url-encoded Measurement Protocol payloads.
+
+  The encoder is compiled once from the query schema. For tables of scalar
+  fields, the parameters of every row come in the same order, so they are
+  sorted and prefixed in advance, and a row is encoded by a single pass over
+  its values. Records and repeated fields are flattened by functions built for
+  their subfields into parameters named after their path, sorted afterwards.
+
+  NB: BigQuery field names only contain letters, digits and underscores, so
+      they don't need to be quoted.
+  """
+
+  # Measurement Protocol version, unless a field sets it.
+  VERSION = 1
+
+  def __init__(self, schema):
+    names = [field.name for field in schema]
+    self._version_index = names.index('v') if 'v' in names else None
+    self._nested = []
+    for i, field in enumerate(schema):
+      if field.field_type == 'RECORD' and field.mode == 'REPEATED':
+        self._nested.append((i, field.name, _compile_repeated_record(
+            field.fields)))
+      elif field.field_type == 'RECORD':
+        self._nested.append((i, field.name, _compile_record(field.fields)))
+      elif field.mode == 'REPEATED':
+        self._nested.append((i, field.name, _flatten_into))
+    self._scalars = [(i, name) for i, name in enumerate(names)
+                     if not any(i == n[0] for n in self._nested)]
+    # Sorted slots of scalar fields, as tuples of (index in rows, name
+    # followed by "=", encoded default value).
+    slots = [(name, i, '%s=' % name, None) for i, name in self._scalars
+             if name != 'v']
+    if self._version_index is None or not self._nested:
+      slots.append(('v', self._version_index, 'v=',
+                    _encode_value(self.VERSION)))
+    self._slots = [slot[1:] for slot in sorted(slots)]
+
+  def encode(self, row):
+    """Returns the payload of a row, parameters sorted by name."""
+    if self._nested:
+      return self._encode_nested(row)
+    parts = []
+    for index, prefix, default in self._slots:
+      value = row[index] if index is not None else None
+      if value is not None:
+        parts.append(prefix + _encode_value(value))
+      elif default is not None:
+        parts.append(prefix + default)
+    return '&'.join(parts)
+
+  def _encode_nested(self, row):
+    pairs = []
+    for index, name in self._scalars:
+      value = row[index]
+      if value is not None:
+        pairs.append((name, _encode_value(value)))
+    for index, name, flatten in self._nested:
+      flatten(name, row[index], pairs)
+    if self._version_index is None or row[self._version_index] is None:
+      pairs.append(('v', _encode_value(self.VERSION)))
+    pairs.sort(key=lambda pair: pair[0])
+    return '&'.join('%s=%s' % pair for pair in pairs)
+
+
+class BQToMeasurementProtocolProcessor(BQWorker):
+  """Worker pushing to Measurement Protocol the first page only of a query."""
+
+  # Number of batch requests sent in parallel, unless set in parameters.
+  DEFAULT_CONCURRENCY = 10
 
   def _send_batch_hits(self, batch_payload, user_agent='CRMint / 0.1'):
     """Sends a batch request to the Measurement Protocol endpoint.
@@ -1060,7 +2026,7 @@ class BQToMeasurementProtocolProcessor(BQWorker):
     headers = {'user-agent': user_agent}
     if self._debug:
       for payload in batch_payload.split('\n'):
-        response = requests.post(
+        response = self._session.post(
             'https://www.google-analytics.com/debug/collect',
             headers=headers,
             data=payload)
@@ -1072,17 +2038,17 @@ class BQToMeasurementProtocolProcessor(BQWorker):
           readable_payload = payload.replace('&', '\n')
           self.log_warn(message, readable_payload, response.text)
     else:
-      response = requests.post('https://www.google-analytics.com/batch',
-                               headers=headers,
-                               data=batch_payload)
+      response = self._session.post('https://www.google-analytics.com/batch',
+                                    headers=headers,
+                                    data=batch_payload)
 
       if response.status_code != requests.codes.ok:
         raise MeasurementProtocolException(
             'Failed to send event hit with status code (%s) and parameters: %s'
             % (response.status_code, batch_payload))
 
-  def _send_payload_list(self, payload_list):
-    batch_payload = self._prepare_payloads_for_batch_request(payload_list)
+  def _send_payloads(self, payloads):
+    batch_payload = '\n'.join(payloads)
     try:
       self.retry(self._send_batch_hits, max_retries=1)(batch_payload)
     except MeasurementProtocolException as e:
@@ -1090,31 +2056,50 @@ class BQToMeasurementProtocolProcessor(BQWorker):
       self.log_error(escaped_message)
 
   def _process_query_results(self, query_data, query_schema):
-    """Sends event hits from query data."""
-    fields = [f.name for f in query_schema]
-    payload_list = []
-    for row in query_data:
-      data = dict(zip(fields, row))
-      payload = self._get_payload_from_data(data)
-      payload_list.append(payload)
-      if len(payload_list) >= self._params['mp_batch_size']:
-        self._send_payload_list(payload_list)
-        payload_list = []
-    if payload_list:
-      # Sends remaining payloads.
-      self._send_payload_list(payload_list)
+    """Sends event hits from query data.
+
+    Batches are encoded while the previous ones are being sent, on up to
+    `mp_concurrency` threads sharing a pool of keep-alive connections.
+    """
+    encoder = MeasurementProtocolEncoder(query_schema)
+
+    def _batches():
+      payloads = []
+      for row in query_data:
+        payloads.append(encoder.encode(row))
+        if len(payloads) >= self._params['mp_batch_size']:
+          yield payloads
+          payloads = []
+      if payloads:
+        # Sends remaining payloads.
+        yield payloads
+
+    self._session = clients.get_http_session()
+    max_workers = int(self._params.get('mp_concurrency')
+                      or self.DEFAULT_CONCURRENCY)
+    errors = concurrency.run(self._send_payloads, _batches(), max_workers)
+    if errors:
+      _, error = errors[0]
+      raise error
 
   def _execute(self):
     self._bq_setup()
     self._table.reload()
     self._debug = self._params['debug']
-    page_token = self._params['bq_page_token'] or None
     batch_size = self._params['bq_batch_size']
-    query_iterator = self.retry(self._table.fetch_data)(
-        max_results=batch_size,
-        page_token=page_token)
-    query_first_page = next(query_iterator.pages)
-    self._process_query_results(query_first_page, query_iterator.schema)
+    start_index = self._params.get('bq_start_index')
+    if start_index is None:
+      # Processor enqueued by a former version of the scheduler.
+      page_token = self._params['bq_page_token'] or None
+      query_iterator = self.retry(self._table.fetch_data)(
+          max_results=batch_size,
+          page_token=page_token)
+      rows = next(query_iterator.pages)
+      self._process_query_results(rows, self._table.schema)
+    else:
+      reader = self._read_table(start_index=start_index,
+                                max_results=batch_size, batch_size=batch_size)
+      self._process_query_results(reader.rows(), reader.schema)
 
 
 class BQMLTrainer(BQWorker):
@@ -1149,19 +2134,16 @@ class AWWorker(Worker):
       if not name in self._params or not self._params[name]:
         raise WorkerException(
             "One or more AdWords API global parameters are missing.")
-    client_params_dict = {
-        'adwords': {
-            'client_customer_id': self._params['client_customer_id'].strip(),
-            'developer_token': self._params['developer_token'].strip(),
-            'client_id': self._params['client_id'].strip(),
-            'client_secret': self._params['client_secret'].strip(),
-            'refresh_token': self._params['google_ads_refresh_token'].strip(),
-        }
-    }
-    client_params_yaml = yaml.safe_dump(client_params_dict, encoding='utf-8',
-                                        allow_unicode=True)
-    self._aw_client = adwords.AdWordsClient.LoadFromString(client_params_yaml)
-    self._aw_client.cache = zeep.cache.InMemoryCache()
+    self._aw_client = clients.get_adwords_client({
+        'client_customer_id': self._params['client_customer_id'].strip(),
+        'developer_token': self._params['developer_token'].strip(),
+        'client_id': self._params['client_id'].strip(),
+        'client_secret': self._params['client_secret'].strip(),
+        'refresh_token': self._params['google_ads_refresh_token'].strip(),
+    })
+
+  def _get_aw_service(self, service_name, version):
+    return clients.get_adwords_service(self._aw_client, service_name, version)
 
 
 class BQToCM(AWWorker, BQWorker):
@@ -1220,6 +2202,15 @@ class BQToCM(AWWorker, BQWorker):
                   user_list['name'], user_list['id'])
     return user_list['id']
 
+  def _get_selected_fields(self):
+    """Returns the first field of the table, holding the list members."""
+    if not self._table.schema:
+      return None
+    return [self._table.schema[0].name]
+
+  def _get_row_filter(self):
+    return lambda row: row[0] is not None
+
   def _process_page(self, page_data):
     """Upload data fetched from BigQuery table to the Customer Match list."""
 
@@ -1235,8 +2226,8 @@ class BQToCM(AWWorker, BQWorker):
       return clean_obj if clean_obj else None
 
     members = [remove_nones(row[0]) for row in page_data]
-    user_list_service = self._aw_client.GetService('AdwordsUserListService',
-                                                   'v201809')
+    user_list_service = self._get_aw_service('AdwordsUserListService',
+                                             'v201809')
     user_list_id = self._get_user_list(user_list_service)
     # Flow control to keep calls within usage limits.
     self.log_info('Starting upload.')
@@ -1266,17 +2257,9 @@ class BQToCM(AWWorker, BQWorker):
     self._aw_setup()
     self._bq_setup()
     self._table.reload()
-    page_token = self._params.get('bq_page_token', None)
-    page_iterator = self.retry(self._table.fetch_data)(
-        max_results=self.BQ_BATCH_SIZE,
-        page_token=page_token)
-    page = next(page_iterator.pages)
-    self._process_page(page)
-    # Update the page token reference for the next iteration.
-    page_token = page_iterator.next_page_token
-    if page_token:
-      self._params['bq_page_token'] = page_token
-      self._enqueue(self.__class__.__name__, self._params, 0)
+    reader = self._read_task_rows(self.BQ_BATCH_SIZE)
+    self._process_page(list(reader.rows()))
+    self._enqueue_next_task(reader, self.BQ_BATCH_SIZE)
 
 
 class BQToAppConversionAPI(BQWorker):
@@ -1295,20 +2278,38 @@ class BQToAppConversionAPI(BQWorker):
                      'sdk_version', 'timestamp', 'link_id', 'app_event_type']
   OPTIONAL_PARAMS = ['value', 'app_event_name', 'currency_code', 'gclid']
   API_URL = 'https://www.googleadservices.com/pagead/conversion/app/1.0'
+  CROSS_NETWORK_API_URL = '%s/cross_network' % API_URL
   # BigQuery batch size for querying results. Default to 10000.
   BQ_BATCH_SIZE = int(10000)
+  # Maximum number of conversions sent in parallel.
+  MAX_CONCURRENT_REQUESTS = 16
+  # Maximum number of requests per second sent to each API endpoint.
+  MAX_REQUESTS_PER_SECOND = 100
+
+  class SEND_STATUS(object):
+    ATTRIBUTED = 'attributed'
+    NOT_ATTRIBUTED = 'not_attributed'
+    FAILED = 'failed'
+    CROSS_NETWORK_FAILED = 'cross_network_failed'
+    ALL = [ATTRIBUTED, NOT_ATTRIBUTED, FAILED, CROSS_NETWORK_FAILED]
+
+  def _post(self, url, headers, params, body):
+    self._rate_limiters[url].wait()
+    return self._session.post(url, headers=headers, params=params, json=body)
 
   def _send_api_requests(self, headers, params, body=None):
-    """Sends app conversion and cross-network attribution requests."""
-    response = requests.post(self.API_URL, headers=headers, params=params,
-                             json=body)
+    """Sends app conversion and cross-network attribution requests.
+
+    Returns: One of the SEND_STATUS values.
+    """
+    response = self._post(self.API_URL, headers, params, body)
     if response.status_code != requests.codes.ok:
       self.log_warn(
           'Failed to send app conversion request, status code %s.\n'
           '  Headers: %s\n  Parameters: %s\n  Body: %s'
           % (response.status_code, headers, params, body)
       )
-      return
+      return self.SEND_STATUS.FAILED
     result = json.loads(response.text)
     if not result['attributed']:
       self.log_warn(
@@ -1316,7 +2317,7 @@ class BQToAppConversionAPI(BQWorker):
           '  Headers: %s\n  Parameters: %s\n  Body: %s\n  Errors: %s'
           % (headers, params, body, result['errors'])
       )
-      return
+      return self.SEND_STATUS.NOT_ATTRIBUTED
 
     self.log_info(
         'App conversion was attributed to Google Ads.\n'
@@ -1326,47 +2327,93 @@ class BQToAppConversionAPI(BQWorker):
 
     params['ad_event_id'] = result['ad_events'][0]['ad_event_id']
     params['attributed'] = 1
-    response = requests.post('%s/cross_network' % self.API_URL,
-                             headers=headers, params=params, json=body)
+    response = self._post(self.CROSS_NETWORK_API_URL, headers, params, body)
     if response.status_code != requests.codes.ok:
       self.log_warn(
           'Failed to send cross-network attribution request, status code %s.\n'
           '  Headers: %s\n  Parameters: %s\n  Body: %s'
           % (response.status_code, headers, params, body)
       )
+      return self.SEND_STATUS.CROSS_NETWORK_FAILED
+    return self.SEND_STATUS.ATTRIBUTED
+
+  def _get_selected_fields(self):
+    """Returns the fields of the table mapped to request headers or params."""
+    names = set(self.HEADER_PARAMS + self.REQUIRED_PARAMS +
+                self.OPTIONAL_PARAMS + [self.BODY_PARAM])
+    return [f.name for f in self._table.schema if f.name in names]
+
+  def _make_conversion(self, row):
+    """Returns the (headers, params, body) tuple of the conversion of a row."""
+    headers = {'Content-Type': self.CONTENT_TYPE}
+    for param in self.HEADER_PARAMS:
+      if row[param] is not None:
+        headers[param.replace('_', '-')] = row[param]
+      else:
+        self.log_warn(
+            'Missing value for the required header "%s" in table "%s.%s"' % (
+                param.replace('_', '-'), self._params['bq_dataset_id'],
+                self._params['bq_table_id']))
+    params = {'dev_token': self._params['app_conversion_api_developer_token']}
+    for param in self.REQUIRED_PARAMS:
+      if row[param] is not None:
+        params[param] = row[param]
+      else:
+        self.log_warn(
+            'Missing value for the required param "%s" in table "%s.%s"' % (
+                param, self._params['bq_dataset_id'],
+                self._params['bq_table_id']))
+    for param in self.OPTIONAL_PARAMS:
+      if param in row and row[param] is not None:
+        params[param] = row[param]
+    if self.BODY_PARAM in row and row[self.BODY_PARAM] is not None:
+      body = {self.BODY_PARAM: row[self.BODY_PARAM]}
+    else:
+      body = None
+      headers['Content-Length'] = '0'
+    return headers, params, body
 
   def _process_page(self, page, fields):
-    """Send each row of a BQ table page as a single app conversion."""
-    for values in page:
-      row = dict(zip(fields, values))
-      headers = {'Content-Type': self.CONTENT_TYPE}
-      for param in self.HEADER_PARAMS:
-        if row[param] is not None:
-          headers[param.replace('_', '-')] = row[param]
-        else:
-          self.log_warn(
-              'Missing value for the required header "%s" in table "%s.%s"' % (
-                  param.replace('_', '-'), self._params['bq_dataset_id'],
-                  self._params['bq_table_id']))
-      params = {'dev_token': self._params['app_conversion_api_developer_token']}
-      for param in self.REQUIRED_PARAMS:
-        if row[param] is not None:
-          params[param] = row[param]
-        else:
-          self.log_warn(
-              'Missing value for the required param "%s" in table "%s.%s"' % (
-                  param, self._params['bq_dataset_id'],
-                  self._params['bq_table_id']))
-      for param in self.OPTIONAL_PARAMS:
-        if param in row and row[param] is not None:
-          params[param] = row[param]
-      if self.BODY_PARAM in row and row[self.BODY_PARAM] is not None:
-        body = {self.BODY_PARAM: row[self.BODY_PARAM]}
-      else:
-        body = None
-        headers['Content-Length'] = '0'
+    """Send each row of a BQ table page as a single app conversion.
 
-      self._send_api_requests(headers, params, body)
+    Conversions are sent concurrently over the pooled connections of a shared
+    session, and a summary of the page is logged once it's sent.
+    """
+    self._session = clients.get_http_session()
+    self._rate_limiters = {
+        self.API_URL: concurrency.RateLimiter(self.MAX_REQUESTS_PER_SECOND),
+        self.CROSS_NETWORK_API_URL: concurrency.RateLimiter(
+            self.MAX_REQUESTS_PER_SECOND),
+    }
+    conversions = [self._make_conversion(dict(zip(fields, values)))
+                   for values in page]
+
+    counts = dict((status, 0) for status in self.SEND_STATUS.ALL)
+    counts_lock = threading.Lock()
+
+    def _send(conversion):
+      status = self._send_api_requests(*conversion)
+      with counts_lock:
+        counts[status] += 1
+
+    started_at = time.time()
+    errors = concurrency.run(_send, conversions, self.MAX_CONCURRENT_REQUESTS)
+    duration = max(time.time() - started_at, 0.001)
+    sent_count = len(conversions) - len(errors)
+    self.log_info(
+        'Sent %i app conversions in %.1f seconds (%.1f rows/s): '
+        '%i attributed (%.1f%%), %i not attributed, %i failed, '
+        '%i cross-network attributions failed, %i errors',
+        sent_count, duration, sent_count / duration,
+        counts[self.SEND_STATUS.ATTRIBUTED],
+        100.0 * counts[self.SEND_STATUS.ATTRIBUTED] / max(sent_count, 1),
+        counts[self.SEND_STATUS.NOT_ATTRIBUTED],
+        counts[self.SEND_STATUS.FAILED],
+        counts[self.SEND_STATUS.CROSS_NETWORK_FAILED], len(errors))
+    if errors:
+      _, error = errors[0]
+      raise WorkerException('Failed to send %i app conversions: %s' % (
+          len(errors), error))
 
   def _execute(self):
     """Fetch a BQ table page, process it, schedule self for the next page."""
@@ -1375,24 +2422,15 @@ class BQToAppConversionAPI(BQWorker):
                             'specified in General Settings.')
     self._bq_setup()
     self._table.reload()
-    page_token = self._params.get('bq_page_token', None)
-    page_iterator = self.retry(self._table.fetch_data)(
-        max_results=self.BQ_BATCH_SIZE,
-        page_token=page_token)
-    fields = [field.name for field in page_iterator.schema]
+    reader = self._read_task_rows(self.BQ_BATCH_SIZE)
     for param in self.REQUIRED_PARAMS + self.HEADER_PARAMS:
-      if param not in fields:
+      if param not in reader.fields:
         raise WorkerException(
             'Required field "%s" not found in table "%s.%s"' % (
                 param, self._params['bq_dataset_id'],
                 self._params['bq_table_id']))
-    page = next(page_iterator.pages)
-    self._process_page(page, fields)
-    # Update the page token reference for the next iteration.
-    page_token = page_iterator.next_page_token
-    if page_token:
-      self._params['bq_page_token'] = page_token
-      self._enqueue(self.__class__.__name__, self._params, 0)
+    self._process_page(list(reader.rows()), reader.fields)
+    self._enqueue_next_task(reader, self.BQ_BATCH_SIZE)
 
 
 class AutoMLWorker(Worker):
@@ -1406,8 +2444,7 @@ class AutoMLWorker(Worker):
     # The reason is that the modern client libraries (e.g. google-cloud-automl)
     # are not supported on App Engine's Python 2 runtime.
     # See: https://github.com/googleapis/google-cloud-python
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(_KEY_FILE)
-    return build('automl', 'v1beta1', credentials=credentials)
+    return clients.build_service('automl', 'v1beta1')
 
   @staticmethod
   def _get_full_model_name(project, location, model):
@@ -1437,6 +2474,7 @@ class AutoMLPredictor(AutoMLWorker):
   ]
 
   def _execute(self):
+    from core.models import ExternalOperation
     # Construct the fully-qualified model name and config for the prediction.
     model_name = self._get_full_model_name(self._params['model_project_id'],
                                            self._params['model_location'],
@@ -1455,9 +2493,10 @@ class AutoMLPredictor(AutoMLWorker):
 
     # Since the batch prediction might take more than the 10 minutes the job
     # service has to serve a response to the Push Queue, we can't wait on it
-    # here. We thus spawn a worker that waits until the operation is completed.
+    # here. We thus hand it over to the poller until the operation is completed.
     operation_name = response.get('name')
-    self._enqueue('AutoMLWaiter', {'operation_name': operation_name}, 60)
+    self._track_operation(ExternalOperation.KIND.AUTOML_OPERATION,
+                          operation_name, delay=60)
 
   def _generate_input_config(self):
     """Constructs the input configuration for the batch prediction request."""
@@ -1485,9 +2524,14 @@ class AutoMLPredictor(AutoMLWorker):
 
 
 class AutoMLWaiter(AutoMLWorker):
-  """Worker that keeps respawning until an AutoML operation is completed."""
+  """Worker that checks an AutoML operation and hands it over to poller.
+
+  NB: AutoML operations are now tracked by the poller, this worker only
+      completes waiter tasks enqueued before.
+  """
 
   def _execute(self):
+    from core.models import ExternalOperation
     client = self._get_automl_client()
     operation_name = self._params['operation_name']
 
@@ -1501,4 +2545,5 @@ class AutoMLWaiter(AutoMLWorker):
         self.log_info('AutoML operation completed successfully: %s', response)
     else:
       self.log_info('AutoML operation still running: %s', response)
-      self._enqueue('AutoMLWaiter', self._params, 60)
+      self._track_operation(ExternalOperation.KIND.AUTOML_OPERATION,
+                            operation_name)
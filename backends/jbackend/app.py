@@ -53,7 +53,8 @@ def register_api_blueprints(api_blueprint):
 
 def register_blueprints(app):
   """Register Flask blueprints."""
-  from jbackend import cron, task, views
+  from jbackend import cron, poller, task, views
   app.register_blueprint(views.blueprint)
   app.register_blueprint(task.views.blueprint)
   app.register_blueprint(cron.views.blueprint)
+  app.register_blueprint(poller.views.blueprint)
@@ -0,0 +1,40 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Poller handler."""
+import logging
+
+from google.appengine.api import urlfetch
+
+from flask import Blueprint
+from flask_restful import Resource
+
+from core import poller
+from jbackend.extensions import api
+
+blueprint = Blueprint('poller', __name__)
+
+
+class Poller(Resource):
+  """Resource to handle GET requests from cron service."""
+
+  def get(self):
+    """Checks the external operations due to be checked now."""
+    urlfetch.set_default_fetch_deadline(300)
+    operations_count = poller.poll()
+    logging.info('Checked %i external operations', operations_count)
+    return 'OK', 200
+
+
+api.add_resource(Poller, '/poller')
@@ -59,25 +59,31 @@ class Task(Resource):
     for setting in worker_class.GLOBAL_SETTINGS:
         worker_params[setting] = GeneralSetting.where(name=setting).first().value
 
-    worker = worker_class(worker_params, job.pipeline_id, job.id)
+    worker = worker_class(worker_params, job.pipeline_id, job.id, task_name)
     if retries >= worker_class.MAX_ATTEMPTS:
       worker.log_error('Execution canceled after %i failed attempts', retries)
+      worker.flush_logs()
       job.task_failed(task_name)
     elif job.status == 'stopping':
       worker.log_warn('Execution canceled as parent job is going to stop')
+      worker.flush_logs()
       job.task_failed(task_name)
     else:
       try:
         workers_to_enqueue = worker.execute()
       except workers.WorkerException as e:
         worker.log_error('Execution failed: %s: %s', e.__class__.__name__, e)
+        worker.flush_logs()
         job.task_failed(task_name)
       except Exception as e:
         worker.log_error('Unexpected error: %s: %s', e.__class__.__name__, e)
+        worker.flush_logs()
         raise e
       else:
         for worker_class_name, worker_params, delay in workers_to_enqueue:
           job.enqueue(worker_class_name, worker_params, delay)
+        for kind, name, params, delay in worker.operations_to_track:
+          job.track_operation(args['worker_class'], kind, name, params, delay)
         job.task_succeeded(task_name)
     return 'OK', 200
 
@@ -0,0 +1,43 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add enqueued tasks count to jobs
+
+Revision ID: 3f1c5e9a2b7d
+Revises: 64e9670466d2
+Create Date: 2026-10-16 20:40:12.518233
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c5e9a2b7d'
+down_revision = '64e9670466d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.add_column('jobs', sa.Column('enqueued_tasks_count', sa.Integer(),
+                                  nullable=False, server_default='0'))
+  # Backfills the counter of jobs running while upgrading.
+  op.execute(
+      "UPDATE jobs SET enqueued_tasks_count = ("
+      "SELECT COUNT(*) FROM enqueued_tasks WHERE enqueued_tasks.task_namespace"
+      " = CONCAT('pipeline=', jobs.pipeline_id, '_job=', jobs.id))")
+
+def downgrade():
+  op.drop_column('jobs', 'enqueued_tasks_count')
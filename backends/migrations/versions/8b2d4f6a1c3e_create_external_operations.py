@@ -0,0 +1,61 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""create external operations
+
+Revision ID: 8b2d4f6a1c3e
+Revises: 3f1c5e9a2b7d
+Create Date: 2026-10-16 21:05:44.137902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2d4f6a1c3e'
+down_revision = '3f1c5e9a2b7d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table(
+      'external_operations',
+      sa.Column('created_at', sa.DateTime(), nullable=False),
+      sa.Column('updated_at', sa.DateTime(), nullable=False),
+      sa.Column('id', sa.Integer(), nullable=False),
+      sa.Column('job_id', sa.Integer(), nullable=True),
+      sa.Column('task_name', sa.String(length=100), nullable=True),
+      sa.Column('worker_class', sa.String(length=255), nullable=True),
+      sa.Column('kind', sa.String(length=50), nullable=False),
+      sa.Column('name', sa.String(length=255), nullable=False),
+      sa.Column('params', sa.Text(), nullable=True),
+      sa.Column('checks_count', sa.Integer(), nullable=False,
+                server_default='0'),
+      sa.Column('next_check_at', sa.DateTime(), nullable=True),
+      sa.ForeignKeyConstraint(['job_id'], ['jobs.id'], ),
+      sa.PrimaryKeyConstraint('id')
+  )
+  op.create_index(op.f('ix_external_operations_job_id'),
+                  'external_operations', ['job_id'], unique=False)
+  op.create_index(op.f('ix_external_operations_next_check_at'),
+                  'external_operations', ['next_check_at'], unique=False)
+
+def downgrade():
+  op.drop_index(op.f('ix_external_operations_next_check_at'),
+                table_name='external_operations')
+  op.drop_index(op.f('ix_external_operations_job_id'),
+                table_name='external_operations')
+  op.drop_table('external_operations')
@@ -0,0 +1,51 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""create audience fingerprints
+
+Revision ID: c7e3a9d2f5b1
+Revises: 8b2d4f6a1c3e
+Create Date: 2026-10-16 23:12:08.512304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e3a9d2f5b1'
+down_revision = '8b2d4f6a1c3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table(
+      'audience_fingerprints',
+      sa.Column('created_at', sa.DateTime(), nullable=False),
+      sa.Column('updated_at', sa.DateTime(), nullable=False),
+      sa.Column('id', sa.Integer(), nullable=False),
+      sa.Column('property_id', sa.String(length=50), nullable=False),
+      sa.Column('name', sa.String(length=255), nullable=False),
+      sa.Column('audience_id', sa.String(length=50), nullable=True),
+      sa.Column('fingerprint', sa.String(length=40), nullable=False),
+      sa.PrimaryKeyConstraint('id')
+  )
+  op.create_index(op.f('ix_audience_fingerprints_property_id'),
+                  'audience_fingerprints', ['property_id'], unique=False)
+
+def downgrade():
+  op.drop_index(op.f('ix_audience_fingerprints_property_id'),
+                table_name='audience_fingerprints')
+  op.drop_table('audience_fingerprints')
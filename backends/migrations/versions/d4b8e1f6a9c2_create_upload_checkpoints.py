@@ -0,0 +1,54 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""create upload checkpoints
+
+Revision ID: d4b8e1f6a9c2
+Revises: c7e3a9d2f5b1
+Create Date: 2026-10-16 23:41:27.086519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4b8e1f6a9c2'
+down_revision = 'c7e3a9d2f5b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table(
+      'upload_checkpoints',
+      sa.Column('created_at', sa.DateTime(), nullable=False),
+      sa.Column('updated_at', sa.DateTime(), nullable=False),
+      sa.Column('id', sa.Integer(), nullable=False),
+      sa.Column('job_id', sa.Integer(), nullable=True),
+      sa.Column('source_uri', sa.Text(), nullable=False),
+      sa.Column('source_etag', sa.String(length=255), nullable=True),
+      sa.Column('session_uri', sa.Text(), nullable=False),
+      sa.Column('offset', sa.BigInteger(), nullable=False),
+      sa.Column('chunk_size', sa.Integer(), nullable=False),
+      sa.ForeignKeyConstraint(['job_id'], ['jobs.id'], ),
+      sa.PrimaryKeyConstraint('id')
+  )
+  op.create_index(op.f('ix_upload_checkpoints_job_id'),
+                  'upload_checkpoints', ['job_id'], unique=False)
+
+def downgrade():
+  op.drop_index(op.f('ix_upload_checkpoints_job_id'),
+                table_name='upload_checkpoints')
+  op.drop_table('upload_checkpoints')
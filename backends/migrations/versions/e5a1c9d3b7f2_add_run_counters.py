@@ -0,0 +1,55 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""add run counters
+
+Revision ID: e5a1c9d3b7f2
+Revises: d4b8e1f6a9c2
+Create Date: 2026-10-17 10:12:45.203718
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a1c9d3b7f2'
+down_revision = 'd4b8e1f6a9c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.add_column('jobs', sa.Column('pending_predecessors_count', sa.Integer(),
+                                  nullable=False, server_default='0'))
+  op.add_column('pipelines', sa.Column('active_jobs_count', sa.Integer(),
+                                       nullable=False, server_default='0'))
+  # Backfills the counters of pipelines running while upgrading.
+  op.execute(
+      "UPDATE jobs SET pending_predecessors_count = ("
+      "SELECT COUNT(*) FROM start_conditions"
+      " JOIN (SELECT id, status FROM jobs) AS preceding_jobs"
+      " ON preceding_jobs.id = start_conditions.preceding_job_id"
+      " WHERE start_conditions.job_id = jobs.id"
+      " AND preceding_jobs.status NOT IN ('succeeded', 'failed'))"
+      " WHERE jobs.status = 'waiting'")
+  op.execute(
+      "UPDATE pipelines SET active_jobs_count = ("
+      "SELECT COUNT(*) FROM jobs WHERE jobs.pipeline_id = pipelines.id"
+      " AND jobs.status NOT IN ('idle', 'succeeded', 'failed'))"
+      " WHERE pipelines.status = 'running'")
+
+def downgrade():
+  op.drop_column('pipelines', 'active_jobs_count')
+  op.drop_column('jobs', 'pending_predecessors_count')
@@ -0,0 +1,110 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of the queries issued to render the params of a pipeline run.
+
+Compares the number of SQL statements and the latency of the former per-job
+loading of params with the run snapshot, for pipelines of 10, 100 and 500
+jobs with two params each:
+
+  $ python runtests.py ~/google-cloud-sdk --test-path tests/benchmarks \\
+      --test-pattern '*_benchmark.py'
+"""
+
+import os
+import sys
+import time
+
+from sqlalchemy import event
+
+from core import inline
+from core import models
+from core import scheduler
+
+sys.path.insert(0, os.getcwd())
+from tests import utils
+
+
+PIPELINE_SIZES = [10, 100, 500]
+
+
+def _legacy_populate(pipeline):
+  global_context = {}
+  for param in models.Param.where(pipeline_id=None, job_id=None).all():
+    global_context[param.name] = inline.Evaluator().render(param.value)
+  pipeline_context = global_context.copy()
+  for param in pipeline.params.all():
+    pipeline_context[param.name] = inline.Evaluator(
+        global_context).render(param.value)
+  for job in pipeline.jobs.all():
+    for param in job.params.all():
+      param.update(runtime_value=inline.Evaluator(
+          pipeline_context).render(param.value))
+  return dict((job.id, dict((p.name, p.worker_value) for p in job.params))
+              for job in pipeline.jobs.all())
+
+
+def _snapshot_populate(pipeline):
+  snapshot = scheduler.RunSnapshot.load(pipeline)
+  pipeline.populate_params_runtime_values(snapshot)
+  return snapshot.worker_params
+
+
+class TestPipelineStartBenchmark(utils.ModelTestCase):
+
+  def setUp(self):
+    super(TestPipelineStartBenchmark, self).setUp()
+    self._statements_count = 0
+    event.listen(self._engine, 'before_cursor_execute', self._count)
+
+  def tearDown(self):
+    event.remove(self._engine, 'before_cursor_execute', self._count)
+    super(TestPipelineStartBenchmark, self).tearDown()
+
+  def _count(self, *args):
+    self._statements_count += 1
+
+  def _create_pipeline(self, jobs_count):
+    models.Param.create(name='g', type='string', value='global')
+    pipeline = models.Pipeline.create(name='pipeline%i' % jobs_count)
+    models.Param.create(pipeline_id=pipeline.id, name='p', type='string',
+                        value='{% g %}_pipeline')
+    for i in range(jobs_count):
+      job = models.Job.create(name='job%i' % i, pipeline_id=pipeline.id)
+      models.Param.create(job_id=job.id, name='s', type='string',
+                          value='{%% p %%}/%i' % i)
+      models.Param.create(job_id=job.id, name='n', type='number',
+                          value='{%% %i * 2 %%}' % i)
+    return pipeline
+
+  def _measure(self, populate, pipeline):
+    self._statements_count = 0
+    start = time.time()
+    worker_params = populate(pipeline)
+    return worker_params, self._statements_count, time.time() - start
+
+  def test_pipeline_sizes(self):
+    for jobs_count in PIPELINE_SIZES:
+      pipeline = self._create_pipeline(jobs_count)
+      before, before_count, before_time = self._measure(
+          _legacy_populate, pipeline)
+      after, after_count, after_time = self._measure(
+          _snapshot_populate, pipeline)
+      self.assertEqual(after, before)
+      print('\n%i jobs: %i queries in %.3fs before, %i queries in %.3fs '
+            'after' % (jobs_count, before_count, before_time, after_count,
+                       after_time))
+      models.Param.query.delete()
+      models.Job.query.delete()
+      models.Pipeline.query.delete()
@@ -17,6 +17,7 @@ from google.appengine.ext import testbed
 import mock
 
 from core import models
+from core import scheduler
 
 import os
 import sys
@@ -24,6 +25,22 @@ sys.path.insert(0, os.getcwd())
 from tests import utils
 
 
+def _start(pipeline):
+  """Gets a pipeline ready and starts its first jobs as Pipeline.start does."""
+  snapshot = scheduler.RunSnapshot.load(pipeline)
+  if not pipeline.get_ready(snapshot):
+    return False
+  scheduler.start_pipeline(pipeline, snapshot)
+  return True
+
+
+def _task_name(job):
+  """Returns the name of the only task enqueued for a job."""
+  enqueued_task, = models.TaskEnqueued.where(
+      task_namespace=job._get_task_namespace())
+  return enqueued_task.task_name
+
+
 class TestPipelineWithJobs(utils.ModelTestCase):
 
   def setUp(self):
@@ -212,21 +229,13 @@ class TestPipelineWithJobs(utils.ModelTestCase):
     job1 = models.Job.create(pipeline_id=pipeline.id)
     job2 = models.Job.create(pipeline_id=pipeline.id)
 
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job1.status, models.Job.STATUS.WAITING)
-    self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-
-    task1 = job1.start()
-    self.assertIsNotNone(task1)
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job1._enqueued_task_count(), 1)
-
-    task2 = job2.start()
-    self.assertIsNotNone(task2)
     self.assertEqual(job2.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job2._enqueued_task_count(), 1)
 
-    job2.task_failed(task2.name)
+    job2.task_failed(_task_name(job2))
     self.assertEqual(job2.status, models.Job.STATUS.FAILED)
 
     # It should trigger the end of the pipeline by itself
@@ -341,9 +350,7 @@ class TestJobStartedStatus(utils.ModelTestCase):
   def test_succeeds_status_running(self):
     pipeline = models.Pipeline.create()
     job = models.Job.create(pipeline_id=pipeline.id)
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job.status, models.Job.STATUS.WAITING)
-    self.assertTrue(job.start())
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
 
 
@@ -486,22 +493,17 @@ class TestJobStartConditions(utils.ModelTestCase):
   def test_fails_if_running(self):
     pipeline = models.Pipeline.create()
     job = models.Job.create(pipeline_id=pipeline.id)
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job.status, models.Job.STATUS.WAITING)
-    task1 = job.start()
-    self.assertIsNotNone(task1)
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
-    task2 = job.start()
-    self.assertIsNone(task2)
+    self.assertFalse(_start(pipeline))
+    self.assertEqual(job._enqueued_task_count(), 1)
 
   def test_succeeds_if_waiting_without_start_conditions(self):
     pipeline = models.Pipeline.create()
     job = models.Job.create(pipeline_id=pipeline.id)
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job.status, models.Job.STATUS.WAITING)
-    task = job.start()
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
-    self.assertIsNotNone(task)
+    self.assertEqual(job._enqueued_task_count(), 1)
 
   def test_succeeds_with_start_condition_fulfill_success_with_succeeded(self):
     pipeline = models.Pipeline.create()
@@ -511,13 +513,10 @@ class TestJobStartConditions(utils.ModelTestCase):
         job_id=job2.id,
         preceding_job_id=job1.id,
         condition='success')
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job1.status, models.Job.STATUS.WAITING)
-    self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    task1 = job1.start()
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    job1.task_succeeded(task1.name)
+    job1.task_succeeded(_task_name(job1))
     self.assertEqual(job1.status, models.Job.STATUS.SUCCEEDED)
     self.assertEqual(job2.status, models.Job.STATUS.RUNNING)
 
@@ -529,13 +528,10 @@ class TestJobStartConditions(utils.ModelTestCase):
         job_id=job2.id,
         preceding_job_id=job1.id,
         condition=models.StartCondition.CONDITION.SUCCESS)
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job1.status, models.Job.STATUS.WAITING)
-    self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    task1 = job1.start()
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    job1.task_failed(task1.name)
+    job1.task_failed(_task_name(job1))
     self.assertEqual(job1.status, models.Job.STATUS.FAILED)
     self.assertEqual(job2.status, models.Job.STATUS.FAILED)
 
@@ -547,13 +543,10 @@ class TestJobStartConditions(utils.ModelTestCase):
         job_id=job2.id,
         preceding_job_id=job1.id,
         condition=models.StartCondition.CONDITION.FAIL)
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job1.status, models.Job.STATUS.WAITING)
-    self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    task1 = job1.start()
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    job1.task_failed(task1.name)
+    job1.task_failed(_task_name(job1))
     self.assertEqual(job1.status, models.Job.STATUS.FAILED)
     self.assertEqual(job2.status, models.Job.STATUS.RUNNING)
     self.assertNotEqual(pipeline.status, models.Pipeline.STATUS.FAILED)
@@ -566,13 +559,10 @@ class TestJobStartConditions(utils.ModelTestCase):
         job_id=job2.id,
         preceding_job_id=job1.id,
         condition='fail')
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job1.status, models.Job.STATUS.WAITING)
-    self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    task1 = job1.start()
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    job1.task_succeeded(task1.name)
+    job1.task_succeeded(_task_name(job1))
     self.assertEqual(job1.status, models.Job.STATUS.SUCCEEDED)
     self.assertEqual(job2.status, models.Job.STATUS.FAILED)
 
@@ -584,13 +574,10 @@ class TestJobStartConditions(utils.ModelTestCase):
         job_id=job2.id,
         preceding_job_id=job1.id,
         condition=models.StartCondition.CONDITION.WHATEVER)
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job1.status, models.Job.STATUS.WAITING)
-    self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    task1 = job1.start()
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    job1.task_failed(task1.name)
+    job1.task_failed(_task_name(job1))
     self.assertEqual(job1.status, models.Job.STATUS.FAILED)
     self.assertEqual(job2.status, models.Job.STATUS.RUNNING)
 
@@ -602,13 +589,10 @@ class TestJobStartConditions(utils.ModelTestCase):
         job_id=job2.id,
         preceding_job_id=job1.id,
         condition=models.StartCondition.CONDITION.WHATEVER)
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job1.status, models.Job.STATUS.WAITING)
-    self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    task1 = job1.start()
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    job1.task_succeeded(task1.name)
+    job1.task_succeeded(_task_name(job1))
     self.assertEqual(job1.status, models.Job.STATUS.SUCCEEDED)
     self.assertEqual(job2.status, models.Job.STATUS.RUNNING)
 
@@ -620,14 +604,10 @@ class TestJobStartConditions(utils.ModelTestCase):
         job_id=job2.id,
         preceding_job_id=job1.id,
         condition=models.StartCondition.CONDITION.WHATEVER)
-    self.assertTrue(pipeline.get_ready())
-    task1 = job1.start()
-    self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
-    self.assertEqual(job2.status, models.Job.STATUS.WAITING)
-    task2 = job2.start()
-    self.assertIsNone(task2)
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job2.status, models.Job.STATUS.WAITING)
+    self.assertEqual(job2._enqueued_task_count(), 0)
 
 
 class TestJobStopConditions(utils.ModelTestCase):
@@ -665,19 +645,15 @@ class TestJobStopConditions(utils.ModelTestCase):
   def test_stop_succeeds_with_running(self):
     pipeline = models.Pipeline.create()
     job1 = models.Job.create(pipeline_id=pipeline.id)
-    self.assertTrue(pipeline.get_ready())
-    task1 = job1.start()
-    self.assertIsNotNone(task1)
+    self.assertTrue(_start(pipeline))
     self.assertTrue(job1.stop())
     self.assertEqual(job1.status, models.Job.STATUS.STOPPING)
 
   def test_stop_succeeds_with_outdated_tasks(self):
     pipeline = models.Pipeline.create()
     job1 = models.Job.create(pipeline_id=pipeline.id)
-    self.assertTrue(pipeline.get_ready())
-    task1 = job1.start()
-    self.assertIsNotNone(task1)
-    taskqueue.Queue().delete_tasks([taskqueue.Task(name=task1.name)])
+    self.assertTrue(_start(pipeline))
+    taskqueue.Queue().delete_tasks([taskqueue.Task(name=_task_name(job1))])
     self.assertTrue(job1.stop())
     self.assertEqual(job1.status, models.Job.STATUS.STOPPING)
 
@@ -709,13 +685,11 @@ class TestJobStartWithDependentJobs(utils.ModelTestCase):
         job_id=job3.id,
         preceding_job_id=job2.id,
         condition=models.StartCondition.CONDITION.SUCCESS)
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job1.status, models.Job.STATUS.WAITING)
+    self.assertTrue(_start(pipeline))
+    self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job2.status, models.Job.STATUS.WAITING)
     self.assertEqual(job3.status, models.Job.STATUS.WAITING)
-    task = job1.start()
-    self.assertIsNotNone(task)
-    job1.task_failed(task.name)
+    job1.task_failed(_task_name(job1))
     self.assertEqual(job1.status, models.Job.STATUS.FAILED)
     self.assertEqual(job2.status, models.Job.STATUS.FAILED)
     self.assertEqual(job3.status, models.Job.STATUS.FAILED)
@@ -733,15 +707,11 @@ class TestJobStartWithDependentJobs(utils.ModelTestCase):
         job_id=job3.id,
         preceding_job_id=job2.id,
         condition=models.StartCondition.CONDITION.SUCCESS)
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job1.status, models.Job.STATUS.WAITING)
+    self.assertTrue(_start(pipeline))
+    self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job2.status, models.Job.STATUS.WAITING)
     self.assertEqual(job3.status, models.Job.STATUS.WAITING)
-    task1 = job1.start()
-    self.assertIsNotNone(task1)
-    job1.task_succeeded(task1.name)
-    task2 = job2.start()
-    self.assertIsNone(task2)
+    job1.task_succeeded(_task_name(job1))
     self.assertEqual(job2.status, models.Job.STATUS.FAILED)
     self.assertEqual(job3.status, models.Job.STATUS.FAILED)
 
@@ -758,18 +728,14 @@ class TestJobStartWithDependentJobs(utils.ModelTestCase):
         job_id=job3.id,
         preceding_job_id=job2.id,
         condition=models.StartCondition.CONDITION.SUCCESS)
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job1.status, models.Job.STATUS.WAITING)
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job2.status, models.Job.STATUS.WAITING)
     self.assertEqual(job3.status, models.Job.STATUS.WAITING)
-    task1 = job1.start()
+    task1_name = _task_name(job1)
     task2 = job1.enqueue(job1.worker_class, {})
-    self.assertIsNotNone(task1)
-    job1.task_succeeded(task1.name)
+    job1.task_succeeded(task1_name)
     job1.task_failed(task2.name)
     self.assertEqual(job1.status, models.Job.STATUS.FAILED)
-    task3 = job2.start()
-    self.assertIsNone(task3)
     self.assertEqual(job2.status, models.Job.STATUS.RUNNING)
     self.assertEqual(job3.status, models.Job.STATUS.WAITING)
 
@@ -792,14 +758,12 @@ class TestJobStartingMultipleTasks(utils.ModelTestCase):
     pipeline = models.Pipeline.create()
     job = models.Job.create(pipeline_id=pipeline.id)
     worker_params = dict([(p.name, p.val) for p in job.params])
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job.status, models.Job.STATUS.WAITING)
-    task1 = job.start()
-    self.assertIsNotNone(task1)
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
+    task1_name = _task_name(job)
     task2 = job.enqueue(job.worker_class, worker_params)
     self.assertIsNotNone(task2)
-    job.task_succeeded(task1.name)
+    job.task_succeeded(task1_name)
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
     job.task_succeeded(task2.name)
     self.assertEqual(job.status, models.Job.STATUS.SUCCEEDED)
@@ -813,9 +777,8 @@ class TestJobStartingMultipleTasks(utils.ModelTestCase):
         job_id=job2.id,
         preceding_job_id=job1.id,
         condition=models.StartCondition.CONDITION.SUCCESS)
-    pipeline.get_ready()
-    task1 = job1.start()
-    job1.task_failed(task1.name)
+    self.assertTrue(_start(pipeline))
+    job1.task_failed(_task_name(job1))
     self.assertTrue(job1.status, models.Job.STATUS.FAILED)
     self.assertTrue(job2.status, models.Job.STATUS.STOPPING)
     self.assertEqual(pipeline.status, models.Pipeline.STATUS.FAILED)
@@ -824,16 +787,14 @@ class TestJobStartingMultipleTasks(utils.ModelTestCase):
     pipeline = models.Pipeline.create()
     job = models.Job.create(pipeline_id=pipeline.id)
     worker_params = dict([(p.name, p.val) for p in job.params])
-    self.assertTrue(pipeline.get_ready())
-    self.assertEqual(job.status, models.Job.STATUS.WAITING)
-    task1 = job.start()
-    self.assertIsNotNone(task1)
+    self.assertTrue(_start(pipeline))
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
+    task1_name = _task_name(job)
     task2 = job.enqueue(job.worker_class, worker_params)
     task3 = job.enqueue(job.worker_class, worker_params)
     self.assertIsNotNone(task2)
     self.assertIsNotNone(task3)
-    job.task_succeeded(task1.name)
+    job.task_succeeded(task1_name)
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
     job.task_succeeded(task3.name)
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
@@ -47,10 +47,11 @@ class TestTaskCreation(utils.JBackendBaseTest):
     #     testbed service available for now
     patched_logger.log_struct.__name__ = 'foo'
     patched_logger.log_struct.return_value = 'patched_log_struct'
+    patched_logger.batch.return_value.commit.__name__ = 'foo'
     pipeline = models.Pipeline.create()
     job = models.Job.create(pipeline_id=pipeline.id)
     self.assertTrue(job.get_ready())
-    task = job.start()
+    task = job.start_as_single()
     self.assertIsNotNone(task)
     data = dict(
         job_id=job.id,
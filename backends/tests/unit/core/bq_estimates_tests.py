@@ -0,0 +1,110 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import mock
+
+from core import bq_estimates
+
+
+def _job(statistics):
+  job = mock.Mock()
+  job._properties = {'statistics': statistics}
+  return job
+
+
+class TestProgress(unittest.TestCase):
+
+  def test_no_plan(self):
+    self.assertIsNone(bq_estimates.progress(_job({})))
+
+  def test_counts_completed_inputs_of_every_stage(self):
+    job = _job({'query': {'queryPlan': [
+        {'status': 'COMPLETE', 'parallelInputs': '10',
+         'completedParallelInputs': '10'},
+        {'status': 'RUNNING', 'parallelInputs': '10',
+         'completedParallelInputs': '5'},
+        {'status': 'PENDING', 'parallelInputs': '20'},
+    ]}})
+    self.assertEqual(bq_estimates.progress(job), 0.375)
+
+
+class TestEstimates(unittest.TestCase):
+
+  def test_estimate_remaining_from_progress(self):
+    job = _job({'query': {'queryPlan': [
+        {'status': 'RUNNING', 'parallelInputs': '4',
+         'completedParallelInputs': '1'}]}})
+    self.assertEqual(bq_estimates.estimate_remaining(job, 2), 6)
+    self.assertEqual(bq_estimates.estimate_remaining(job, 2, 4), 4)
+
+  def test_estimate_remaining_from_history(self):
+    self.assertEqual(bq_estimates.estimate_remaining(_job({}), 2, 12), 10)
+    self.assertIsNone(bq_estimates.estimate_remaining(_job({}), 2))
+
+  def test_estimate_remaining_ignores_history_once_overrun(self):
+    self.assertIsNone(bq_estimates.estimate_remaining(_job({}), 12, 10))
+    job = _job({'query': {'queryPlan': [
+        {'status': 'RUNNING', 'parallelInputs': '4',
+         'completedParallelInputs': '2'}]}})
+    self.assertEqual(bq_estimates.estimate_remaining(job, 12, 10), 12)
+
+  def test_next_delay(self):
+    self.assertEqual(bq_estimates.next_delay(0, None), 0.5)
+    self.assertEqual(bq_estimates.next_delay(4, None), 4)
+    self.assertEqual(bq_estimates.next_delay(0, 0.2), 0.5)
+    self.assertEqual(bq_estimates.next_delay(0, 3600), 30)
+
+  def test_duration(self):
+    job = _job({'startTime': '1000', 'endTime': '3500'})
+    self.assertEqual(bq_estimates.duration(job), 2.5)
+    self.assertIsNone(bq_estimates.duration(_job({})))
+
+
+class TestHistory(unittest.TestCase):
+
+  @mock.patch('core.bq_estimates._get_memcache', return_value=None)
+  def test_record_duration_averages_runs(self, _):
+    key = bq_estimates.fingerprint('BQQueryLauncher', mock.Mock(query='x'))
+    self.assertIsNone(bq_estimates.get_expected_duration(key))
+    bq_estimates.record_duration(key, 10)
+    bq_estimates.record_duration(key, 20)
+    self.assertEqual(bq_estimates.get_expected_duration(key), 15)
+
+  def test_fingerprint_ignores_whitespace(self):
+    self.assertEqual(
+        bq_estimates.fingerprint(
+            'W', mock.Mock(spec=['query'], query='SELECT  1\n')),
+        bq_estimates.fingerprint(
+            'W', mock.Mock(spec=['query'], query='SELECT 1')))
+
+  def test_fingerprint_encodes_non_ascii_queries(self):
+    key = bq_estimates.fingerprint(
+        'W', mock.Mock(spec=['query'], query=u'SELECT "caf\xe9"'))
+    self.assertEqual(len(key), 40)
+
+  def test_fingerprint_tells_extract_jobs_apart(self):
+    def _extract_job(table_id, destination_uri):
+      table = mock.Mock(spec=['project', 'dataset_name', 'name'],
+                        project='project', dataset_name='dataset')
+      table.name = table_id
+      return mock.Mock(spec=['source', 'destination_uris'], source=table,
+                       destination_uris=[destination_uri])
+    self.assertNotEqual(
+        bq_estimates.fingerprint('W', _extract_job('t1', 'gs://b/t1.csv')),
+        bq_estimates.fingerprint('W', _extract_job('t2', 'gs://b/t2.csv')))
+    self.assertEqual(
+        bq_estimates.fingerprint('W', _extract_job('t1', 'gs://b/t1.csv')),
+        bq_estimates.fingerprint('W', _extract_job('t1', 'gs://b/t1.csv')))
@@ -0,0 +1,175 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+import unittest
+
+from google.appengine.ext import testbed
+import mock
+
+from core import clients
+
+
+class TestBigQueryClients(unittest.TestCase):
+
+  def setUp(self):
+    super(TestBigQueryClients, self).setUp()
+    app_data = mock.Mock(SA_DATA={'project_id': 'sa-project'})
+    patcher_app_data = mock.patch.dict(sys.modules,
+                                       {'core.app_data': app_data})
+    self.addCleanup(patcher_app_data.stop)
+    patcher_app_data.start()
+    patcher_credentials = mock.patch(
+        'google.oauth2.service_account.Credentials.from_service_account_info')
+    self.addCleanup(patcher_credentials.stop)
+    self._patched_credentials = patcher_credentials.start()
+    patcher_client = mock.patch('google.cloud.bigquery.Client')
+    self.addCleanup(patcher_client.stop)
+    self._patched_client = patcher_client.start()
+    patcher_cache = mock.patch.multiple(clients, _CREDENTIALS={},
+                                        _LOCAL=threading.local())
+    self.addCleanup(patcher_cache.stop)
+    patcher_cache.start()
+
+  def test_client_is_reused_for_same_project(self):
+    client1 = clients.get_bigquery_client('project1')
+    client2 = clients.get_bigquery_client('project1')
+    self.assertIs(client1, client2)
+    self._patched_client.assert_called_once()
+    self._patched_credentials.assert_called_once()
+
+  def test_client_is_not_shared_between_threads(self):
+    self._patched_client.side_effect = lambda **kwargs: mock.Mock()
+    client1 = clients.get_bigquery_client('project1')
+    other_clients = []
+    thread = threading.Thread(target=lambda: other_clients.append(
+        clients.get_bigquery_client('project1')))
+    thread.start()
+    thread.join()
+    self.assertIsNot(client1, other_clients[0])
+    self._patched_credentials.assert_called_once()
+
+  def test_credentials_are_shared_between_projects(self):
+    clients.get_bigquery_client('project1')
+    clients.get_bigquery_client('project2')
+    self.assertEqual(self._patched_client.call_count, 2)
+    self._patched_credentials.assert_called_once()
+
+  def test_client_defaults_to_service_account_project(self):
+    clients.get_bigquery_client('')
+    self.assertEqual(self._patched_client.call_args[1]['project'],
+                     'sa-project')
+
+
+class TestDiscoveryServices(unittest.TestCase):
+
+  def setUp(self):
+    super(TestDiscoveryServices, self).setUp()
+    patcher_build = mock.patch('googleapiclient.discovery.build')
+    self.addCleanup(patcher_build.stop)
+    self._patched_build = patcher_build.start()
+    patcher_local = mock.patch.object(clients, '_LOCAL', mock.Mock(spec=[]))
+    self.addCleanup(patcher_local.stop)
+    patcher_local.start()
+    self._credentials = mock.Mock()
+
+  def test_service_is_reused_for_same_api_and_version(self):
+    service1 = clients.build_service('ml', 'v1', self._credentials)
+    service2 = clients.build_service('ml', 'v1', self._credentials)
+    self.assertIs(service1, service2)
+    self._patched_build.assert_called_once()
+
+  def test_service_is_built_for_another_version(self):
+    clients.build_service('analytics', 'v3', self._credentials)
+    clients.build_service('analytics', 'v4', self._credentials)
+    self.assertEqual(self._patched_build.call_count, 2)
+
+
+class TestDiscoveryCache(unittest.TestCase):
+
+  @mock.patch('googleapiclient.discovery_cache.autodetect')
+  def test_document_is_served_from_memory(self, patched_autodetect):
+    fallback = mock.Mock()
+    fallback.get.return_value = '{"name": "ml"}'
+    patched_autodetect.return_value = fallback
+    cache = clients.DiscoveryCache()
+    self.assertEqual(cache.get('url'), '{"name": "ml"}')
+    self.assertEqual(cache.get('url'), '{"name": "ml"}')
+    fallback.get.assert_called_once_with('url')
+
+  @mock.patch('googleapiclient.discovery_cache.autodetect')
+  def test_expired_document_is_fetched_again(self, patched_autodetect):
+    fallback = mock.Mock()
+    fallback.get.return_value = None
+    patched_autodetect.return_value = fallback
+    cache = clients.DiscoveryCache(ttl=-1)
+    cache.set('url', '{"name": "ml"}')
+    self.assertIsNone(cache.get('url'))
+    fallback.set.assert_called_once_with('url', '{"name": "ml"}')
+
+
+class TestAdWordsClients(unittest.TestCase):
+
+  def setUp(self):
+    super(TestAdWordsClients, self).setUp()
+    patcher_load = mock.patch(
+        'googleads.adwords.AdWordsClient.LoadFromString')
+    self.addCleanup(patcher_load.stop)
+    self._patched_load = patcher_load.start()
+    self._patched_load.side_effect = lambda _: mock.Mock()
+    patcher_cache = mock.patch.multiple(clients, _ADWORDS_CLIENTS={})
+    self.addCleanup(patcher_cache.stop)
+    patcher_cache.start()
+    self.params = {'client_customer_id': '123-456-7890',
+                   'refresh_token': 'token'}
+
+  def test_client_is_reused_for_same_customer_and_credentials(self):
+    client1 = clients.get_adwords_client(self.params)
+    client2 = clients.get_adwords_client(dict(self.params))
+    self.assertIs(client1, client2)
+    self._patched_load.assert_called_once()
+    self.assertIsInstance(client1.cache, clients.WSDLCache)
+
+  def test_client_differs_by_credentials(self):
+    client1 = clients.get_adwords_client(self.params)
+    client2 = clients.get_adwords_client(
+        dict(self.params, refresh_token='other'))
+    self.assertIsNot(client1, client2)
+
+  def test_service_is_built_once_per_thread(self):
+    client = clients.get_adwords_client(self.params)
+    service1 = clients.get_adwords_service(client, 'UserListService', 'v1')
+    service2 = clients.get_adwords_service(client, 'UserListService', 'v1')
+    self.assertIs(service1, service2)
+    client.GetService.assert_called_once_with('UserListService', 'v1')
+
+
+class TestWSDLCache(unittest.TestCase):
+
+  def setUp(self):
+    super(TestWSDLCache, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+
+  def tearDown(self):
+    super(TestWSDLCache, self).tearDown()
+    self.testbed.deactivate()
+
+  def test_documents_are_shared_through_memcache(self):
+    clients.WSDLCache().add('https://example.com/a.wsdl', '<wsdl/>')
+    cache = clients.WSDLCache()
+    self.assertEqual(cache.get('https://example.com/a.wsdl'), '<wsdl/>')
+    self.assertIsNone(cache.get('https://example.com/b.wsdl'))
@@ -0,0 +1,56 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from core import concurrency
+
+
+def _producer(name, count):
+  def _produce():
+    for i in range(count):
+      yield (name, i)
+  return _produce
+
+
+class TestStream(unittest.TestCase):
+
+  def test_yields_items_in_producers_order(self):
+    items = list(concurrency.stream(
+        [_producer('a', 3), _producer('b', 0), _producer('c', 2)],
+        max_workers=2, buffer_size=1))
+    self.assertEqual(items, [('a', 0), ('a', 1), ('a', 2), ('c', 0), ('c', 1)])
+
+  def test_raises_producer_errors(self):
+    def _failing():
+      yield 1
+      raise ValueError('listing failed')
+    with self.assertRaises(ValueError):
+      list(concurrency.stream([_failing, _producer('a', 1)], max_workers=2))
+
+
+class TestRun(unittest.TestCase):
+
+  def test_calls_function_on_every_item(self):
+    results = []
+    errors = concurrency.run(results.append, iter(range(10)), max_workers=3)
+    self.assertEqual(errors, [])
+    self.assertEqual(sorted(results), range(10))
+
+  def test_returns_failed_items(self):
+    def _fail_on_odd(item):
+      if item % 2:
+        raise ValueError(item)
+    errors = concurrency.run(_fail_on_odd, range(4), max_workers=2)
+    self.assertEqual(sorted(item for item, _ in errors), [1, 3])
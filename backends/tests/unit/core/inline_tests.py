@@ -12,9 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+import time
 import unittest
 
 from freezegun import freeze_time
+from google.cloud.bigquery.schema import SchemaField
+import mock
+from simpleeval import InvalidExpression
 
 from core import inline
 
@@ -48,3 +53,87 @@ class TestFunctions(unittest.TestCase):
   def test_inline_function_days_since(self):
     func = inline.functions['days_since']
     self.assertEqual(func('2018-03-29', '%Y-%m-%d'), 3)
+
+
+class TestEvaluator(unittest.TestCase):
+
+  def test_render_replaces_inliners(self):
+    evaluator = inline.Evaluator({'x': 2})
+    self.assertEqual(evaluator.render('{% x * 3 %}-{% x %}'), '6-2')
+    self.assertEqual(evaluator.render('{% True %}'), 'True')
+
+  def test_values_are_parsed_once(self):
+    value = '{% 1 + 1 %} and {% 2 + 2 %}'
+    compiled = inline.compile_value(value)
+    self.assertEqual([e for _, e, _ in compiled], [' 1 + 1 ', ' 2 + 2 '])
+    self.assertIs(inline.compile_value(value), compiled)
+
+  def test_render_raises_on_unknown_names(self):
+    with self.assertRaises(InvalidExpression):
+      inline.Evaluator().render('{% unknown %}')
+
+
+class TestBigQueryFunction(unittest.TestCase):
+
+  def setUp(self):
+    super(TestBigQueryFunction, self).setUp()
+    patcher_client = mock.patch('core.clients.get_bigquery_client')
+    self.addCleanup(patcher_client.stop)
+    self.patched_get_client = patcher_client.start()
+    client = self.patched_get_client.return_value
+    client.project = 'project'
+    self.table = client.dataset.return_value.table.return_value
+    self.table.schema = [SchemaField('name', 'STRING'),
+                         SchemaField('ids', 'INTEGER', mode='REPEATED')]
+    self.table.modified = 1
+    self.table.fetch_data.return_value = iter([('crmint', [1, 2])])
+    patcher_cache = mock.patch.multiple(inline, _BIGQUERY_CACHE={},
+                                        _get_memcache=lambda: None)
+    self.addCleanup(patcher_cache.stop)
+    patcher_cache.start()
+    inline.open_session()
+    self.addCleanup(inline.close_session)
+
+  def test_reads_first_row_of_table(self):
+    self.assertEqual(inline.functions['bigquery']('dataset.table', 'name'),
+                     'crmint')
+    self.assertEqual(inline.functions['bigquery']('dataset.table', 'ids'),
+                     '1\n2')
+    self.table.fetch_data.assert_called_once()
+
+  def test_rows_are_reused_across_runs(self):
+    inline.functions['bigquery']('dataset.table', 'name')
+    inline.close_session()
+    inline.open_session()
+    self.assertEqual(inline.functions['bigquery']('dataset.table', 'name'),
+                     'crmint')
+    self.table.reload.assert_called_once()
+
+  def test_unmodified_table_is_not_read_again(self):
+    inline.functions['bigquery']('dataset.table', 'name')
+    inline.close_session()
+    inline.open_session()
+    with mock.patch('time.time', return_value=time.time() + 3600):
+      inline.functions['bigquery']('dataset.table', 'name')
+    self.assertEqual(self.table.reload.call_count, 2)
+    self.table.fetch_data.assert_called_once()
+
+  def test_prefetch_reads_with_clients_of_its_threads(self):
+    threads = []
+    client = self.patched_get_client.return_value
+    def _get_client(project_id):
+      threads.append(threading.current_thread())
+      return client
+    self.patched_get_client.side_effect = _get_client
+    inline.prefetch(['{% bigquery("dataset.table1", "name") %}',
+                     '{% bigquery("dataset.table2", "name") %}'])
+    self.assertEqual(len(threads), 2)
+    self.assertNotIn(threading.current_thread(), threads)
+
+  def test_prefetch_reads_referenced_tables(self):
+    inline.prefetch(['{% bigquery("dataset.table", "name") %}', 'plain',
+                     '{% bigquery( %}', None])
+    self.table.fetch_data.assert_called_once()
+    self.assertEqual(inline.Evaluator().render(
+        '{% bigquery("dataset.table", "name") %}'), 'crmint')
+    self.table.fetch_data.assert_called_once()
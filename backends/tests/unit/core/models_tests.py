@@ -13,7 +13,9 @@
 # limitations under the License.
 
 from google.appengine.ext import testbed
+import mock
 from core import models
+from core import scheduler
 
 import os
 import sys
@@ -143,6 +145,45 @@ class TestPipeline(utils.ModelTestCase):
     self.assertEqual(success, True)
     self.assertEqual(p5.runtime_value, 'foo baz goo zaz')
 
+  def test_get_ready_moves_all_jobs_to_waiting(self):
+    pipeline = models.Pipeline.create(name='pipeline1')
+    job1 = models.Job.create(name='job1', pipeline_id=pipeline.id)
+    job2 = models.Job.create(name='job2', pipeline_id=pipeline.id,
+                             status=models.Job.STATUS.FAILED)
+    self.assertTrue(pipeline.get_ready())
+    self.assertEqual(models.Job.find(job1.id).status,
+                     models.Job.STATUS.WAITING)
+    self.assertEqual(models.Job.find(job2.id).status,
+                     models.Job.STATUS.WAITING)
+    self.assertEqual(pipeline.status, models.Pipeline.STATUS.RUNNING)
+
+  def test_get_ready_fails_with_an_active_job(self):
+    pipeline = models.Pipeline.create(name='pipeline1')
+    models.Job.create(name='job1', pipeline_id=pipeline.id)
+    models.Job.create(name='job2', pipeline_id=pipeline.id,
+                      status=models.Job.STATUS.RUNNING)
+    self.assertFalse(pipeline.get_ready())
+    self.assertEqual(pipeline.status, models.Pipeline.STATUS.IDLE)
+
+  def test_stop_moves_active_jobs_to_failed(self):
+    pipeline = models.Pipeline.create(status=models.Pipeline.STATUS.RUNNING)
+    waiting = models.Job.create(pipeline_id=pipeline.id,
+                                status=models.Job.STATUS.WAITING)
+    succeeded = models.Job.create(pipeline_id=pipeline.id,
+                                  status=models.Job.STATUS.SUCCEEDED)
+    models.TaskEnqueued.create(task_namespace=waiting._get_task_namespace(),
+                               task_name='task1')
+    with mock.patch('google.appengine.api.taskqueue.Queue.delete_tasks') \
+        as patched_delete_tasks:
+      self.assertTrue(pipeline.stop())
+    patched_delete_tasks.assert_called_once()
+    self.assertEqual(models.Job.find(waiting.id).status,
+                     models.Job.STATUS.FAILED)
+    self.assertEqual(models.Job.find(succeeded.id).status,
+                     models.Job.STATUS.SUCCEEDED)
+    self.assertEqual(models.TaskEnqueued.query.count(), 0)
+
+
 class TestJob(utils.ModelTestCase):
 
   def setUp(self):
@@ -157,6 +198,62 @@ class TestJob(utils.ModelTestCase):
     super(TestJob, self).tearDown()
     self.testbed.deactivate()
 
+  def test_bulk_set_pipeline_status_only_moves_guarded_jobs(self):
+    pipeline = models.Pipeline.create(name='pipeline1')
+    job1 = models.Job.create(name='job1', pipeline_id=pipeline.id)
+    job2 = models.Job.create(name='job2', pipeline_id=pipeline.id,
+                             status=models.Job.STATUS.RUNNING)
+    other_pipeline = models.Pipeline.create(name='pipeline2')
+    job3 = models.Job.create(name='job3', pipeline_id=other_pipeline.id)
+    changed_ids = models.Job.bulk_set_pipeline_status(
+        pipeline.id, models.Job.STATUS.WAITING, [models.Job.STATUS.IDLE])
+    self.assertEqual(changed_ids, [job1.id])
+    self.assertEqual(models.Job.find(job2.id).status,
+                     models.Job.STATUS.RUNNING)
+    self.assertEqual(models.Job.find(job3.id).status, models.Job.STATUS.IDLE)
+
+  def test_destroy_deletes_tracked_operations(self):
+    pipeline = models.Pipeline.create(name='pipeline1')
+    job = models.Job.create(name='job1', pipeline_id=pipeline.id,
+                            status=models.Job.STATUS.RUNNING)
+    job.track_operation('BQWaiter', 'bigquery_job', 'job1')
+    job.destroy()
+    self.assertEqual(models.ExternalOperation.query.count(), 0)
+
+  def test_destroy_deletes_upload_checkpoints(self):
+    pipeline = models.Pipeline.create(name='pipeline1')
+    job = models.Job.create(name='job1', pipeline_id=pipeline.id)
+    models.UploadCheckpoint.create(job_id=job.id, source_uri='gs://b/f.csv',
+                                   session_uri='https://upload', offset=0,
+                                   chunk_size=262144)
+    job.destroy()
+    self.assertEqual(models.UploadCheckpoint.query.count(), 0)
+
+  def test_stop_sees_job_finished_during_transition(self):
+    pipeline = models.Pipeline.create(status=models.Pipeline.STATUS.RUNNING)
+    job = models.Job.create(pipeline_id=pipeline.id,
+                            status=models.Job.STATUS.RUNNING)
+    bulk_set_pipeline_status = models.Job.bulk_set_pipeline_status
+    def _finish_job_first(*args):
+      models.Job.query.filter(models.Job.id == job.id).update(
+          {'status': models.Job.STATUS.SUCCEEDED},
+          synchronize_session=False)
+      return bulk_set_pipeline_status(*args)
+    with mock.patch.object(models.Job, 'bulk_set_pipeline_status',
+                           side_effect=_finish_job_first):
+      self.assertTrue(pipeline.stop())
+    self.assertEqual(models.Job.find(job.id).status,
+                     models.Job.STATUS.SUCCEEDED)
+
+  def test_stop_deletes_tracked_operations(self):
+    pipeline = models.Pipeline.create(name='pipeline1')
+    job = models.Job.create(name='job1', pipeline_id=pipeline.id,
+                            status=models.Job.STATUS.RUNNING)
+    job.track_operation('BQWaiter', 'bigquery_job', 'job1')
+    with mock.patch('google.appengine.api.taskqueue.Queue.delete_tasks'):
+      self.assertTrue(job.stop())
+    self.assertEqual(models.ExternalOperation.query.count(), 0)
+
   def test_job_succeeds_get_ready_with_pipeline_parameter(self):
     pipeline = models.Pipeline.create()
     models.Param.create(
@@ -193,7 +290,7 @@ class TestJob(utils.ModelTestCase):
     self.assertEqual(job.status, models.Job.STATUS.IDLE)
     self.assertTrue(job.get_ready())
     self.assertEqual(job.status, models.Job.STATUS.WAITING)
-    task = job.start()
+    task = job.start_as_single()
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
     job.task_succeeded(task.name)
     self.assertEqual(job.status, models.Job.STATUS.SUCCEEDED)
@@ -204,12 +301,129 @@ class TestJob(utils.ModelTestCase):
         pipeline_id=pipeline.id)
     self.assertTrue(job.get_ready())
     self.assertEqual(job.status, models.Job.STATUS.WAITING)
-    task = job.start()
+    task = job.start_as_single()
     self.assertIsNotNone(task)
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
     job.task_failed(task.name)
     self.assertEqual(job.status, models.Job.STATUS.FAILED)
 
+  def test_enqueue_tracks_task_before_adding_it(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id,
+                            status=models.Job.STATUS.RUNNING)
+    counts = []
+    def _add(**kwargs):
+      counts.append(job._enqueued_task_count())
+      return mock.Mock()
+    with mock.patch('google.appengine.api.taskqueue.add', side_effect=_add):
+      job.enqueue(job.worker_class, {})
+    self.assertEqual(counts, [1])
+
+  def test_enqueue_untracks_task_if_adding_it_fails(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id,
+                            status=models.Job.STATUS.RUNNING)
+    with mock.patch('google.appengine.api.taskqueue.add',
+                    side_effect=ValueError('boom')):
+      with self.assertRaises(ValueError):
+        job.enqueue(job.worker_class, {})
+    self.assertEqual(job._enqueued_task_count(), 0)
+    self.assertEqual(models.TaskEnqueued.query.count(), 0)
+
+  def test_enqueued_tasks_count_is_decremented_once_per_task(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    self.assertTrue(job.get_ready())
+    task1 = job.start_as_single()
+    task2 = job.enqueue(job.worker_class, {})
+    self.assertEqual(job._enqueued_task_count(), 2)
+    self.assertFalse(job._task_completed(task1.name))
+    self.assertEqual(job._enqueued_task_count(), 1)
+    # A retried completion of the same task must not decrement the counter.
+    self.assertFalse(job._task_completed(task1.name))
+    self.assertEqual(job._enqueued_task_count(), 1)
+    self.assertTrue(job._task_completed(task2.name))
+    self.assertEqual(job._enqueued_task_count(), 0)
+    # Nor observe again that it was the last task.
+    self.assertIsNone(job._task_completed(task2.name))
+
+  def test_failure_of_completed_task_keeps_job_status(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    self.assertTrue(job.get_ready())
+    task = job.start_as_single()
+    job.task_succeeded(task.name)
+    self.assertEqual(models.Job.find(job.id).status,
+                     models.Job.STATUS.SUCCEEDED)
+    job.task_failed(task.name)
+    self.assertEqual(models.Job.find(job.id).status,
+                     models.Job.STATUS.SUCCEEDED)
+
+  def test_dependent_job_starts_after_all_preceding_jobs_succeeded(self):
+    pipeline = models.Pipeline.create()
+    job1 = models.Job.create(pipeline_id=pipeline.id)
+    job2 = models.Job.create(pipeline_id=pipeline.id)
+    job3 = models.Job.create(pipeline_id=pipeline.id)
+    for preceding_job in [job1, job2]:
+      models.StartCondition.create(
+          job_id=job3.id,
+          preceding_job_id=preceding_job.id,
+          condition=models.StartCondition.CONDITION.SUCCESS)
+    self.assertTrue(pipeline.start())
+    self.assertEqual(job1.status, models.Job.STATUS.RUNNING)
+    self.assertEqual(job2.status, models.Job.STATUS.RUNNING)
+    self.assertEqual(job3.status, models.Job.STATUS.WAITING)
+    task1 = models.TaskEnqueued.where(
+        task_namespace=job1._get_task_namespace()).first()
+    job1.task_succeeded(task1.task_name)
+    self.assertEqual(job3.status, models.Job.STATUS.WAITING)
+    task2 = models.TaskEnqueued.where(
+        task_namespace=job2._get_task_namespace()).first()
+    job2.task_succeeded(task2.task_name)
+    self.assertEqual(job3.status, models.Job.STATUS.RUNNING)
+    self.assertEqual(pipeline.status, models.Pipeline.STATUS.RUNNING)
+
+  def test_blocked_successor_stops_running_jobs(self):
+    pipeline = models.Pipeline.create()
+    job1 = models.Job.create(pipeline_id=pipeline.id)
+    job2 = models.Job.create(pipeline_id=pipeline.id)
+    job3 = models.Job.create(pipeline_id=pipeline.id)
+    models.StartCondition.create(
+        job_id=job3.id,
+        preceding_job_id=job1.id,
+        condition=models.StartCondition.CONDITION.SUCCESS)
+    self.assertTrue(pipeline.start())
+    job1.set_status(models.Job.STATUS.FAILED)
+    with mock.patch('google.appengine.api.taskqueue.Queue.delete_tasks') \
+        as patched_delete_tasks:
+      self.assertTrue(scheduler.job_finished(job1))
+    patched_delete_tasks.assert_called()
+    self.assertEqual(models.Job.find(job2.id).status,
+                     models.Job.STATUS.FAILED)
+    self.assertEqual(models.Job.find(job3.id).status,
+                     models.Job.STATUS.FAILED)
+    self.assertEqual(models.Pipeline.find(pipeline.id).status,
+                     models.Pipeline.STATUS.FAILED)
+
+  def test_run_counters_follow_finished_jobs(self):
+    pipeline = models.Pipeline.create()
+    job1 = models.Job.create(pipeline_id=pipeline.id)
+    job2 = models.Job.create(pipeline_id=pipeline.id)
+    models.StartCondition.create(
+        job_id=job2.id,
+        preceding_job_id=job1.id,
+        condition=models.StartCondition.CONDITION.SUCCESS)
+    self.assertTrue(pipeline.start())
+    self.assertEqual(models.Pipeline.find(pipeline.id).active_jobs_count, 2)
+    self.assertEqual(models.Job.find(job2.id).pending_predecessors_count, 1)
+    task1 = models.TaskEnqueued.where(
+        task_namespace=job1._get_task_namespace()).first()
+    job1.task_succeeded(task1.task_name)
+    self.assertEqual(models.Pipeline.find(pipeline.id).active_jobs_count, 1)
+    self.assertEqual(models.Job.find(job2.id).pending_predecessors_count, 0)
+    self.assertEqual(models.Job.find(job2.id).status,
+                     models.Job.STATUS.RUNNING)
+
   def test_save_relations(self):
     pipeline = models.Pipeline.create()
     job0 = models.Job.create(pipeline_id=pipeline.id)
@@ -241,8 +455,12 @@ class TestParam(utils.ModelTestCase):
 class TestParamSupportsType(utils.ModelTestCase):
 
   def _setup_parent_job(self):
-    pipeline = models.Pipeline.create(name='pipeline1')
-    self.job = models.Job.create(name='job1', pipeline_id=pipeline.id)
+    self.pipeline = models.Pipeline.create(name='pipeline1')
+    self.job = models.Job.create(name='job1', pipeline_id=self.pipeline.id)
+
+  def _populate_runtime_value(self, param):
+    self.assertTrue(self.pipeline.populate_params_runtime_values())
+    return models.Param.find(param.id)
 
 class TestParamSupportsTypeBoolean(TestParamSupportsType):
 
@@ -250,21 +468,21 @@ class TestParamSupportsTypeBoolean(TestParamSupportsType):
     self._setup_parent_job()
     param = models.Param.create(
         job_id=self.job.id, name='p1', type='boolean', value='1')
-    param.populate_runtime_value()
+    param = self._populate_runtime_value(param)
     self.assertEqual(param.worker_value, True)
 
   def test_worker_value_succeeds_false(self):
     self._setup_parent_job()
     param = models.Param.create(
         job_id=self.job.id, name='p1', type='boolean', value='0')
-    param.populate_runtime_value()
+    param = self._populate_runtime_value(param)
     self.assertEqual(param.worker_value, False)
 
   def test_worker_value_fails_random_string(self):
     self._setup_parent_job()
     param = models.Param.create(
         job_id=self.job.id, name='p1', type='boolean', value='abc')
-    param.populate_runtime_value()
+    param = self._populate_runtime_value(param)
     self.assertEqual(param.worker_value, False)
 
   def test_api_value_succeeds_true(self):
@@ -286,7 +504,7 @@ class TestParamSupportsTypeString(TestParamSupportsType):
     self._setup_parent_job()
     param = models.Param.create(
         job_id=self.job.id, name='p1', type='string', value='hello world!')
-    param.populate_runtime_value()
+    param = self._populate_runtime_value(param)
     self.assertIsInstance(param.worker_value, str)
     self.assertEqual(param.worker_value, 'hello world!')
 
@@ -303,7 +521,7 @@ class TestParamSupportsTypeNumber(TestParamSupportsType):
     self._setup_parent_job()
     param = models.Param.create(
         job_id=self.job.id, name='p1', type='number', value='3')
-    param.populate_runtime_value()
+    param = self._populate_runtime_value(param)
     self.assertIsInstance(param.worker_value, int)
     self.assertEqual(param.worker_value, 3)
 
@@ -311,7 +529,7 @@ class TestParamSupportsTypeNumber(TestParamSupportsType):
     self._setup_parent_job()
     param = models.Param.create(
         job_id=self.job.id, name='p1', type='number', value='5.1')
-    param.populate_runtime_value()
+    param = self._populate_runtime_value(param)
     self.assertIsInstance(param.worker_value, float)
     self.assertEqual(param.worker_value, 5.1)
 
@@ -319,7 +537,7 @@ class TestParamSupportsTypeNumber(TestParamSupportsType):
     self._setup_parent_job()
     param = models.Param.create(
         job_id=self.job.id, name='p1', type='number', value='abc')
-    param.populate_runtime_value()
+    param = self._populate_runtime_value(param)
     self.assertEqual(param.worker_value, 0)
 
   def test_api_value_succeeds_with_integer(self):
@@ -341,7 +559,7 @@ class TestParamSupportsTypeStringList(TestParamSupportsType):
     self._setup_parent_job()
     param = models.Param.create(job_id=self.job.id, name='p1',
                                 type='string_list', value='foo\nbar\njohn')
-    param.populate_runtime_value()
+    param = self._populate_runtime_value(param)
     self.assertIsInstance(param.worker_value, list)
     self.assertEqual(len(param.worker_value), 3)
     self.assertEqual(param.worker_value[0], 'foo')
@@ -355,7 +573,7 @@ class TestParamSupportsTypeNumberList(TestParamSupportsType):
     self._setup_parent_job()
     param = models.Param.create(job_id=self.job.id, name='p1',
                                 type='number_list', value='1\n3\n2.8')
-    param.populate_runtime_value()
+    param = self._populate_runtime_value(param)
     self.assertIsInstance(param.worker_value, list)
     self.assertEqual(len(param.worker_value), 3)
     self.assertEqual(param.worker_value[0], 1)
@@ -366,24 +584,80 @@ class TestParamSupportsTypeNumberList(TestParamSupportsType):
 class TestParamRuntimeValues(utils.ModelTestCase):
 
   def test_global_param_runtime_value_is_populated_with_null(self):
+    pipeline = models.Pipeline.create(name='pipeline1')
     param = models.Param.create(name='p1', type='number', value='42')
-    param.populate_runtime_value()
-    self.assertEqual(param.runtime_value, None)
+    self.assertTrue(pipeline.populate_params_runtime_values())
+    self.assertEqual(models.Param.find(param.id).runtime_value, None)
 
   def test_pipeline_param_runtime_value_is_populated_with_null(self):
     pipeline = models.Pipeline.create(name='pipeline1')
     param = models.Param.create(pipeline_id=pipeline.id, name='p1',
                                 type='number', value='42')
-    param.populate_runtime_value()
-    self.assertEqual(param.runtime_value, None)
+    self.assertTrue(pipeline.populate_params_runtime_values())
+    self.assertEqual(models.Param.find(param.id).runtime_value, None)
 
   def test_job_param_runtime_value_is_populated_with_value(self):
     pipeline = models.Pipeline.create(name='pipeline1')
     job = models.Job.create(name='job1', pipeline_id=pipeline.id)
     param = models.Param.create(job_id=job.id, name='p1',
                                 type='number', value='42')
-    param.populate_runtime_value()
-    self.assertEqual(param.runtime_value, '42')
+    self.assertTrue(pipeline.populate_params_runtime_values())
+    self.assertEqual(models.Param.find(param.id).runtime_value, '42')
+
+  def test_pipeline_populates_job_params_with_variables(self):
+    models.Param.create(name='g', type='string', value='global')
+    pipeline = models.Pipeline.create(name='pipeline1')
+    models.Param.create(pipeline_id=pipeline.id, name='p', type='string',
+                        value='{% g %}_pipeline')
+    job = models.Job.create(name='job1', pipeline_id=pipeline.id)
+    param1 = models.Param.create(job_id=job.id, name='p1', type='string',
+                                 value='{% p %}/{% g %}')
+    param2 = models.Param.create(job_id=job.id, name='p2', type='number',
+                                 value='{% 6 * 7 %}')
+    self.assertTrue(pipeline.populate_params_runtime_values())
+    self.assertEqual(models.Param.find(param1.id).runtime_value,
+                     'global_pipeline/global')
+    self.assertEqual(models.Param.find(param2.id).runtime_value, '42')
+
+  def test_pipeline_keeps_worker_params_in_snapshot(self):
+    pipeline = models.Pipeline.create(name='pipeline1')
+    job = models.Job.create(name='job1', pipeline_id=pipeline.id)
+    models.Param.create(job_id=job.id, name='n', type='number',
+                        value='{% 6 * 7 %}')
+    models.Param.create(job_id=job.id, name='l', type='string_list',
+                        value='a\nb')
+    snapshot = scheduler.RunSnapshot.load(pipeline)
+    self.assertTrue(pipeline.populate_params_runtime_values(snapshot))
+    self.assertEqual(snapshot.worker_params, {job.id: {'n': 42,
+                                                       'l': ['a', 'b']}})
+
+  def test_pipeline_fails_on_invalid_expression(self):
+    pipeline = models.Pipeline.create(name='pipeline1')
+    job = models.Job.create(name='job1', pipeline_id=pipeline.id)
+    models.Param.create(job_id=job.id, name='p1', type='string',
+                        value='{% unknown %}')
+    with mock.patch('core.cloud_logging.logger') as patched_logger:
+      self.assertFalse(pipeline.populate_params_runtime_values())
+    patched_logger.log_struct.assert_called_once()
+
+  def test_pipeline_fails_on_null_value_of_first_param(self):
+    models.Param.create(name='g', type='string', value=None)
+    pipeline = models.Pipeline.create(name='pipeline1')
+    job = models.Job.create(name='job1', pipeline_id=pipeline.id)
+    models.Param.create(job_id=job.id, name='p1', type='string',
+                        value='{% g %}')
+    with mock.patch('core.cloud_logging.logger') as patched_logger:
+      self.assertFalse(pipeline.populate_params_runtime_values())
+    entry = patched_logger.log_struct.call_args[0][0]
+    self.assertTrue(entry['message'].startswith('Invalid global variable'))
+
+  def test_pipeline_fails_before_rendering_params(self):
+    pipeline = models.Pipeline.create(name='pipeline1')
+    with mock.patch('core.inline.prefetch', side_effect=TypeError('oops')), \
+        mock.patch('core.cloud_logging.logger') as patched_logger:
+      self.assertFalse(pipeline.populate_params_runtime_values())
+    entry = patched_logger.log_struct.call_args[0][0]
+    self.assertEqual(entry['message'], 'Invalid variables: oops')
 
 
 class TestStage(utils.ModelTestCase):
@@ -396,16 +670,19 @@ class TestStage(utils.ModelTestCase):
     self.assertEqual(st.sid, '123')
 
 
-class TestTaskEnqueued(utils.ModelTestCase):
-
-  def test_count_is_zero(self):
-    self.assertEqual(models.TaskEnqueued.count_in_namespace('xyz'), 0)
+class TestAudienceFingerprint(utils.ModelTestCase):
 
-  def test_count_is_zero_in_another_namespace(self):
-    models.TaskEnqueued.create(task_namespace='abc')
-    self.assertEqual(models.TaskEnqueued.count_in_namespace('xyz'), 0)
+  def test_store_replaces_fingerprints_of_property(self):
+    models.AudienceFingerprint.store('UA-1-1', {'a': ('1', 'f1'),
+                                                'b': ('2', 'f2')})
+    models.AudienceFingerprint.store('UA-2-1', {'a': ('3', 'f3')})
+    models.AudienceFingerprint.store('UA-1-1', {'a': ('1', 'f4')})
+    self.assertEqual(models.AudienceFingerprint.load('UA-1-1'),
+                     {'a': ('1', 'f4'), 'b': ('2', 'f2')})
 
-  def test_count_is_not_zero_in_another_namespace(self):
-    models.TaskEnqueued.create(task_namespace='xyz')
-    models.TaskEnqueued.create(task_namespace='abc')
-    self.assertEqual(models.TaskEnqueued.count_in_namespace('xyz'), 1)
+  def test_forget(self):
+    models.AudienceFingerprint.store('UA-1-1', {'a': ('1', 'f1'),
+                                                'b': ('2', 'f2')})
+    models.AudienceFingerprint.forget('UA-1-1', ['a'])
+    self.assertEqual(models.AudienceFingerprint.load('UA-1-1'),
+                     {'b': ('2', 'f2')})
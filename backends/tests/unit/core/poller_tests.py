@@ -0,0 +1,138 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import mock
+
+from core import poller
+
+
+class TestNextDelay(unittest.TestCase):
+
+  def test_grows_with_checks_count(self):
+    self.assertEqual(poller.next_delay('bigquery_job', 0), 10)
+    self.assertEqual(poller.next_delay('bigquery_job', 1), 15)
+
+  def test_is_capped(self):
+    self.assertEqual(poller.next_delay('bigquery_job', 100), 300)
+
+
+class TestParsers(unittest.TestCase):
+
+  def test_parse_ml_job(self):
+    self.assertEqual(poller._parse_ml_job({'state': 'RUNNING'})[0],
+                     poller.RUNNING)
+    self.assertEqual(poller._parse_ml_job({'state': 'SUCCEEDED'})[0],
+                     poller.SUCCEEDED)
+
+  def test_parse_automl_operation(self):
+    self.assertEqual(poller._parse_automl_operation({})[0], poller.RUNNING)
+    self.assertEqual(poller._parse_automl_operation({'done': True})[0],
+                     poller.SUCCEEDED)
+    self.assertEqual(
+        poller._parse_automl_operation({'done': True, 'error': {}})[0],
+        poller.SUCCEEDED)
+    self.assertEqual(
+        poller._parse_automl_operation({'done': True, 'error': {'code': 3}})[0],
+        poller.FAILED)
+
+
+class TestCheckInBatch(unittest.TestCase):
+
+  def test_checks_all_operations_with_one_batch(self):
+    responses = {'1': {'done': True}, '2': {}}
+    batch = mock.Mock()
+    requests = []
+    batch.add.side_effect = lambda request, request_id: requests.append(
+        request_id)
+    service = mock.Mock()
+
+    def _new_batch(callback):
+      batch.execute.side_effect = lambda: [
+          callback(r, responses[r], None) for r in requests]
+      return batch
+    service.new_batch_http_request.side_effect = _new_batch
+    operations = [mock.Mock(id=1), mock.Mock(id=2)]
+    results = poller._check_in_batch(
+        operations, service, lambda s, o: o.id, poller._parse_ml_operation)
+    self.assertEqual(batch.execute.call_count, 1)
+    self.assertEqual(results, {1: (poller.SUCCEEDED, None),
+                               2: (poller.RUNNING, None)})
+
+  def test_transient_errors_keep_operation_running(self):
+    batch = mock.Mock()
+    service = mock.Mock()
+
+    def _new_batch(callback):
+      batch.execute.side_effect = lambda: callback('1', None, Exception())
+      return batch
+    service.new_batch_http_request.side_effect = _new_batch
+    results = poller._check_in_batch(
+        [mock.Mock(id=1)], service, lambda s, o: o.id,
+        poller._parse_ml_operation)
+    self.assertEqual(results[1][0], poller.RUNNING)
+
+
+class TestCheckBigQueryJobs(unittest.TestCase):
+
+  def setUp(self):
+    super(TestCheckBigQueryJobs, self).setUp()
+    patcher = mock.patch('core.clients.get_bigquery_client')
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    patcher = mock.patch('google.cloud.bigquery.job._AsyncJob')
+    self.patched_job = patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _operation(self, operation_id):
+    return mock.Mock(id=operation_id, parsed_params={})
+
+  def test_client_error_fails_only_its_operation(self):
+    from google.cloud.exceptions import NotFound
+    done_job = mock.Mock(error_result=None, state='DONE')
+    missing_job = mock.Mock(error_result=None)
+    missing_job.reload.side_effect = NotFound('Not found: Job job2')
+    self.patched_job.side_effect = [missing_job, done_job]
+    results = poller._check_bigquery_jobs(
+        [self._operation(2), self._operation(1)])
+    self.assertEqual(results[1], (poller.SUCCEEDED, None))
+    self.assertEqual(results[2][0], poller.FAILED)
+
+  def test_unexpected_error_keeps_operation_running(self):
+    self.patched_job.return_value.reload.side_effect = ValueError('boom')
+    results = poller._check_bigquery_jobs([self._operation(1)])
+    self.assertEqual(results[1], (poller.RUNNING, 'boom'))
+
+
+class TestDeleteStagingFiles(unittest.TestCase):
+
+  @mock.patch('core.poller._log')
+  @mock.patch('cloudstorage.delete')
+  def test_deletes_files_and_logs_failures(self, patched_delete,
+                                           patched_log):
+    import cloudstorage as gcs
+    patched_delete.side_effect = [None, gcs.NotFoundError(), ValueError('x')]
+    operation = mock.Mock(parsed_params={
+        'staging_paths': ['/bucket/a.json', '/bucket/b.json',
+                          '/bucket/c.json']})
+    poller._delete_staging_files(operation, None)
+    self.assertEqual(patched_delete.call_count, 3)
+    patched_log.assert_called_once()
+    self.assertEqual(patched_log.call_args[0][2], 'WARNING')
+
+  @mock.patch('cloudstorage.delete')
+  def test_ignores_operations_without_staging_files(self, patched_delete):
+    poller._delete_staging_files(mock.Mock(parsed_params={}), None)
+    patched_delete.assert_not_called()
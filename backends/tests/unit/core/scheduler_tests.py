@@ -0,0 +1,91 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from core import scheduler
+
+
+class TestDependencyGraph(unittest.TestCase):
+
+  def setUp(self):
+    super(TestDependencyGraph, self).setUp()
+    # 1 -> 3 <- 2, 3 -> 4
+    self.graph = scheduler.DependencyGraph([
+        (3, 1, 'success'),
+        (3, 2, 'whatever'),
+        (4, 3, 'fail'),
+    ])
+
+  def test_roots_are_jobs_without_start_conditions(self):
+    self.assertEqual(self.graph.roots([1, 2, 3, 4, 5]), [1, 2, 5])
+
+  def test_in_degree_counts_start_conditions(self):
+    self.assertEqual(self.graph.in_degree[3], 2)
+    self.assertEqual(self.graph.in_degree[4], 1)
+    self.assertEqual(self.graph.in_degree[1], 0)
+
+  def test_successor_decrements_count_conditions_per_successor(self):
+    graph = scheduler.DependencyGraph([
+        (3, 1, 'success'),
+        (3, 1, 'whatever'),
+        (4, 1, 'fail'),
+    ])
+    self.assertEqual(graph.successor_decrements(1), {3: 2, 4: 1})
+    self.assertEqual(graph.successor_decrements(2), {})
+
+  def test_successor_waits_for_all_preceding_jobs(self):
+    ready, blocked = self.graph.ready_successors(1, 'succeeded', {3: 1})
+    self.assertEqual(ready, [])
+    self.assertEqual(blocked, [])
+
+  def test_successor_is_ready_when_all_preceding_jobs_finished(self):
+    ready, blocked = self.graph.ready_successors(2, 'failed', {3: 0})
+    self.assertEqual(ready, [3])
+    self.assertEqual(blocked, [])
+
+  def test_successor_is_blocked_by_unfulfilled_condition(self):
+    ready, blocked = self.graph.ready_successors(1, 'failed', {3: 0})
+    self.assertEqual(ready, [])
+    self.assertEqual(blocked, [3])
+
+  def test_successor_conditions_fulfilled(self):
+    self.assertTrue(self.graph.successor_conditions_fulfilled(3, 'failed'))
+    self.assertFalse(self.graph.successor_conditions_fulfilled(3, 'succeeded'))
+
+  def test_start_conditions_without_preceding_job_are_ignored(self):
+    graph = scheduler.DependencyGraph([(2, None, 'success')])
+    self.assertEqual(graph.roots([1, 2]), [1, 2])
+
+
+class _Record(object):
+
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+
+class TestRunSnapshot(unittest.TestCase):
+
+  def test_params_are_split_by_scope(self):
+    jobs = [_Record(id=1), _Record(id=2)]
+    global_param = _Record(job_id=None, pipeline_id=None)
+    pipeline_param = _Record(job_id=None, pipeline_id=7)
+    job_param = _Record(job_id=2, pipeline_id=None)
+    graph = scheduler.DependencyGraph([])
+    snapshot = scheduler.RunSnapshot(
+        jobs, [global_param, job_param, pipeline_param], graph)
+    self.assertEqual(snapshot.global_params, [global_param])
+    self.assertEqual(snapshot.pipeline_params, [pipeline_param])
+    self.assertEqual(snapshot.params_by_job, {1: [], 2: [job_param]})
+    self.assertIsNone(snapshot.worker_params)
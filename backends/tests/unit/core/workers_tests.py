@@ -12,12 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
+import threading
 import unittest
 
 from apiclient.errors import HttpError
 import cloudstorage
 from google.appengine.ext import testbed
+from google.cloud.bigquery.schema import SchemaField
 from google.cloud.bigquery.table import Table
 from google.cloud.exceptions import ClientError
 from urllib2 import HTTPError
@@ -51,34 +54,73 @@ class TestAbstractWorker(unittest.TestCase):
 
   @mock.patch('core.cloud_logging.logger')
   def test_log_info_succeeds(self, patched_logger):
-    patched_logger.log_struct.__name__ = 'foo'
+    batch = patched_logger.batch.return_value
+    batch.commit.__name__ = 'foo'
     worker = workers.Worker({}, 1, 1)
-    self.assertEqual(patched_logger.log_struct.call_count, 0)
     worker.log_info('Hi there!')
-    self.assertEqual(patched_logger.log_struct.call_count, 1)
-    call_first_arg = patched_logger.log_struct.call_args[0][0]
+    self.assertEqual(batch.commit.call_count, 0)
+    worker.flush_logs()
+    self.assertEqual(batch.commit.call_count, 1)
+    call_first_arg = batch.log_struct.call_args[0][0]
     self.assertEqual(call_first_arg.get('log_level'), 'INFO')
 
   @mock.patch('core.cloud_logging.logger')
   def test_log_warn_succeeds(self, patched_logger):
-    patched_logger.log_struct.__name__ = 'foo'
+    batch = patched_logger.batch.return_value
+    batch.commit.__name__ = 'foo'
     worker = workers.Worker({}, 1, 1)
-    self.assertEqual(patched_logger.log_struct.call_count, 0)
     worker.log_warn('Hi there!')
-    self.assertEqual(patched_logger.log_struct.call_count, 1)
-    call_first_arg = patched_logger.log_struct.call_args[0][0]
+    self.assertEqual(batch.commit.call_count, 0)
+    worker.flush_logs()
+    self.assertEqual(batch.commit.call_count, 1)
+    call_first_arg = batch.log_struct.call_args[0][0]
     self.assertEqual(call_first_arg.get('log_level'), 'WARNING')
 
   @mock.patch('core.cloud_logging.logger')
   def test_log_error_succeeds(self, patched_logger):
-    patched_logger.log_struct.__name__ = 'foo'
+    batch = patched_logger.batch.return_value
+    batch.commit.__name__ = 'foo'
     worker = workers.Worker({}, 1, 1)
-    self.assertEqual(patched_logger.log_struct.call_count, 0)
     worker.log_error('Hi there!')
-    self.assertEqual(patched_logger.log_struct.call_count, 1)
-    call_first_arg = patched_logger.log_struct.call_args[0][0]
+    self.assertEqual(batch.commit.call_count, 1)
+    call_first_arg = batch.log_struct.call_args[0][0]
     self.assertEqual(call_first_arg.get('log_level'), 'ERROR')
 
+  @mock.patch('core.cloud_logging.logger')
+  def test_log_entries_are_written_in_batches(self, patched_logger):
+    batch = patched_logger.batch.return_value
+    worker = workers.Worker({}, 1, 1)
+    worker.LOG_BUFFER_SIZE = 3
+    for i in range(7):
+      worker.log_info('Row %i', i)
+    self.assertEqual(batch.commit.call_count, 2)
+    self.assertEqual(batch.log_struct.call_count, 6)
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_log_entries_are_kept_if_writing_fails(self, patched_logger):
+    batch = patched_logger.batch.return_value
+    batch.commit.side_effect = [Exception('Unavailable'), None]
+    worker = workers.Worker({}, 1, 1)
+    worker.log_error('First')
+    worker.log_error('Second')
+    messages = [c[0][0]['message'] for c in batch.log_struct.call_args_list]
+    self.assertEqual(messages, ['First', 'First', 'Second'])
+
+  @mock.patch('logging.exception')
+  @mock.patch('time.sleep')
+  @mock.patch('core.cloud_logging.logger')
+  def test_log_entries_failed_to_be_flushed_are_reported(
+      self, patched_logger, patched_sleep, patched_logging_exception):
+    batch = patched_logger.batch.return_value
+    batch.commit.__name__ = 'foo'
+    batch.commit.side_effect = Exception('Unavailable')
+    worker = workers.Worker({}, 1, 1)
+    worker.log_info('Hi there!')
+    worker.flush_logs()
+    patched_logging_exception.assert_called_once_with(
+        'Failed to write %i log entries', 1)
+    self.assertEqual(worker._log_entries, [])
+
   @mock.patch('core.cloud_logging.logger')
   def test_execute_client_error_raises_worker_exception(self, patched_logger):
     patched_logger.log_struct.__name__ = 'foo'
@@ -154,30 +196,162 @@ class TestBQWorker(unittest.TestCase):
     job0.error_result = None
     worker._begin_and_wait(job0)
     job0.begin.assert_called_once()
+    self.assertLess(patched_time_sleep.call_args_list[0][0][0], 1)
 
   @mock.patch('time.sleep')
   @mock.patch('google.cloud.bigquery.job.QueryJob')
-  @mock.patch('core.workers.BQWorker._enqueue')
-  def test_begin_and_wait_enqueue_bqwaiter_after_some_time(self,
-      patched_BQWorker_enqueue, patched_bigquery_QueryJob, patched_time_sleep):
+  def test_begin_and_wait_tracks_operation_after_some_time(self,
+      patched_bigquery_QueryJob, patched_time_sleep):
     # NB: bypass the time.sleep wait, otherwise the test will take ages
     patched_time_sleep.side_effect = lambda delay: delay
-    def _fake_enqueue(*args, **kwargs):
-      # Do Nothing
-      return True
-    patched_BQWorker_enqueue.side_effect = _fake_enqueue
     worker = workers.BQWorker({'bq_project_id': 'BQID'}, 1, 1)
     job0 = patched_bigquery_QueryJob()
+    job0.name = 'Job0'
     job0.error_result = None
     worker._begin_and_wait(job0)
-    patched_BQWorker_enqueue.assert_called_once()
-    self.assertEqual(patched_BQWorker_enqueue.call_args[0][0], 'BQWaiter')
-    self.assertIsInstance(patched_BQWorker_enqueue.call_args[0][1], dict)
+    self.assertEqual(len(worker._workers_to_enqueue), 0)
+    self.assertEqual(len(worker.operations_to_track), 1)
+    kind, name, params, _ = worker.operations_to_track[0]
+    self.assertEqual((kind, name), ('bigquery_job', 'Job0'))
+    self.assertEqual(params['bq_project_id'], 'BQID')
+
+  @mock.patch('time.sleep')
+  @mock.patch('core.bq_estimates.get_expected_duration')
+  @mock.patch('google.cloud.bigquery.job.QueryJob')
+  def test_begin_and_wait_hands_over_predicted_long_jobs(self,
+      patched_bigquery_QueryJob, patched_get_expected_duration,
+      patched_time_sleep):
+    patched_get_expected_duration.return_value = 3600
+    worker = workers.BQWorker({'bq_project_id': 'BQID'}, 1, 1)
+    job0 = patched_bigquery_QueryJob()
+    job0.name = 'Job0'
+    worker._begin_and_wait(job0)
+    job0.begin.assert_called_once()
+    patched_time_sleep.assert_not_called()
+    self.assertEqual(worker.operations_to_track[0][3], 300)
+
+  @mock.patch('cloudstorage.delete')
+  @mock.patch('core.bq_estimates.get_expected_duration')
+  @mock.patch('google.cloud.bigquery.job.QueryJob')
+  def test_begin_and_wait_hands_staging_files_over(self,
+      patched_bigquery_QueryJob, patched_get_expected_duration,
+      patched_delete):
+    patched_get_expected_duration.return_value = 3600
+    worker = workers.BQWorker({'bq_project_id': 'BQID'}, 1, 1)
+    job0 = patched_bigquery_QueryJob()
+    worker._begin_and_wait(job0, staging_paths=['/bucket/file.json'])
+    self.assertEqual(worker.operations_to_track[0][2]['staging_paths'],
+                     ['/bucket/file.json'])
+    patched_delete.assert_not_called()
+
+  @mock.patch('time.sleep')
+  @mock.patch('cloudstorage.delete')
+  @mock.patch('google.cloud.bigquery.job.QueryJob')
+  def test_begin_and_wait_deletes_staging_files_of_done_jobs(self,
+      patched_bigquery_QueryJob, patched_delete, patched_time_sleep):
+    worker = workers.BQWorker({}, 1, 1)
+    job0 = patched_bigquery_QueryJob()
+    job0.error_result = None
+    job0.state = 'DONE'
+    worker._begin_and_wait(job0, staging_paths=['/bucket/file.json'])
+    patched_delete.assert_called_once_with('/bucket/file.json')
+
+
+class FakeTable(object):
+  """Table serving tabledata.list requests from a list of rows.
+
+  Rows following the first `num_rows` ones are in the streaming buffer.
+  """
+
+  def __init__(self, fields, rows, page_size=2, num_rows=None):
+    self.name = 'fake_table'
+    self.schema = [SchemaField(name, 'STRING') for name in fields]
+    self.num_rows = len(rows) if num_rows is None else num_rows
+    self._properties = {}
+    if self.num_rows < len(rows):
+      self._properties['streamingBuffer'] = {
+          'estimatedRows': str(len(rows) - self.num_rows)}
+    self.requests = []
+    self.clients = []
+    self._rows = rows
+    self._page_size = page_size
+
+  def fetch_data(self, max_results=None, page_token=None, client=None):
+    self.clients.append(client)
+    query_iterator = mock.Mock(extra_params={'maxResults': max_results})
+    def _pages():
+      params = query_iterator.extra_params
+      self.requests.append(params)
+      start_index = params.get('startIndex', int(page_token or 0))
+      count = min(max_results, self._page_size)
+      rows = self._rows[start_index:start_index + count]
+      if start_index + count < len(self._rows):
+        query_iterator.next_page_token = str(start_index + count)
+      if 'selectedFields' in params:
+        names = [f.name for f in self.schema]
+        indexes = [names.index(n) for n in params['selectedFields'].split(',')]
+        rows = [tuple(row[i] for i in indexes) for row in rows]
+      yield rows
+    query_iterator.pages = _pages()
+    query_iterator.next_page_token = None
+    return query_iterator
+
+
+class TestTableReader(unittest.TestCase):
+
+  def setUp(self):
+    super(TestTableReader, self).setUp()
+    self.rows = [('id%i' % i, 'email%i' % i, 'name%i' % i) for i in range(9)]
+    self.table = FakeTable(['id', 'email', 'name'], self.rows)
+
+  def test_reads_all_rows_in_order(self):
+    reader = workers.TableReader(self.table, batch_size=4, max_streams=3,
+                                 get_client=threading.current_thread)
+    self.assertEqual(list(reader.rows()), self.rows)
+    self.assertEqual(sorted(r['startIndex'] for r in self.table.requests),
+                     [0, 2, 4, 6, 8])
+
+  def test_streams_use_the_client_of_their_thread(self):
+    reader = workers.TableReader(self.table, batch_size=4, max_streams=3,
+                                 get_client=threading.current_thread)
+    list(reader.rows())
+    self.assertNotIn(threading.current_thread(), self.table.clients)
+
+  def test_reads_ranges_serially_without_client_per_thread(self):
+    reader = workers.TableReader(self.table, batch_size=4, max_streams=3)
+    self.assertEqual(list(reader.rows()), self.rows)
+    self.assertEqual(self.table.clients, [None] * 5)
+
+  def test_reads_range_of_rows(self):
+    reader = workers.TableReader(self.table, start_index=3, max_results=3)
+    self.assertEqual(list(reader.rows()), self.rows[3:6])
+
+  def test_reads_selected_fields_only(self):
+    reader = workers.TableReader(self.table, selected_fields=['name', 'id'])
+    self.assertEqual(reader.fields, ['id', 'name'])
+    self.assertEqual(list(reader.rows())[0], ('id0', 'name0'))
+    self.assertEqual(self.table.requests[0]['selectedFields'], 'id,name')
+
+  def test_raises_on_unknown_fields(self):
+    with self.assertRaises(workers.WorkerException):
+      workers.TableReader(self.table, selected_fields=['phone'])
+
+  def test_filters_rows(self):
+    reader = workers.TableReader(self.table,
+                                 row_filter=lambda row: row[0] != 'id1')
+    self.assertEqual(len(list(reader.rows())), 8)
+
+  def test_reads_rows_of_streaming_buffer_page_after_page(self):
+    table = FakeTable(['id', 'email', 'name'], self.rows, num_rows=5)
+    reader = workers.TableReader(table, batch_size=4, max_streams=3,
+                                 get_client=threading.current_thread)
+    self.assertEqual(list(reader.rows()), self.rows)
+    self.assertTrue(all('startIndex' not in r for r in table.requests))
 
 
 class TestBQWaiter(unittest.TestCase):
 
-  def test_execute_enqueue_job_if_done(self):
+  def test_execute_tracks_operation_if_not_done(self):
     patcher_get_client = mock.patch.object(workers.BQWaiter, '_get_client',
         return_value=None)
     self.addCleanup(patcher_get_client.stop)
@@ -188,9 +362,6 @@ class TestBQWaiter(unittest.TestCase):
         return_value=mockAsyncJob)
     self.addCleanup(patcher_async_job.stop)
     patcher_async_job.start()
-    patcher_worker_enqueue = mock.patch('core.workers.BQWaiter._enqueue')
-    self.addCleanup(patcher_worker_enqueue.stop)
-    patched_enqueue = patcher_worker_enqueue.start()
     worker = workers.BQWaiter(
         {
             'bq_project_id': 'BQID',
@@ -200,8 +371,10 @@ class TestBQWaiter(unittest.TestCase):
         1)
     worker._client = mock.Mock()
     worker._execute()
-    patched_enqueue.assert_called_once()
-    self.assertEqual(patched_enqueue.call_args[0][0], 'BQWaiter')
+    self.assertEqual(len(worker._workers_to_enqueue), 0)
+    self.assertEqual(len(worker.operations_to_track), 2)
+    self.assertEqual(worker.operations_to_track[0][:2],
+                     ('bigquery_job', 'Job1'))
 
 
 class TestStorageToBQImporter(unittest.TestCase):
@@ -219,7 +392,7 @@ class TestStorageToBQImporter(unittest.TestCase):
     patcher_listbucket = mock.patch('cloudstorage.listbucket')
     patched_listbucket = patcher_listbucket.start()
     self.addCleanup(patcher_listbucket.stop)
-    def _fake_listbucket(bucket_prefix):
+    def _fake_listbucket(path_prefix, marker=None):
       filenames = [
         'input.csv',
         'subdir/input.csv',
@@ -227,13 +400,18 @@ class TestStorageToBQImporter(unittest.TestCase):
         'subdir/data.csv',
       ]
       for suffix in filenames:
-        filename = os.path.join(bucket_prefix, suffix)
+        filename = os.path.join('/bucket', suffix)
+        if not filename.startswith(path_prefix):
+          continue
+        if marker is not None and filename <= marker:
+          continue
         stat = cloudstorage.GCSFileStat(
             filename,
             0,
             '686897696a7c876b7e',
             0)
         yield stat
+    self.patched_listbucket = patched_listbucket
     patched_listbucket.side_effect = _fake_listbucket
 
   def tearDown(self):
@@ -268,6 +446,593 @@ class TestStorageToBQImporter(unittest.TestCase):
     self.assertEqual(len(source_uris), 2)
     self.assertEqual(source_uris[0], 'gs://bucket/subdir/input.csv')
     self.assertEqual(source_uris[1], 'gs://bucket/subdir/data.csv')
+    self.patched_listbucket.assert_called_once_with('/bucket/subdir/',
+                                                    marker=None)
+
+  def test_get_source_uris_lists_overlapping_prefixes_once(self):
+    worker = workers.StorageToBQImporter(
+      {
+        'source_uris': [
+          'gs://bucket/subdir/*.csv',
+          'gs://bucket/subdir/data.csv',
+          'gs://bucket/in*.csv',
+        ]
+      },
+      1,
+      1)
+    source_uris = worker._get_source_uris()
+    self.assertEqual(source_uris, [
+        'gs://bucket/input.csv',
+        'gs://bucket/subdir/input.csv',
+        'gs://bucket/subdir/data.csv',
+    ])
+    self.assertEqual(self.patched_listbucket.call_count, 2)
+
+  def test_get_source_uris_lists_buckets_apart(self):
+    worker = workers.StorageToBQImporter(
+      {
+        'source_uris': [
+          'gs://bucket',
+          'gs://bucket2/data.csv',
+        ]
+      },
+      1,
+      1)
+    worker._get_source_uris()
+    self.assertEqual(
+        [c[0][0] for c in self.patched_listbucket.call_args_list],
+        ['/bucket/', '/bucket2/data.csv'])
+
+  def test_get_source_uris_lists_nested_prefixes_without_duplicates(self):
+    worker = workers.StorageToBQImporter(
+      {
+        'source_uris': [
+          'gs://bucket/sub*',
+          'gs://bucket/subdir/data.csv',
+        ]
+      },
+      1,
+      1)
+    source_uris = worker._get_source_uris()
+    self.assertEqual(source_uris, [
+        'gs://bucket/subdir/input.csv',
+        'gs://bucket/subdir/data.csv',
+    ])
+    self.assertEqual(self.patched_listbucket.call_count, 2)
+
+
+class TestStorageCleaner(unittest.TestCase):
+
+  def setUp(self):
+    super(TestStorageCleaner, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+
+    patcher_listbucket = mock.patch('cloudstorage.listbucket')
+    self.patched_listbucket = patcher_listbucket.start()
+    self.addCleanup(patcher_listbucket.stop)
+    def _fake_listbucket(path_prefix, marker=None):
+      for bucket in ['/bucket', '/other']:
+        for i in range(5):
+          filename = '%s/data_%i.csv' % (bucket, i)
+          if not filename.startswith(path_prefix):
+            continue
+          if marker is not None and filename <= marker:
+            continue
+          yield cloudstorage.GCSFileStat(filename, 0, '686897696a7c876b7e', 0)
+    self.patched_listbucket.side_effect = _fake_listbucket
+    patcher_delete = mock.patch('cloudstorage.delete')
+    self.patched_delete = patcher_delete.start()
+    self.addCleanup(patcher_delete.stop)
+    patcher_log = mock.patch.object(workers.StorageCleaner, '_log')
+    patcher_log.start()
+    self.addCleanup(patcher_log.stop)
+
+  def tearDown(self):
+    super(TestStorageCleaner, self).tearDown()
+    self.testbed.deactivate()
+
+  def _make_worker(self, task_name='task1',
+                   file_uris=('gs://bucket/data_*.csv',)):
+    worker = workers.StorageCleaner(
+        {
+            'file_uris': list(file_uris),
+            'expiration_days': 1,
+        },
+        1,
+        1,
+        task_name)
+    worker.CHECKPOINT_INTERVAL = 2
+    return worker
+
+  def test_execute_deletes_expired_files(self):
+    self._make_worker().execute()
+    self.assertEqual(
+        sorted(c[0][0] for c in self.patched_delete.call_args_list),
+        ['/bucket/data_%i.csv' % i for i in range(5)])
+
+  def test_execute_resumes_after_checkpoint(self):
+    def _fail_on_last_file(filename):
+      if filename == '/bucket/data_4.csv':
+        raise cloudstorage.TransientError()
+    self.patched_delete.side_effect = _fail_on_last_file
+    with self.assertRaises(workers.WorkerException):
+      self._make_worker().execute()
+    self.patched_delete.reset_mock()
+    self.patched_delete.side_effect = None
+    self._make_worker().execute()
+    self.patched_delete.assert_called_once_with('/bucket/data_4.csv')
+
+  def test_execute_resumes_listing_of_checkpoint(self):
+    file_uris = ['gs://other/data_*.csv', 'gs://bucket/data_*.csv']
+    def _fail_on_file(filename):
+      if filename == '/other/data_2.csv':
+        raise cloudstorage.TransientError()
+    self.patched_delete.side_effect = _fail_on_file
+    with self.assertRaises(workers.WorkerException):
+      self._make_worker(file_uris=file_uris).execute()
+    self.patched_delete.reset_mock()
+    self.patched_delete.side_effect = None
+    self.patched_listbucket.reset_mock()
+    self._make_worker(file_uris=file_uris).execute()
+    self.patched_listbucket.assert_called_once_with(
+        '/other/data_', marker='/other/data_0.csv')
+    self.assertEqual(
+        sorted(c[0][0] for c in self.patched_delete.call_args_list),
+        ['/other/data_%i.csv' % i for i in range(1, 5)])
+
+  def test_next_run_ignores_checkpoint_of_previous_run(self):
+    def _fail_on_last_file(filename):
+      if filename == '/bucket/data_4.csv':
+        raise cloudstorage.TransientError()
+    self.patched_delete.side_effect = _fail_on_last_file
+    with self.assertRaises(workers.WorkerException):
+      self._make_worker('task1').execute()
+    self.patched_delete.reset_mock()
+    self.patched_delete.side_effect = None
+    self._make_worker('task2').execute()
+    self.assertEqual(self.patched_delete.call_count, 5)
+
+
+class TestGAReportRowMapper(unittest.TestCase):
+
+  def setUp(self):
+    super(TestGAReportRowMapper, self).setUp()
+    self.column_header = {
+        'dimensions': ['ga:source', 'ga:medium'],
+        'metricHeader': {'metricHeaderEntries': [{'name': 'ga:users'}]},
+    }
+    self.row = {'dimensions': ['google', 'cpc'],
+                'metrics': [{'values': ['3']}]}
+
+  def test_maps_row_in_schema_order(self):
+    mapper = workers.GAReportRowMapper(
+        ['view_id', 'ga_users', 'ga_source', 'other', 'end_date'],
+        self.column_header)
+    self.assertEqual(mapper.map(self.row, '123', '2018-01-01', '2018-01-31'),
+                     ('123', '3', 'google', None, '2018-01-31'))
+
+  def test_maps_row_to_single_field(self):
+    mapper = workers.GAReportRowMapper(['ga_medium'], self.column_header)
+    self.assertEqual(mapper.map(self.row, '123', 's', 'e'), ('cpc',))
+
+  def test_maps_report_without_dimensions(self):
+    column_header = {
+        'metricHeader': {'metricHeaderEntries': [{'name': 'ga:users'}]},
+    }
+    mapper = workers.GAReportRowMapper(['view_id', 'ga_users', 'ga_source'],
+                                       column_header)
+    row = {'metrics': [{'values': ['3']}]}
+    self.assertEqual(mapper.map(row, '123', 's', 'e'), ('123', '3', None))
+
+  def test_metrics_take_precedence(self):
+    self.column_header['dimensions'].append('ga:users')
+    self.row['dimensions'].append('dimension')
+    mapper = workers.GAReportRowMapper(['ga_users'], self.column_header)
+    self.assertEqual(mapper.map(self.row, '123', 's', 'e'), ('3',))
+
+
+class TestGAToBQImporter(unittest.TestCase):
+
+  def setUp(self):
+    super(TestGAToBQImporter, self).setUp()
+    patcher_open = mock.patch('cloudstorage.open')
+    self.addCleanup(patcher_open.stop)
+    self.staging_file = patcher_open.start().return_value
+    patcher_delete = mock.patch('cloudstorage.delete')
+    self.addCleanup(patcher_delete.stop)
+    self.patched_delete = patcher_delete.start()
+    patcher_log = mock.patch.object(workers.GAToBQImporter, '_log')
+    self.addCleanup(patcher_log.stop)
+    patcher_log.start()
+    patcher_wait = mock.patch.object(workers.GAToBQImporter,
+                                     '_begin_and_wait')
+    self.addCleanup(patcher_wait.stop)
+    self.patched_begin_and_wait = patcher_wait.start()
+    patcher_build_service = mock.patch('core.clients.build_service')
+    self.addCleanup(patcher_build_service.stop)
+    self.ga_client = patcher_build_service.start().return_value
+
+  def _make_worker(self, staging_uri='', view_ids=('123',),
+                   end_date='2018-01-01', day_by_day=False):
+    worker = workers.GAToBQImporter(
+        {
+            'view_ids': list(view_ids),
+            'start_date': '2018-01-01',
+            'end_date': end_date,
+            'day_by_day': day_by_day,
+            'metrics': ['ga:users'],
+            'dimensions': ['ga:source'],
+            'staging_uri': staging_uri,
+        },
+        1,
+        1)
+    def _bq_setup():
+      worker._client = mock.Mock()
+      worker._table = mock.Mock(schema=[
+          SchemaField('view_id', 'STRING'),
+          SchemaField('ga_source', 'STRING'),
+          SchemaField('ga_users', 'INTEGER'),
+      ])
+      worker._job_name = 'job'
+    worker._bq_setup = _bq_setup
+    batch_get = self.ga_client.reports.return_value.batchGet
+    batch_get.return_value.execute.return_value = {'reports': [{
+        'columnHeader': {
+            'dimensions': ['ga:source'],
+            'metricHeader': {'metricHeaderEntries': [{'name': 'ga:users'}]},
+        },
+        'data': {'rows': [
+            {'dimensions': ['google'], 'metrics': [{'values': ['2']}]},
+            {'dimensions': ['(none)'], 'metrics': [{'values': ['1']}]},
+        ]},
+    }]}
+    return worker
+
+  def test_plan_shards_by_view_and_day(self):
+    worker = self._make_worker(view_ids=['1', '2'], end_date='2018-01-02',
+                               day_by_day=True)
+    self.assertEqual(worker._plan_shards(), [
+        ['1', '2018-01-01', '2018-01-01'],
+        ['2', '2018-01-01', '2018-01-01'],
+        ['1', '2018-01-02', '2018-01-02'],
+        ['2', '2018-01-02', '2018-01-02'],
+    ])
+
+  def test_execute_fetches_shards_concurrently(self):
+    worker = self._make_worker(view_ids=['1', '2'])
+    worker._execute()
+    batch_get = self.ga_client.reports.return_value.batchGet
+    view_ids = sorted(c[1]['body']['reportRequests'][0]['viewId']
+                      for c in batch_get.call_args_list)
+    self.assertEqual(view_ids, ['1', '2'])
+    self.assertEqual(len(worker._table.insert_data.call_args[0][0]), 4)
+    self.assertEqual(worker._workers_to_enqueue, [])
+
+  def test_execute_spreads_large_backfills_over_parallel_tasks(self):
+    worker = self._make_worker(end_date='2018-12-31', day_by_day=True)
+    worker._execute()
+    self.assertEqual(len(worker._workers_to_enqueue),
+                     workers.GAToBQImporter.MAX_PARALLEL_TASKS)
+    shards = [s for _, params, _ in worker._workers_to_enqueue
+              for s in params['shards']]
+    self.assertEqual(len(shards), 365)
+    self.assertEqual(shards[0], ['123', '2018-01-01', '2018-01-01'])
+    self.ga_client.reports.assert_not_called()
+
+  def test_execute_hands_remaining_shards_over(self):
+    worker = self._make_worker()
+    shards = [['123', '2018-01-%02i' % d, '2018-01-%02i' % d]
+              for d in range(1, 11)]
+    worker._params['shards'] = shards
+    worker._execute()
+    (_, params, _), = worker._workers_to_enqueue
+    self.assertEqual(params['shards'],
+                     shards[workers.GAToBQImporter.MAX_SHARDS_PER_TASK:])
+
+  def test_execute_streams_rows_without_staging_uri(self):
+    worker = self._make_worker()
+    worker._execute()
+    worker._table.insert_data.assert_called_once_with(
+        [('123', 'google', '2'), ('123', '(none)', '1')])
+    worker._client.load_table_from_storage.assert_not_called()
+
+  def test_execute_loads_rows_from_staging_file(self):
+    worker = self._make_worker('gs://bucket/staging/')
+    worker._execute()
+    worker._table.insert_data.assert_not_called()
+    lines = [c[0][0] for c in self.staging_file.write.call_args_list]
+    self.assertEqual(
+        json.loads(lines[0]),
+        {'view_id': '123', 'ga_source': 'google', 'ga_users': '2'})
+    self.assertEqual(len(lines), 2)
+    worker._client.load_table_from_storage.assert_called_once_with(
+        'job', worker._table, 'gs://bucket/staging/job.json')
+    job = worker._client.load_table_from_storage.return_value
+    self.assertEqual(job.source_format, 'NEWLINE_DELIMITED_JSON')
+    self.patched_begin_and_wait.assert_called_once_with(
+        job, staging_paths=['/bucket/staging/job.json'])
+
+
+class TestBQToAppConversionAPI(unittest.TestCase):
+
+  def setUp(self):
+    super(TestBQToAppConversionAPI, self).setUp()
+    patcher_session = mock.patch('core.clients.get_http_session')
+    self.addCleanup(patcher_session.stop)
+    self.session = patcher_session.start().return_value
+    patcher_log = mock.patch.object(workers.BQToAppConversionAPI, '_log')
+    self.addCleanup(patcher_log.stop)
+    self.patched_log = patcher_log.start()
+    self.worker = workers.BQToAppConversionAPI(
+        {
+            'bq_dataset_id': 'dataset',
+            'bq_table_id': 'table',
+            'app_conversion_api_developer_token': 'token',
+        },
+        1,
+        1)
+    self.fields = (workers.BQToAppConversionAPI.HEADER_PARAMS
+                   + workers.BQToAppConversionAPI.REQUIRED_PARAMS)
+
+  def _response(self, status_code, result=None):
+    response = mock.Mock(status_code=status_code)
+    response.text = json.dumps(result or {})
+    return response
+
+  def test_process_page_sends_rows_with_shared_session(self):
+    attributed = {'attributed': True, 'errors': [],
+                  'ad_events': [{'ad_event_id': 'E1'}]}
+    def _post(url, **kwargs):
+      if url.endswith('/cross_network'):
+        return self._response(200)
+      if kwargs['params']['rdid'] == 'attributed':
+        return self._response(200, attributed)
+      return self._response(200, {'attributed': False, 'errors': []})
+    self.session.post.side_effect = _post
+    page = [['UA', '1.2.3.4', rdid] + ['x'] * 8
+            for rdid in ['attributed', 'other', 'attributed']]
+    self.worker._process_page(page, self.fields)
+    self.assertEqual(self.session.post.call_count, 5)
+    summary = self.patched_log.call_args_list[-1][0]
+    self.assertEqual(summary[0], 'INFO')
+    self.assertEqual(summary[2:6], (3, mock.ANY, mock.ANY, 2))
+
+  def test_process_page_counts_failed_requests(self):
+    self.session.post.return_value = self._response(500)
+    page = [['UA', '1.2.3.4', 'rdid'] + ['x'] * 8]
+    self.worker._process_page(page, self.fields)
+    summary = self.patched_log.call_args_list[-1][0]
+    self.assertEqual(summary[-3:], (1, 0, 0))
+
+
+  @mock.patch.object(workers.BQToAppConversionAPI, '_get_client',
+                     return_value=None)
+  def test_reads_declared_fields_only(self, _):
+    fields = self.fields + ['gclid', 'unused']
+    self.worker._table = FakeTable(fields, [tuple(fields)])
+    reader = self.worker._read_table()
+    self.assertEqual(reader.fields, self.fields + ['gclid'])
+    self.assertEqual(list(reader.rows()), [tuple(self.fields + ['gclid'])])
+
+
+class TestBQToCM(unittest.TestCase):
+
+  @mock.patch.object(workers.BQToCM, '_get_client', return_value=None)
+  def test_reads_members_column_only(self, _):
+    worker = workers.BQToCM({}, 1, 1)
+    worker._table = FakeTable(
+        ['member', 'score'], [('m1', 's1'), (None, 's2'), ('m3', 's3')])
+    reader = worker._read_table()
+    self.assertEqual(list(reader.rows()), [('m1',), ('m3',)])
+    self.assertEqual(worker._table.requests[0]['selectedFields'], 'member')
+
+  @mock.patch.object(workers.BQToCM, '_get_client', return_value=None)
+  @mock.patch.object(workers.BQToCM, '_enqueue')
+  def test_tasks_read_rows_of_streaming_buffer(self, patched_enqueue, _):
+    rows = [('m%i' % i,) for i in range(9)]
+    table = FakeTable(['member'], rows, num_rows=5)
+    params = {}
+    read_rows = []
+    while params is not None:
+      worker = workers.BQToCM(params, 1, 1)
+      worker._table = table
+      reader = worker._read_task_rows(4)
+      read_rows.extend(reader.rows())
+      patched_enqueue.reset_mock()
+      worker._enqueue_next_task(reader, 4)
+      params = (patched_enqueue.call_args[0][1] if patched_enqueue.called
+                else None)
+    self.assertEqual(read_rows, rows)
+
+
+class TestGADataImporter(unittest.TestCase):
+
+  def setUp(self):
+    super(TestGADataImporter, self).setUp()
+    for target in ['cloudstorage.open', 'core.workers.MediaIoBaseUpload']:
+      patcher = mock.patch(target)
+      self.addCleanup(patcher.stop)
+      patcher.start()
+    patcher_stat = mock.patch('cloudstorage.stat')
+    self.addCleanup(patcher_stat.stop)
+    patcher_stat.start().return_value = cloudstorage.GCSFileStat(
+        '/bucket/data.csv', 0, 'etag', 0)
+    patcher_checkpoint = mock.patch('core.models.UploadCheckpoint')
+    self.addCleanup(patcher_checkpoint.stop)
+    self.patched_checkpoint = patcher_checkpoint.start()
+    self.patched_checkpoint.where.return_value.first.return_value = None
+    self.worker = workers.GADataImporter(
+        {
+            'csv_uri': 'gs://bucket/data.csv',
+            'property_id': 'UA-12345-1',
+            'dataset_id': 'dataset',
+        },
+        1,
+        1)
+    self.worker._log = mock.Mock()
+    self.worker._account_id = '12345'
+    self.worker._file_name = '/bucket/data.csv'
+    self.worker._ga_client = mock.Mock()
+    self.request = (self.worker._ga_client.management.return_value
+                    .uploads.return_value.uploadData.return_value)
+    self.request.resumable_uri = 'https://upload/session'
+    self.request.resumable_progress = 0
+    status = mock.Mock()
+    status.progress.return_value = 0.5
+    self.request.next_chunk.side_effect = [(status, None), (None, {})]
+
+  def test_next_chunk_size_follows_throughput(self):
+    chunk_size = workers.GADataImporter._BUFFER_SIZE * 4
+    self.assertEqual(self.worker._next_chunk_size(chunk_size, 5),
+                     chunk_size * 2)
+    self.assertEqual(self.worker._next_chunk_size(chunk_size, 20),
+                     chunk_size / 2)
+    self.assertEqual(self.worker._next_chunk_size(chunk_size, 1000),
+                     workers.GADataImporter._BUFFER_SIZE)
+
+  def test_upload_checkpoints_progress(self):
+    self.worker._upload()
+    self.patched_checkpoint.create.assert_called_once_with(
+        job_id=1, source_uri='gs://bucket/data.csv', source_etag='etag',
+        session_uri='https://upload/session', offset=0, chunk_size=mock.ANY)
+    self.patched_checkpoint.create.return_value.delete.assert_called_once()
+
+  def test_upload_resumes_from_checkpoint(self):
+    checkpoint = mock.Mock(source_etag='etag', session_uri='https://resume',
+                           offset=1024, chunk_size=524288)
+    self.patched_checkpoint.where.return_value.first.return_value = checkpoint
+    self.request.next_chunk.side_effect = [(None, {})]
+    self.worker._upload()
+    self.assertEqual(self.request.resumable_uri, 'https://resume')
+    self.assertEqual(self.request.resumable_progress, 1024)
+    self.assertTrue(self.request._in_error_state)
+    workers.MediaIoBaseUpload.assert_called_once_with(
+        mock.ANY, mimetype='application/octet-stream', chunksize=524288,
+        resumable=True)
+    checkpoint.delete.assert_called_once()
+
+  @mock.patch('time.sleep')
+  def test_upload_failure_is_retried_from_checkpoint(self, patched_sleep):
+    status = mock.Mock()
+    status.progress.return_value = 0.5
+    error = HttpError(mock.Mock(status=503), '')
+    self.request.next_chunk.side_effect = [(status, None)] + [error] * 5
+    with self.assertRaises(HttpError):
+      self.worker._upload()
+    self.assertEqual(patched_sleep.call_count, 5)
+    self.patched_checkpoint.create.assert_called_once()
+    self.patched_checkpoint.create.return_value.delete.assert_not_called()
+
+  def test_upload_starts_over_when_file_has_changed(self):
+    checkpoint = mock.Mock(source_etag='old_etag')
+    self.patched_checkpoint.where.return_value.first.return_value = checkpoint
+    self.worker._upload()
+    checkpoint.delete.assert_called_once()
+    self.patched_checkpoint.create.assert_called_once()
+
+
+class TestGAAudiencesUpdater(unittest.TestCase):
+
+  @mock.patch.object(workers.GAAudiencesUpdater, '_get_client',
+                     return_value=None)
+  def test_reads_fields_used_by_template(self, _):
+    worker = workers.GAAudiencesUpdater(
+        {'template': '{"name": "%(name)s", "id": "%(id)s"}'}, 1, 1)
+    worker._table = FakeTable(['id', 'email', 'name'], [('1', 'e', 'n')])
+    worker._infer_audiences()
+    self.assertEqual(worker._inferred_audiences,
+                     {'n': {'name': 'n', 'id': '1'}})
+    self.assertEqual(worker._table.requests[0]['selectedFields'], 'id,name')
+
+  def _make_worker(self, stored_fingerprints):
+    patcher_fingerprint = mock.patch('core.models.AudienceFingerprint')
+    self.addCleanup(patcher_fingerprint.stop)
+    self.patched_fingerprint = patcher_fingerprint.start()
+    self.patched_fingerprint.load.return_value = stored_fingerprints
+    worker = workers.GAAudiencesUpdater(
+        {'property_id': 'UA-12345-1', 'account_id': '12345'}, 1, 1)
+    worker._account_id = '12345'
+    worker._log = mock.Mock()
+    worker._ga_client = mock.Mock()
+    self.audiences = worker._ga_client.management().remarketingAudience()
+    self.audiences.list.return_value.execute.return_value = {
+        'totalResults': 1, 'items': [{'id': 'B', 'name': 'b', 'v': 1}]}
+    self.audiences.list.return_value.execute.__name__ = 'execute'
+    self.batch_requests = []
+    # Number of batches failing before any request is processed.
+    self.failing_batches_count = 0
+    def _new_batch(callback):
+      batch = mock.Mock()
+      batch_requests = []
+      def _add(request, request_id):
+        batch_requests.append(request_id)
+        self.batch_requests.append((request, request_id))
+      batch.add.side_effect = _add
+      def _execute():
+        if self.failing_batches_count:
+          self.failing_batches_count -= 1
+          raise IOError('Connection reset')
+        for request_id in batch_requests:
+          callback(request_id, {'id': 'new%s' % request_id}, None)
+      batch.execute.side_effect = _execute
+      return batch
+    worker._ga_client.new_batch_http_request.side_effect = _new_batch
+    worker._inferred_audiences = {
+        'a': {'name': 'a', 'v': 1},
+        'b': {'name': 'b', 'v': 1},
+        'c': {'name': 'c', 'v': 2},
+    }
+    return worker
+
+  def _sync(self, worker):
+    worker._get_fingerprints()
+    worker._get_audiences()
+    worker._get_diff()
+    worker._update_ga_audiences()
+
+  def test_skips_unchanged_audiences_without_listing(self):
+    worker = self._make_worker({})
+    worker._get_fingerprints()
+    stored = dict((name, ('id', fingerprint))
+                  for name, fingerprint in worker._fingerprints.iteritems())
+    worker = self._make_worker(stored)
+    self._sync(worker)
+    self.audiences.list.assert_not_called()
+    self.assertEqual(self.batch_requests, [])
+
+  def test_patches_changed_audiences_by_stored_id(self):
+    worker = self._make_worker({'a': ('A', 'old'), 'b': ('B', 'old'),
+                                'c': ('C', 'old')})
+    self._sync(worker)
+    self.audiences.list.assert_not_called()
+    self.assertEqual(self.audiences.patch.call_count, 3)
+    self.assertEqual(len(self.batch_requests), 3)
+
+  def test_lists_unknown_audiences_and_inserts_missing_ones(self):
+    worker = self._make_worker({})
+    self._sync(worker)
+    self.audiences.list.assert_called_once()
+    self.assertEqual(self.audiences.insert.call_count, 2)
+    self.audiences.patch.assert_not_called()
+    _, fingerprints = self.patched_fingerprint.store.call_args[0]
+    self.assertEqual(sorted(fingerprints), ['a', 'b', 'c'])
+    self.assertEqual(fingerprints['b'][0], 'B')
+
+  @mock.patch('time.sleep')
+  def test_resends_patches_only_after_failed_batch(self, _):
+    worker = self._make_worker({'a': ('A', 'old')})
+    self.failing_batches_count = 1
+    with self.assertRaises(workers.WorkerException):
+      self._sync(worker)
+    self.assertEqual(self.audiences.insert.call_count, 1)
+    self.assertEqual([request_id for _, request_id in self.batch_requests],
+                     ['0', '1', '1'])
+    self.patched_fingerprint.forget.assert_called_once_with(
+        'UA-12345-1', ['c'])
+    _, fingerprints = self.patched_fingerprint.store.call_args[0]
+    self.assertEqual(sorted(fingerprints), ['a', 'b'])
 
 
 class TestBQToMeasurementProtocolMixin(object):
@@ -285,6 +1050,40 @@ class TestBQToMeasurementProtocolMixin(object):
     mock_dataset.table.return_value = mock_table
 
 
+class TestMeasurementProtocolEncoder(unittest.TestCase):
+
+  def test_encode_sorts_parameters_and_skips_nulls(self):
+    encoder = workers.MeasurementProtocolEncoder([
+        SchemaField('tid', 'STRING'),
+        SchemaField('el', 'STRING'),
+        SchemaField('cd1', 'STRING'),
+    ])
+    self.assertEqual(encoder.encode(('UA-1', u'\u043c', None)),
+                     'el=%D0%BC&tid=UA-1&v=1')
+
+  def test_encode_keeps_version_from_row(self):
+    encoder = workers.MeasurementProtocolEncoder([
+        SchemaField('v', 'INTEGER'),
+        SchemaField('tid', 'STRING'),
+    ])
+    self.assertEqual(encoder.encode((2, 'UA-1')), 'tid=UA-1&v=2')
+    self.assertEqual(encoder.encode((None, 'UA-1')), 'tid=UA-1&v=1')
+
+  def test_encode_flattens_repeated_records(self):
+    encoder = workers.MeasurementProtocolEncoder([
+        SchemaField('pr', 'RECORD', mode='REPEATED', fields=[
+            SchemaField('id', 'STRING'),
+            SchemaField('qt', 'INTEGER'),
+        ]),
+        SchemaField('tid', 'STRING'),
+    ])
+    products = [{'id': 'SKU%i' % i, 'qt': None} for i in range(1, 11)]
+    payload = encoder.encode((products, 'UA-1'))
+    self.assertEqual(
+        payload.split('&')[:3], ['pr10id=SKU10', 'pr1id=SKU1', 'pr2id=SKU2'])
+    self.assertTrue(payload.endswith('&tid=UA-1&v=1'))
+
+
 class TestBQToMeasurementProtocolProcessor(TestBQToMeasurementProtocolMixin, unittest.TestCase):
 
   def setUp(self):
@@ -298,9 +1097,9 @@ class TestBQToMeasurementProtocolProcessor(TestBQToMeasurementProtocolMixin, uni
     self.addCleanup(patcher_get_client.stop)
     patcher_get_client.start()
 
-    patcher_requests_post = mock.patch('requests.post')
-    self.addCleanup(patcher_requests_post.stop)
-    self._patched_post = patcher_requests_post.start()
+    patcher_session = mock.patch('core.clients.get_http_session')
+    self.addCleanup(patcher_session.stop)
+    self._patched_post = patcher_session.start().return_value.post
     self.maxDiff = None  # This is to see full diff when self.assertEqual fails.
 
   @mock.patch('time.sleep')
@@ -607,6 +1406,40 @@ cd1=segment1&cid=35009a79-1a05-49d7-b876-2b884d0f825b&ea=action&ec=category&el=%
             'data': 'cid=123456789.1234567890&cu=RUB&il1nm=List1&il1pi1br=Brand11&il1pi1ca=Cat11&il1pi1id=SKU11&il1pi1nm=Product11&il1pi1pr=1110.0&il1pi2br=Brand12&il1pi2ca=Cat12&il1pi2id=SKU12&il1pi2nm=Product12&il1pi2pr=1220.0&il1pi3br=Brand13&il1pi3ca=Cat13&il1pi3id=SKU13&il1pi3nm=Product13&il1pi3pr=1330.0&il2nm=List2&il2pi1br=Brand21&il2pi1ca=Cat21&il2pi1id=SKU21&il2pi1nm=Product21&il2pi1pr=2110.0&il2pi2br=Brand22&il2pi2id=SKU22&il2pi2nm=Product22&il2pi2pr=2220.0&il2pi3br=Brand23&il2pi3ca=Cat23&il2pi3id=SKU23&il2pi3nm=Product23&il2pi3pr=2330.0&pa=purchase&pr1br=Brand1&pr1ca=Cat1&pr1id=SKU1&pr1nm=Product1&pr1pr=110.0&pr1qt=1&pr2br=Brand2&pr2ca=Cat2&pr2id=SKU2&pr2nm=Product2&pr2pr=220.0&pr2qt=2&pr3br=Brand3&pr3ca=Cat3&pr3id=SKU3&pr3nm=Product3&pr3pr=330.0&pr3qt=3&t=pageview&ta=Moscow&ti=987654321&tid=UA-12345-6&tr=1540.0&v=1'
         })
 
+  def test_reads_rows_from_start_index(self):
+    self._worker = workers.BQToMeasurementProtocolProcessor(
+        {
+            'bq_project_id': 'BQID',
+            'bq_dataset_id': 'DTID',
+            'bq_table_id': 'table_id',
+            'bq_start_index': 1000,
+            'bq_batch_size': 3,
+            'mp_batch_size': 20,
+            'debug': False,
+        },
+        1,
+        1)
+    table = {
+        'tableReference': {'tableId': 'mock_table'},
+        'jobReference': {'jobId': 'table'},
+        'schema': {'fields': [{'name': 'tid', 'type': 'STRING'}]},
+    }
+    self._use_query_results(table)
+    self._client._connection.api_request.side_effect = [
+        table,
+        {'rows': [{'f': [{'v': 'UA-1'}]}, {'f': [{'v': 'UA-2'}]}]},
+        {'rows': [{'f': [{'v': 'UA-3'}]}]},
+    ]
+    self._patched_post.return_value = mock.Mock(status_code=200)
+    self._worker._execute()
+    query_params = [
+        c[1]['query_params']
+        for c in self._client._connection.api_request.call_args_list[1:]]
+    self.assertEqual([(p['startIndex'], p['maxResults']) for p in query_params],
+                     [(1000, 3), (1002, 1)])
+    self.assertEqual(self._patched_post.call_args[1]['data'],
+                     'tid=UA-1&v=1\ntid=UA-2&v=1\ntid=UA-3&v=1')
+
   @mock.patch('core.cloud_logging.logger')
   @mock.patch('time.sleep')
   def test_log_exception_if_http_fails(self, patched_time_sleep, patched_logger):
@@ -689,85 +1522,73 @@ class TestBQToMeasurementProtocol(TestBQToMeasurementProtocolMixin, unittest.Tes
     self.addCleanup(patcher_get_client.stop)
     patcher_get_client.start()
 
-  @mock.patch('time.sleep')
-  def test_success_with_spawning_new_worker(self, patched_time_sleep):
-    # Bypass the time.sleep wait
-    patched_time_sleep.return_value = 1
-    self._worker = workers.BQToMeasurementProtocol(
-        {
-            'bq_project_id': 'BQID',
-            'bq_dataset_id': 'DTID',
-            'bq_table_id': 'table_id',
-            'bq_page_token': None,
-            'mp_batch_size': 20,
-        },
-        1,
-        1)
-    self._worker.MAX_ENQUEUED_JOBS = 1
-    api_response = {
+  def _use_table(self, num_rows, streaming_rows=None):
+    response_json = {
         'tableReference': {
             'tableId': 'mock_table',
         },
         'jobReference': {
-            'jobId': 'one-row-query',
+            'jobId': 'table',
         },
-        'pageToken': 'abc',
-        'rows': [
-            {
-                'f': [
-                    {'v': 'UA-12345-1'},
-                    {'v': '35009a79-1a05-49d7-b876-2b884d0f825b'},
-                    {'v': 'event'},
-                    {'v': 1},
-                    {'v': 'category'},
-                    {'v': 'action'},
-                    {'v': 'label'},
-                    {'v': 0.9},
-                    {'v': 'User Agent / 1.0'},
-                ]
-            },
-            {
-                'f': [
-                    {'v': 'UA-12345-1'},
-                    {'v': '35009a79-1a05-49d7-b876-2b884d0f825b'},
-                    {'v': 'event'},
-                    {'v': 1},
-                    {'v': 'category'},
-                    {'v': 'action'},
-                    {'v': 'label'},
-                    {'v': 0.8},
-                    {'v': 'User Agent / 1.0'},
-                ]
-            },
-        ],
+        'numRows': str(num_rows),
         'schema': {
             'fields': [
                 {'name': 'tid', 'type': 'STRING'},
                 {'name': 'cid', 'type': 'STRING'},
-                {'name': 't', 'type': 'STRING'},
-                {'name': 'ni', 'type': 'INTEGER'},
-                {'name': 'ec', 'type': 'STRING'},
-                {'name': 'ea', 'type': 'STRING'},
-                {'name': 'el', 'type': 'STRING'},
-                {'name': 'ev', 'type': 'FLOAT'},
-                {'name': 'ua', 'type': 'STRING'},
             ]
         }
     }
-    self._use_query_results(api_response)
+    if streaming_rows is not None:
+      response_json['streamingBuffer'] = {
+          'estimatedRows': str(streaming_rows)}
+    self._use_query_results(response_json)
 
-    patcher_worker_enqueue = mock.patch.object(workers.BQToMeasurementProtocol, '_enqueue')
-    self.addCleanup(patcher_worker_enqueue.stop)
-    patched_enqueue = patcher_worker_enqueue.start()
-    def _remove_next_page_token(worker_name, *args, **kwargs):
-      if worker_name == 'BQToMeasurementProtocol':
-        del api_response['pageToken']
-        self._use_query_results(api_response)
-    patched_enqueue.side_effect = _remove_next_page_token
+  def _make_worker(self, **params):
+    worker_params = {
+        'bq_project_id': 'BQID',
+        'bq_dataset_id': 'DTID',
+        'bq_table_id': 'table_id',
+        'mp_batch_size': 20,
+    }
+    worker_params.update(params)
+    return workers.BQToMeasurementProtocol(worker_params, 1, 1)
 
-    self._worker._execute()
+  @mock.patch.object(workers.BQToMeasurementProtocol, '_enqueue')
+  def test_enqueues_a_processor_per_range_of_rows(self, patched_enqueue):
+    self._use_table(2500)
+    self._make_worker()._execute()
+    self.assertEqual(
+        [(c[0][0], c[0][1]['bq_start_index'], c[0][1]['bq_batch_size'])
+         for c in patched_enqueue.call_args_list],
+        [('BQToMeasurementProtocolProcessor', 0, 1000),
+         ('BQToMeasurementProtocolProcessor', 1000, 1000),
+         ('BQToMeasurementProtocolProcessor', 2000, 1000)])
+    # Rows aren't read, only the table metadata.
+    self.assertEqual(self._client._connection.api_request.call_count, 1)
+
+  @mock.patch.object(workers.BQToMeasurementProtocol, '_enqueue')
+  def test_spawns_new_worker_for_remaining_ranges(self, patched_enqueue):
+    self._use_table(2500)
+    worker = self._make_worker(bq_start_index=1000)
+    worker.MAX_ENQUEUED_JOBS = 1
+    worker._execute()
     self.assertEqual(patched_enqueue.call_count, 2)
-    self.assertEqual(patched_enqueue.call_args_list[0][0][0], 'BQToMeasurementProtocolProcessor')
-    self.assertEqual(patched_enqueue.call_args_list[0][0][1]['bq_page_token'], None)
-    self.assertEqual(patched_enqueue.call_args_list[1][0][0], 'BQToMeasurementProtocol')
-    self.assertEqual(patched_enqueue.call_args_list[1][0][1]['bq_page_token'], 'abc')
+    self.assertEqual(patched_enqueue.call_args_list[0][0][0],
+                     'BQToMeasurementProtocolProcessor')
+    self.assertEqual(patched_enqueue.call_args_list[0][0][1]['bq_start_index'],
+                     1000)
+    self.assertEqual(patched_enqueue.call_args_list[1][0][0],
+                     'BQToMeasurementProtocol')
+    self.assertEqual(patched_enqueue.call_args_list[1][0][1]['bq_start_index'],
+                     2000)
+
+  @mock.patch.object(workers.BQToMeasurementProtocol, '_enqueue')
+  def test_enqueues_a_processor_per_page_with_streaming_buffer(
+      self, patched_enqueue):
+    self._use_table(0, streaming_rows=500)
+    self._make_worker()._execute()
+    self.assertEqual(patched_enqueue.call_count, 1)
+    worker_name, worker_params = patched_enqueue.call_args[0][:2]
+    self.assertEqual(worker_name, 'BQToMeasurementProtocolProcessor')
+    self.assertIsNone(worker_params['bq_page_token'])
+    self.assertNotIn('bq_start_index', worker_params)